@@ -12,6 +12,18 @@ export SEEDS="0,1,2"
 # Number of results to be bundled as one directory. Naming scheme: results/<job-id>_<gpu-profile>_x-y
 export RESULTS_PER_DIR=250
 
+# Maximum number of inference jobs run by one GPU task (one container start, model load and JAX compilation).
+# Reduced automatically so that the task fits the partition MaxTime and the value divides RESULTS_PER_DIR.
+export JOBS_PER_TASK=1
+
+# Maximum number of monomers run by one data pipeline task (one container start, databases stay in the page cache).
+# CPUs, memory and walltime per task follow the datapipeline_classes of the cluster config.
+export MONOMERS_PER_TASK=1
+
+# Maximum number of seeds of one inference job run by one GPU task (0: all seeds in one task).
+# Jobs with more seeds are split into tasks that run in parallel, their results are merged afterwards.
+export SEEDS_PER_TASK=0
+
 # Sorting options: 'alpha' = use keys of INPUT_FILE alphabetically for the script logic, 'input' = preserve key order from INPUT_FILE.
 export SORTING="alpha"
 
@@ -19,6 +31,15 @@ export SORTING="alpha"
 export SCREEN_FILE="screen.json"
 export MAX_COMPOUND_ATOMS=50
 
+# Inference job generation: 'false' = write one JSON per job into pending_jobs/, 'true' = only write a compact job plan
+# (pending_jobs/<run>/inference_plan.json) from which every inference task builds its own JSON.
+export VIRTUAL_JOBS=false
+
+# Streaming: 'true' = submit every inference job as soon as its monomers are ready instead of waiting for the whole
+# data pipeline (needs VIRTUAL_JOBS=true). STREAM_INTERVAL = minutes between two checks for newly finished monomers.
+export STREAMING=false
+export STREAM_INTERVAL=5
+
 # where to find the cluster specific settings for this pipeline
 export CLUSTER_CONFIG="cluster_config.json"
 
@@ -34,6 +55,19 @@ export INFERENCE_STATISTICS_FILE="inference_statistics.jsonl"
 # Optional postprocessing script that runs after every inference job and has access to environment variables such as
 # INFERENCE_NAME, INFERENCE_DIR and INFERENCE_ID. Leave empty if no postprocessing should be done.
 export POSTPROCESSING_SCRIPT="postprocessing_example.sh"
+# 0: one SLURM job per inference job. >0: finished jobs are queued and this many long-lived CPU workers run the script
+# for POSTPROCESSING_BATCH_SIZE jobs at a time (saves one submission per job in large screens).
+export POSTPROCESSING_WORKERS=0
+export POSTPROCESSING_BATCH_SIZE=20
+
+# Whole-node mode: name of a node type in gpu_nodes of the cluster config. NODES jobs on such nodes run one AlphaFold
+# worker per GPU or MIG instance instead of one array task per job. Leave empty for array jobs.
+export NODE_TYPE=""
+export NODES=1
+
+# GPUs available per profile, e.g. "40g=32,80g=8". If set, jobs are moved from the smallest profile that fits to larger
+# profiles when that lowers the makespan predicted from INFERENCE_STATISTICS_FILE (needs VIRTUAL_JOBS=false).
+export SPILL_GPUS=""
 
 ###########################################################################################################################
                                                            
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The utilities are scripts that import their siblings, as when run from utilities/
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "utilities"))
@@ -0,0 +1,132 @@
+import os
+import gzip
+import json
+import pytest
+import content_index
+import extract_msa_and_template_data as extractor
+
+MTIME = 1700000000  # gzip header time of both versions
+
+
+def reference_dumps(obj, indent=2):
+    """The serializer of the extractor before streaming (json.load + dumps_compact_lists)."""
+    def _dump(o, level=0):
+        if isinstance(o, dict):
+            items = [" " * ((level + 1) * indent) + json.dumps(k) + ": " + _dump(v, level + 1) for k, v in o.items()]
+            return "{\n" + ",\n".join(items) + "\n" + " " * (level * indent) + "}"
+        if isinstance(o, list):
+            if any(isinstance(el, dict) for el in o):
+                items = [" " * ((level + 1) * indent) + _dump(el, level + 1) for el in o]
+                return "[\n" + ",\n".join(items) + "\n" + " " * (level * indent) + "]"
+            return "[" + ",".join(_dump(el, level) for el in o) + "]"
+        return json.dumps(o)
+    return _dump(obj, 0)
+
+def reference_extract(input_file, use_gzip):
+    """Output files of the extractor before streaming."""
+    input_dir = os.path.dirname(os.path.abspath(input_file))
+    msa_folder = os.path.join(input_dir, "msas")
+    template_folder = os.path.join(input_dir, "templates")
+    os.makedirs(msa_folder, exist_ok=True)
+    os.makedirs(template_folder, exist_ok=True)
+    with open(input_file) as f:
+        data = json.load(f)
+    name = data.get("name", "protein")
+
+    def write_file(path, content):
+        if use_gzip:
+            with gzip.open(path + ".gz", "wt") as gz:
+                gz.write(content)
+            return path + ".gz"
+        with open(path, "w") as f:
+            f.write(content)
+        return path
+
+    def read_file(path):
+        with (gzip.open(path, "rt") if use_gzip else open(path, "r")) as f:
+            return f.read()
+
+    for seq_entry in data.get("sequences", []):
+        protein = seq_entry.get("protein", {})
+        for key, suffix in (("unpairedMsa", "unpaired"), ("pairedMsa", "paired")):
+            if protein.get(key):
+                path = write_file(os.path.join(msa_folder, f"{name}_{suffix}.a3m"), protein.pop(key))
+                protein[key + "Path"] = os.path.relpath(path, input_dir)
+        for template in protein.get("templates", []):
+            if template.get("mmcif"):
+                content = template.pop("mmcif")
+                base = os.path.join(template_folder, content.splitlines()[0].replace("data_", "").strip())
+                ext = ".cif.gz" if use_gzip else ".cif"
+                candidate, idx = base + ext, 1
+                while os.path.exists(candidate) and read_file(candidate) != content:
+                    candidate, idx = f"{base}_{idx}{ext}", idx + 1
+                if not os.path.exists(candidate):
+                    write_file(candidate[:-3] if use_gzip else candidate, content)
+                template["mmcifPath"] = os.path.relpath(candidate, input_dir)
+    with open(input_file, "w") as f:
+        f.write(reference_dumps(data))
+
+def monomer(name):
+    """A _data.json with escapes, non-ASCII text and surrogate pairs in MSAs, templates and plain strings."""
+    cif = 'data_1ABC\n_entry.id 1ABC\n# "quoted" \\ backslash é \U0001F600\n'
+    return {
+        "dialect": "alphafold3",
+        "version": 2,
+        "name": name,
+        "sequences": [
+            {"protein": {
+                "id": "A",
+                "sequence": "MKVÅ\U0001F9EA",
+                "modifications": [],
+                "unpairedMsa": ">query \"A\"\tx\\y\nMKVÅ\U0001F9EA\n>hit/1  \nMKV--\n" * 3,
+                "pairedMsa": "",
+                "templates": [
+                    {"mmcif": cif, "queryIndices": [0, 1, 2], "templateIndices": [0, 1, 2]},
+                    {"mmcif": cif, "queryIndices": [1], "templateIndices": [3]},
+                    {"mmcif": cif.replace("backslash", "other"), "queryIndices": [2], "templateIndices": [4]},
+                    {"mmcif": "data_2XYZ\r\n\U0001F600", "queryIndices": [], "templateIndices": []},
+                ],
+            }},
+            {"protein": {"id": "B", "sequence": "G", "unpairedMsa": ">q\nG\n", "pairedMsa": ">p\nG\n",
+                         "templates": []}},
+        ],
+        "modelSeeds": [1, -2, 3.5e3],
+        "bondedAtomPairs": None,
+        "userCCD": "a\\\"b\u0000",
+    }
+
+def tree(directory):
+    """Contents of all files below directory, without the content index."""
+    files = {}
+    for root, dirs, names in os.walk(directory):
+        dirs[:] = [d for d in dirs if d != content_index.INDEX_DIR]
+        for name in names:
+            with open(os.path.join(root, name), "rb") as f:
+                files[os.path.relpath(os.path.join(root, name), directory)] = f.read()
+    return files
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 3, 5, 7, 64])
+@pytest.mark.parametrize("use_gzip", [False, True])
+@pytest.mark.parametrize("ensure_ascii", [True, False])
+def test_streaming_matches_json_load(tmp_path, monkeypatch, chunk_size, use_gzip, ensure_ascii):
+    monkeypatch.setattr(extractor, "CHUNK_SIZE", chunk_size)
+    monkeypatch.setattr(content_index, "CHUNK_SIZE", chunk_size)
+    monkeypatch.setattr(gzip.time, "time", lambda: MTIME)
+    text = json.dumps(monomer("mono"), indent=2, ensure_ascii=ensure_ascii)
+    outputs = []
+    for version in ("reference", "streaming"):
+        directory = tmp_path / version
+        directory.mkdir()
+        input_file = directory / "mono_data.json"
+        input_file.write_text(text, encoding="utf-8")
+        if version == "reference":
+            reference_extract(str(input_file), use_gzip)
+        else:
+            extractor.extract(str(input_file), use_gzip)
+        outputs.append(tree(directory))
+    assert outputs[0] == outputs[1]
+    gz = ".gz" if use_gzip else ""
+    assert sorted(outputs[1]) == sorted(["mono_data.json", f"msas/mono_unpaired.a3m{gz}", f"msas/mono_paired.a3m{gz}",
+                                         f"templates/1ABC.cif{gz}", f"templates/1ABC_1.cif{gz}",
+                                         f"templates/2XYZ.cif{gz}"])
+    assert not [n for n in os.listdir(tmp_path / "streaming" / "msas") if n.startswith(".payload_")]
@@ -0,0 +1,44 @@
+import random
+import pytest
+from job_plan import DEFAULT_BUCKETS, profile_windows
+from planner import count_jobs, enumerate_unique_jobs, job_histogram, token_histogram
+
+TOKEN_LIMITS = [1024, 2560, 5120]
+
+
+def random_input(rng, kind):
+    """Protein lists of identical, disjoint or partially overlapping dimensions and the protein lengths."""
+    pool = [f"P{i}" for i in range(12)]
+    lengths = {p: rng.randint(50, 1500) for p in pool}
+    dims = rng.randint(1, 4)
+    if kind == "identical":
+        proteins = rng.sample(pool, rng.randint(1, 5))
+        lists = [list(proteins) for _ in range(dims)]
+    elif kind == "disjoint":
+        shuffled = rng.sample(pool, len(pool))
+        lists = [shuffled[3 * d:3 * d + rng.randint(1, 3)] for d in range(dims)]
+    else:
+        lists = [rng.sample(pool[:6], rng.randint(1, 4)) for _ in range(dims)]
+    return lists, lengths
+
+
+@pytest.mark.parametrize("mode", ["cartesian", "collapsed"])
+@pytest.mark.parametrize("kind", ["identical", "disjoint", "overlapping"])
+def test_counts_match_enumeration(mode, kind):
+    rng = random.Random(f"{mode}-{kind}")
+    windows = list(profile_windows(range(len(TOKEN_LIMITS)), dict(enumerate(TOKEN_LIMITS)), list(DEFAULT_BUCKETS)).values())
+    cap = windows[-1][1]
+    for _ in range(50):
+        lists, lengths = random_input(rng, kind)
+        reference = enumerate_unique_jobs(mode, lists)
+        histogram = token_histogram(reference, lengths, cap)
+
+        jobs, profile_counts = count_jobs(mode, lists, lengths, windows)
+        assert jobs == len(reference)
+        assert profile_counts == [sum(histogram[lo:hi + 1]) for lo, hi in windows] + [histogram[cap + 1]]
+
+        jobs, closed_form_histogram, _ = job_histogram(mode, lists, lengths, cap)
+        assert jobs == len(reference)
+        assert closed_form_histogram == histogram
+        # verify=True enumerates internally and must agree as well
+        assert count_jobs(mode, lists, lengths, windows, verify=True)[0] == len(reference)
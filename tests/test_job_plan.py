@@ -0,0 +1,39 @@
+import itertools
+import pytest
+from job_plan import JobWriter, build_job, dumps_compact_lists, write_jobs
+
+SEEDS = [1, 2, 42]
+MONOMERS = {
+    # id and description already set (e.g. copied from a job JSON): kept in place, values replaced
+    "A": {"protein": {"id": "X", "description": "old", "sequence": "MKV",
+                      "modifications": [{"ptmType": "HY3", "ptmPosition": 1}],
+                      "unpairedMsaPath": "msas/A_unpaired.a3m", "pairedMsa": "",
+                      "templates": [{"mmcifPath": "templates/1ABC.cif", "queryIndices": [0, 1],
+                                     "templateIndices": [0, 1]}]}},
+    "B": {"protein": {"sequence": "GÅ\"\\", "unpairedMsa": ">q\nG\n", "templates": []}},
+}
+COMPOUNDS = [None, {"ID": 17, "SMILES": "CCO", "Atoms": 3}, {"ID": "CHEMBL25", "SMILES": "c1ccccc1", "Atoms": 6}]
+CHOICES = [(), ("A",), ("B",), ("A", "B"), ("B", "A", "A")]
+
+
+def expected(choice, compound):
+    name, data, _ = build_job(choice, compound, MONOMERS, SEEDS)
+    return name, dumps_compact_lists(data)
+
+@pytest.mark.parametrize("choice,compound", list(itertools.product(CHOICES, COMPOUNDS)))
+def test_render_matches_build_job(choice, compound):
+    assert JobWriter(MONOMERS, SEEDS).render(choice, compound) == expected(choice, compound)
+
+def test_render_leaves_monomers_unchanged():
+    writer = JobWriter(MONOMERS, SEEDS)
+    writer.render(("A", "B"), COMPOUNDS[1])
+    assert MONOMERS["A"]["protein"]["id"] == "X" and "id" not in MONOMERS["B"]["protein"]
+
+@pytest.mark.parametrize("processes", [1, 3])
+def test_write_jobs(tmp_path, processes):
+    jobs = [(str(tmp_path / f"job_{i}.json"), choice, compound)
+            for i, (choice, compound) in enumerate(itertools.product(CHOICES, COMPOUNDS))]
+    write_jobs(JobWriter(MONOMERS, SEEDS), jobs, processes=processes, chunk_size=2)
+    for job_file, choice, compound in jobs:
+        with open(job_file, "r") as f:
+            assert f.read() == expected(choice, compound)[1]
@@ -0,0 +1,68 @@
+import os
+import json
+from merge_seed_shards import merge
+
+NAME = "a_b"
+
+
+def fake_shard(shards_dir, k, seeds, scores):
+    """AlphaFold output directory of shard k: one sample per seed with the given ranking scores."""
+    out = os.path.join(shards_dir, str(k), NAME)
+    os.makedirs(out)
+    with open(os.path.join(out, f"{NAME}_ranking_scores.csv"), "w") as f:
+        f.write("seed,sample,ranking_score\n")
+        for seed, score in zip(seeds, scores):
+            f.write(f"{seed},0,{score}\n")
+    with open(os.path.join(out, f"{NAME}_data.json"), "w") as f:
+        json.dump({"name": NAME, "modelSeeds": seeds}, f)
+    for seed in seeds:
+        os.makedirs(os.path.join(out, f"seed-{seed}_sample-0"))
+        with open(os.path.join(out, f"seed-{seed}_sample-0", "model.cif"), "w") as f:
+            f.write(f"seed {seed}\n")
+    for suffix in ("model.cif", "summary_confidences.json"):
+        with open(os.path.join(out, f"{NAME}_{suffix}"), "w") as f:
+            f.write(f"shard {k}\n")
+
+def read(*parts):
+    with open(os.path.join(*parts), "r") as f:
+        return f.read()
+
+def make_shards(tmp_path, scores):
+    shards_dir = str(tmp_path / "shards")
+    seeds = [[1, 2], [3], [4, 5]]
+    for k, (shard_seeds, shard_scores) in enumerate(zip(seeds, scores)):
+        fake_shard(shards_dir, k, shard_seeds, shard_scores)
+    return shards_dir, str(tmp_path / "results")
+
+def test_merge_in_seed_order_with_the_best_sample(tmp_path):
+    shards_dir, output_dir = make_shards(tmp_path, [[0.5, 0.7], [0.9], [0.9, 0.1]])
+    # shards end in any order; the last one merges
+    assert merge(shards_dir, NAME, 3, output_dir, 2, "done") == "waiting"
+    assert merge(shards_dir, NAME, 3, output_dir, 0, "done") == "waiting"
+    assert merge(shards_dir, NAME, 3, output_dir, 1, "done") == "merged"
+
+    target = os.path.join(output_dir, NAME)
+    assert not os.path.exists(shards_dir)
+    assert read(target, f"{NAME}_ranking_scores.csv").splitlines() == [
+        "seed,sample,ranking_score", "1,0,0.5", "2,0,0.7", "3,0,0.9", "4,0,0.9", "5,0,0.1"]
+    assert json.loads(read(target, f"{NAME}_data.json"))["modelSeeds"] == [1, 2, 3, 4, 5]
+    assert sorted(e for e in os.listdir(target) if e.startswith("seed-")) == [f"seed-{s}_sample-0" for s in range(1, 6)]
+    assert read(target, "seed-4_sample-0", "model.cif") == "seed 4\n"
+    # shards 1 and 2 tie for the best score: the first in seed order provides the top-level files
+    assert read(target, f"{NAME}_model.cif") == "shard 1\n"
+    assert read(target, f"{NAME}_summary_confidences.json") == "shard 1\n"
+
+def test_failed_shard_keeps_the_others(tmp_path):
+    shards_dir, output_dir = make_shards(tmp_path, [[0.5, 0.7], [0.9], [0.2, 0.1]])
+    assert merge(shards_dir, NAME, 3, output_dir, 0, "done") == "waiting"
+    assert merge(shards_dir, NAME, 3, output_dir, 1, "out_of_memory") == "waiting"
+    assert merge(shards_dir, NAME, 3, output_dir, 2, "done") == "out_of_memory"
+    assert not os.path.exists(os.path.join(output_dir, NAME))
+    for k, seeds in enumerate([[1, 2], [3], [4, 5]]):
+        shard = os.path.join(shards_dir, str(k), NAME)
+        assert sorted(e for e in os.listdir(shard) if e.startswith("seed-")) == [f"seed-{s}_sample-0" for s in seeds]
+
+    # running the job again only reruns the failed shard, then all of them are merged
+    assert merge(shards_dir, NAME, 3, output_dir, 1, "done") == "merged"
+    assert json.loads(read(output_dir, NAME, f"{NAME}_data.json"))["modelSeeds"] == [1, 2, 3, 4, 5]
+    assert read(output_dir, NAME, f"{NAME}_model.cif") == "shard 1\n"
@@ -0,0 +1,173 @@
+import os
+import json
+import pytest
+from job_plan import write_plan, DEFAULT_BUCKETS
+from datapipeline_sizing import ARRAYS_FILE
+from monomer_manifest import record_monomer
+from pipeline_controller import SlurmCLI, tick, load_state, save_state, resume_batch
+from run_ledger import append_records, load_ledger
+
+FAKE_SLURM = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fake_slurm")
+CLUSTER_CONF = {"gpu_profiles": {"40g": {"gres": "gpu:a100:1", "token_limit": 5120, "max_minutes_per_seed": 10}}}
+SEQUENCES = {"A": "ACDEFGHIK" * 10, "B": "LMNPQRSTV" * 20, "C": "WYACDEFGH" * 30}
+
+
+@pytest.fixture
+def run(tmp_path, monkeypatch):
+    """Streaming run of the jobs A+C and B+C with sbatch/squeue replaced by tests/fake_slurm."""
+    monkeypatch.chdir(tmp_path)
+    slurm_dir = tmp_path / "slurm"
+    slurm_dir.mkdir()
+    monkeypatch.setenv("FAKE_SLURM_DIR", str(slurm_dir))
+    monkeypatch.setenv("PATH", FAKE_SLURM + os.pathsep + os.environ["PATH"])
+    os.makedirs("monomer_data/msas")
+    run_dir = os.path.join("pending_jobs", "r1")
+    write_plan(run_dir, "cartesian", [["A", "B"], ["C"]], SEQUENCES, [], [0, 1], ["40g"], {"40g": 5120},
+               list(DEFAULT_BUCKETS), streaming=True)
+    with open(os.path.join(run_dir, ARRAYS_FILE), "w") as f:
+        json.dump([{"first": 0, "last": 2, "pack": 1, "cpus": 8, "mem_gb": 64, "minutes": 60}], f)
+    env = {"MAX_ARRAY_SIZE": "1000", "MAX_SUBMIT_JOBS": "100", "TOTAL_DATAPIPELINE_JOBS": "3", "JOBS_PER_TASK": "1",
+           "RESULTS_PER_DIR": "10", "SEEDS": "0,1", "DATAPIPELINE_PARTITION": "cpu", "INFERENCE_PARTITION": "gpu"}
+    return run_dir, env, slurm_dir
+
+def finish_monomer(name):
+    """Write a monomer like the data pipeline task does: MSA first, then the _data.json and its manifest record."""
+    msa = f"msas/{name}.a3m"
+    with open(os.path.join("monomer_data", msa), "w") as f:
+        f.write(f">{name}\n{SEQUENCES[name]}\n")
+    data = {"name": name, "sequences": [{"protein": {"id": "A", "sequence": SEQUENCES[name],
+                                                     "unpairedMsaPath": msa, "templates": []}}]}
+    path = os.path.join("monomer_data", f"{name}_data.json")
+    with open(path, "w") as f:
+        json.dump(data, f)
+    record_monomer(path, data)
+
+def submissions(slurm_dir):
+    with open(slurm_dir / "submissions.jsonl") as f:
+        return [json.loads(line) for line in f]
+
+def exports(submission):
+    export = next(arg for arg in submission["args"] if arg.startswith("--export="))
+    return dict(item.split("=", 1) for item in export.split("=", 1)[1].split(",")[1:])
+
+def test_inference_follows_ready_monomers(run):
+    run_dir, env, slurm_dir = run
+    slurm = SlurmCLI()
+
+    assert not tick(run_dir, slurm, env, CLUSTER_CONF)
+    (dp,) = submissions(slurm_dir)
+    assert dp["args"][-1] == "utilities/af3_datapipeline_only_slurm.sh" and dp["tasks"] == 3
+
+    # A and C finished; B has its MSA but no _data.json yet, so B+C is not runnable
+    finish_monomer("A")
+    finish_monomer("C")
+    with open("monomer_data/msas/B.a3m", "w") as f:
+        f.write(">B\n")
+    assert not tick(run_dir, slurm, env, CLUSTER_CONF)
+    inference = submissions(slurm_dir)[1:]
+    assert len(inference) == 1 and inference[0]["args"][-1] == "utilities/af3_inference_only_slurm.sh"
+    assert (exports(inference[0])["RANGE_START"], exports(inference[0])["RANGE_END"]) == ("0", "0")
+
+    finish_monomer("B")
+    assert not tick(run_dir, slurm, env, CLUSTER_CONF)
+    inference = submissions(slurm_dir)[1:]
+    assert len(inference) == 2
+    assert (exports(inference[1])["RANGE_START"], exports(inference[1])["RANGE_END"]) == ("1", "1")
+
+    # Nothing is submitted twice while the arrays are still queued
+    assert not tick(run_dir, slurm, env, CLUSTER_CONF)
+    assert len(submissions(slurm_dir)) == 3
+
+    # All tasks left the queue after reporting to the ledger
+    (slurm_dir / "queue").write_text("")
+    append_records(run_dir, [{"stage": "datapipeline", "profile": None, "id": i, "state": "done"} for i in range(3)]
+                   + [{"stage": "inference", "profile": "40g", "id": i, "state": "done"} for i in range(2)])
+    assert tick(run_dir, slurm, env, CLUSTER_CONF)
+
+def test_same_sequence_is_linked_once_the_first_finished(run, monkeypatch):
+    run_dir, env, slurm_dir = run
+    monkeypatch.setitem(SEQUENCES, "A2", SEQUENCES["A"].lower())
+    write_plan(run_dir, "cartesian", [["A", "A2"], ["C"]], SEQUENCES, [], [0, 1], ["40g"], {"40g": 5120},
+               list(DEFAULT_BUCKETS), streaming=True)
+    env.update(INPUT_FILE="input.json", CLUSTER_CONFIG="cluster.json")
+    linked = []
+
+    def link_run(input_file, cluster_config, monomer_dir, names=None):
+        linked.append(set(names))
+        for name in names:
+            finish_monomer(name)
+        return []
+
+    monkeypatch.setattr("pipeline_controller.link_run", link_run)
+    finish_monomer("C")
+    assert not tick(run_dir, SlurmCLI(), env, CLUSTER_CONF)
+    assert not tick(run_dir, SlurmCLI(), env, CLUSTER_CONF)
+    assert linked == []
+    finish_monomer("A")
+    assert not tick(run_dir, SlurmCLI(), env, CLUSTER_CONF)
+    assert linked == [{"A2"}]
+    assert load_state(run_dir, ["40g"])["released"]["40g"] == 2
+
+def test_state_of_profile_added_before_a_crash(tmp_path):
+    # add_profile saves the plan before the controller saves its state
+    save_state(str(tmp_path), {"released": {"40g": 3}, "submitted": {"40g": 3}, "segments": {"40g": []}})
+    state = load_state(str(tmp_path), ["40g", "80g"])
+    assert state["released"] == {"40g": 3, "80g": 0}
+    assert state["submitted"]["80g"] == 0 and state["segments"]["80g"] == []
+
+def test_timeout_retries_merge_into_the_failed_job(run, tmp_path):
+    run_dir, env, slurm_dir = run
+    env["JOBS_PER_TASK"] = "2"
+    slurm = SlurmCLI()
+    for name in "ABC":
+        finish_monomer(name)
+    tick(run_dir, slurm, env, CLUSTER_CONF)
+    (slurm_dir / "queue").write_text("")
+    result_dir = str(tmp_path / "results" / "1001_40g_0-1")
+    append_records(run_dir, [{"stage": "datapipeline", "profile": None, "id": i, "state": "done"} for i in range(3)]
+                   + [{"stage": "inference", "profile": "40g", "id": 0, "name": "a_c", "state": "failed",
+                       "reason": "timeout", "seeds": [0, 1], "seeds_done": [], "result_dir": f"{result_dir}/a_c"},
+                      {"stage": "inference", "profile": "40g", "id": 1, "state": "done"}])
+    assert not tick(run_dir, slurm, env, CLUSTER_CONF)
+
+    ledger = load_ledger(run_dir)
+    parts = [ledger["inference", "40g", job_id] for job_id in (2, 3)]
+    assert [part["seeds"] for part in parts] == [[0], [1]]
+    assert all(part["merge_into"] == result_dir for part in parts)
+    # the halves of a job never share a task, both write <merge_into>/a_c
+    ranges = [(exports(s)["RANGE_START"], exports(s)["RANGE_END"]) for s in submissions(slurm_dir)[-2:]]
+    assert ranges == [("2", "2"), ("3", "3")]
+
+def test_resume_without_streaming(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv("FAKE_SLURM_DIR", str(tmp_path))
+    monkeypatch.setenv("PATH", FAKE_SLURM + os.pathsep + os.environ["PATH"])
+    run_dir = os.path.join("pending_jobs", "r2")
+    os.makedirs(os.path.join(run_dir, "40g"))
+    for job_id, name in ((1, "a_c"), (2, "b_c"), (3, "a_b")):
+        with open(os.path.join(run_dir, "40g", f"{job_id}_{name}.json"), "w") as f:
+            json.dump({"name": name}, f)
+    result_dir = str(tmp_path / "results" / "1001_40g_0-3")
+    # job 0 is done (its JSON is removed), job 3 never ran
+    append_records(run_dir, [
+        {"stage": "inference", "profile": "40g", "id": 0, "state": "done"},
+        {"stage": "inference", "profile": "40g", "id": 1, "name": "a_c", "state": "failed", "reason": "timeout",
+         "result_dir": f"{result_dir}/a_c"},
+        {"stage": "inference", "profile": "40g", "id": 2, "name": "b_c", "state": "failed", "reason": "oom"},
+    ])
+    conf = {"gpu_profiles": dict(CLUSTER_CONF["gpu_profiles"],
+                                 **{"80g": {"gres": "gpu:h100:1", "token_limit": 8192, "max_minutes_per_seed": 5}})}
+    env = {"MAX_ARRAY_SIZE": "1000", "SEEDS": "0,1", "INFERENCE_PARTITION": "gpu"}
+
+    assert resume_batch(run_dir, SlurmCLI(), env, conf) == 3
+    resubmitted = {exports(s)["GPU_PROFILE"]: s for s in submissions(tmp_path)}
+    assert resubmitted["40g"]["args"][0] == "--array=1,3" and resubmitted["40g"]["tasks"] == 2
+    assert resubmitted["80g"]["args"][0] == "--array=0"
+    assert exports(resubmitted["80g"])["RESUMED"] == "true"
+    assert "0_b_c.json" in os.listdir(os.path.join(run_dir, "80g"))
+
+    ledger = load_ledger(run_dir)
+    assert ledger["inference", "40g", 1]["merge_into"] == result_dir
+    assert ledger["inference", "40g", 2]["state"] == "retried"
+    assert ledger["inference", "80g", 0]["retry_of"] == {"profile": "40g", "id": 2}
+    assert ledger["inference", "40g", 3]["reason"] == "lost"
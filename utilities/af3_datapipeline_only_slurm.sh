@@ -10,26 +10,46 @@
 echo "Job ran on:" $(hostname)
 echo ""
 
-DATA_PIPELINE_ID=$(( SLURM_ARRAY_TASK_ID + START_OFFSET ))
-scontrol update jobid=${SLURM_ARRAY_JOB_ID}_${SLURM_ARRAY_TASK_ID} comment="Task $((DATA_PIPELINE_ID + 1)) of ${TOTAL_DATAPIPELINE_JOBS}"
+# Every array task runs the data pipeline for DP_JOBS_PER_TASK consecutive DATA_PIPELINE_IDs in one AlphaFold call
+# (START_OFFSET counts tasks). The array covers the DATA_PIPELINE_IDs DP_RANGE_START-DP_RANGE_END, entry DP_ARRAY of
+# pending_jobs/<PIPELINE_RUN_ID>/datapipeline_arrays.json (monomers of one resource class, see datapipeline_sizing.py).
+DP_JOBS_PER_TASK=${DP_JOBS_PER_TASK:-1}
+DP_RANGE_START=${DP_RANGE_START:-0}
+DP_RANGE_END=${DP_RANGE_END:-$(( TOTAL_DATAPIPELINE_JOBS - 1 ))}
+TASK_INDEX=$(( SLURM_ARRAY_TASK_ID + START_OFFSET ))
+FIRST_DATA_PIPELINE_ID=$(( DP_RANGE_START + TASK_INDEX * DP_JOBS_PER_TASK ))
+LAST_DATA_PIPELINE_ID=$(( FIRST_DATA_PIPELINE_ID + DP_JOBS_PER_TASK - 1 ))
+if (( LAST_DATA_PIPELINE_ID > DP_RANGE_END )); then
+    LAST_DATA_PIPELINE_ID=$DP_RANGE_END
+fi
+scontrol update jobid=${SLURM_ARRAY_JOB_ID}_${SLURM_ARRAY_TASK_ID} comment="Jobs $((FIRST_DATA_PIPELINE_ID + 1))-$((LAST_DATA_PIPELINE_ID + 1)) of ${TOTAL_DATAPIPELINE_JOBS}"
 
 WORKDIR=$(pwd)
-user_input_file=$WORKDIR/data_pipeline_inputs/${PIPELINE_RUN_ID}/${DATA_PIPELINE_ID}_*.json
-AF3_input_file=$(basename $user_input_file)
-AF3_input_path=$WORKDIR/data_pipeline_inputs/${PIPELINE_RUN_ID}
+DP_inputs_path=$WORKDIR/data_pipeline_inputs/${PIPELINE_RUN_ID}
+AF3_input_path=$WORKDIR/tmp/dp_input_${SLURM_ARRAY_JOB_ID}/${SLURM_ARRAY_TASK_ID}
 AF3_output_path=$WORKDIR/monomer_data
+AF3_log=$WORKDIR/tmp/dp_log_${SLURM_ARRAY_JOB_ID}_${SLURM_ARRAY_TASK_ID}.log # AlphaFold output with timestamps
+SLURM_LOG="slurm-output/slurm-${SLURM_ARRAY_JOB_ID}_${SLURM_ARRAY_TASK_ID}-${SLURM_JOB_NAME}.out"
+DP_ARRAYS=$WORKDIR/pending_jobs/${PIPELINE_RUN_ID}/datapipeline_arrays.json
+LEDGER=$WORKDIR/pending_jobs/${PIPELINE_RUN_ID}/ledger.jsonl
 export APPTAINER_TMPDIR=$WORKDIR/tmp/apptainer_${SLURM_ARRAY_JOB_ID}/${SLURM_ARRAY_TASK_ID}
 
-# --- Task 0 only: decide what’s next ---
-if [[ "$SLURM_ARRAY_TASK_ID" -eq 0 ]]; then
-    NEXT_OFFSET=$(( START_OFFSET + MAX_ARRAY_SIZE ))
+# --- Task 0 only: decide what’s next (not with the streaming controller, which submits all tasks itself, or for jobs
+# resubmitted by utilities/resume_run.sh, which submits the second stage itself) ---
+if [[ "$SLURM_ARRAY_TASK_ID" -eq 0 && "${CONTROLLER_MANAGED:-false}" != "true" && "${RESUMED:-false}" != "true" ]]; then
+    NEXT_ARRAY=$(( ${DP_ARRAY:-0} + 1 ))
 
-    if (( NEXT_OFFSET < TOTAL_DATAPIPELINE_JOBS )); then
-        echo "Submitting next datapipeline batch starting at offset $NEXT_OFFSET"
+    if (( NEXT_ARRAY < $(jq 'length' "$DP_ARRAYS") )); then
+        read -r first last pack cpus mem_gb minutes < <(jq -r --argjson k "$NEXT_ARRAY" \
+            '.[$k] | "\(.first) \(.last) \(.pack) \(.cpus) \(.mem_gb) \(.minutes)"' "$DP_ARRAYS")
+        echo "Submitting next datapipeline array: jobs $first-$last"
         sbatch --dependency=afterok:${SLURM_ARRAY_JOB_ID} \
                --partition=${DATAPIPELINE_PARTITION} \
-               --array=0-$(( MAX_ARRAY_SIZE < (TOTAL_DATAPIPELINE_JOBS - NEXT_OFFSET) ? MAX_ARRAY_SIZE-1 : (TOTAL_DATAPIPELINE_JOBS - NEXT_OFFSET)-1 )) \
-               --export=ALL,START_OFFSET=$NEXT_OFFSET \
+               --array=0-$(( (last - first + pack) / pack - 1 )) \
+               --cpus-per-task=$cpus \
+               --mem=${mem_gb}G \
+               --time=$minutes \
+               --export=ALL,START_OFFSET=0,DP_ARRAY=$NEXT_ARRAY,DP_RANGE_START=$first,DP_RANGE_END=$last,DP_JOBS_PER_TASK=$pack \
                $WORKDIR/utilities/af3_datapipeline_only_slurm.sh
     else
         echo "All datapipeline batches done. Continuing with pair-building and inference..."
@@ -40,38 +60,120 @@ fi
 # -- End of Task 0 only ---
 
 mkdir -p "$APPTAINER_TMPDIR"
+mkdir -p "$AF3_input_path"
 mkdir -p "$AF3_output_path"
 
+# Node-local copy of the sequence databases, staged by the first task on this node (no-op without db_stage_path)
+read -r db_staging_seconds DB_STAGE_DIR <<< "$(python3 $WORKDIR/utilities/db_stage.py stage)"
 export APPTAINER_BINDPATH="/${AF3_input_path}:/root/af_input,${AF3_output_path}:/root/af_output,${AF3_MODEL_PATH}:/root/models,${AF3_DB_PATH}:/root/public_databases"
+db_dir_args=(--db_dir=/root/public_databases)
+if [[ -n "$DB_STAGE_DIR" ]]; then
+    # AlphaFold looks up every database in the staged directory first, databases not staged are read from AF3_DB_PATH
+    export APPTAINER_BINDPATH="${APPTAINER_BINDPATH},${DB_STAGE_DIR}:/root/staged_databases"
+    db_dir_args=(--db_dir=/root/staged_databases "${db_dir_args[@]}")
+    echo "Using node-local databases in $DB_STAGE_DIR (staged in ${db_staging_seconds}s)"
+fi
+mkdir -p $WORKDIR/pending_jobs/${PIPELINE_RUN_ID}
 
-# Extract the protein name from the JSON
-NAME=$(jq -r '.name' "$AF3_input_path"/"$AF3_input_file")
+# Stage the inputs of all monomers of this task (an input is only removed once its data pipeline succeeded)
+copy_start=$SECONDS
+declare -a DATA_PIPELINE_IDS NAMES USER_INPUT_FILES
+for (( id = FIRST_DATA_PIPELINE_ID; id <= LAST_DATA_PIPELINE_ID; id++ )); do
+    user_input_file=$(echo $DP_inputs_path/${id}_*.json)
+    if [[ ! -f "$user_input_file" ]]; then
+        echo "ERROR: No input for data pipeline ID ${id}." >&2
+        ( flock 9; jq -cn --argjson id "$id" \
+            '{"stage": "datapipeline", "id": $id, "state": "failed", "reason": "no_input"}' >&9 ) 9>>"$LEDGER"
+        continue
+    fi
+    cp "$user_input_file" "$AF3_input_path"
+    DATA_PIPELINE_IDS+=("$id")
+    USER_INPUT_FILES+=("$user_input_file")
+    NAMES+=("$(jq -r '.name' "$user_input_file")")
+done
+input_copy_seconds=$(( SECONDS - copy_start ))
+
+if (( ${#DATA_PIPELINE_IDS[@]} == 0 )); then
+    echo "ERROR: No input could be prepared for data pipeline IDs ${FIRST_DATA_PIPELINE_ID}-${LAST_DATA_PIPELINE_ID}." >&2
+    rm -rf "$APPTAINER_TMPDIR" "$AF3_input_path"
+    exit 1
+fi
 
-echo "Running AlphaFold job for ${NAME} (index ${SLURM_ARRAY_TASK_ID}, total index ${DATA_PIPELINE_ID})"
+echo "Running AlphaFold data pipeline for ${#DATA_PIPELINE_IDS[@]} monomer(s): ${NAMES[*]} (index ${SLURM_ARRAY_TASK_ID}, total index ${FIRST_DATA_PIPELINE_ID}-${LAST_DATA_PIPELINE_ID})"
 
 start_time=$(date -u +"%Y-%m-%dT%H:%M:%SZ")
+search_start=$SECONDS
 
 apptainer exec --writable-tmpfs --nv ${AF3_CONTAINER_PATH} python /app/alphafold/run_alphafold.py \
     --run_inference=false \
-    --json_path=/root/af_input/${AF3_input_file} \
+    --input_dir=/root/af_input \
     --model_dir=/root/models \
     --output_dir=/root/af_output \
-    --db_dir=/root/public_databases \
-    --jackhmmer_n_cpu=$SLURM_CPUS_PER_TASK 
+    "${db_dir_args[@]}" \
+    --jackhmmer_n_cpu=$SLURM_CPUS_PER_TASK \
+2>&1 | tee -a "$SLURM_LOG" \
+     | awk '{ print strftime("%Y-%m-%dT%H:%M:%SZ", systime(), 1) "\t" $0; fflush() }' > "$AF3_log"
 
+search_seconds=$(( SECONDS - search_start ))
 unset APPTAINER_BINDPATH
-
-if [[ -n "${DATAPIPELINE_STATISTICS_FILE:-}" && -f "$DATAPIPELINE_STATISTICS_FILE" ]]; then
-    end_time=$(date -u +"%Y-%m-%dT%H:%M:%SZ")
-    sequence_length=$(jq -r '.sequences[0].protein.sequence | length' "$AF3_input_path"/"$AF3_input_file")
-    echo "${PIPELINE_RUN_ID},${DATA_PIPELINE_ID},${NAME},${SLURM_ARRAY_JOB_ID},${SLURM_ARRAY_TASK_ID},$(hostname),${sequence_length},${start_time},${end_time}" >> $DATAPIPELINE_STATISTICS_FILE
-fi
+end_time=$(date -u +"%Y-%m-%dT%H:%M:%SZ")
 
 rm -rf $APPTAINER_TMPDIR
-rm -rf "$AF3_input_path"/"$AF3_input_file"
 
-# move file one up and delete old directory (it is always only one file per directory -> messy)
-mv "$AF3_output_path"/"$NAME"/"$NAME"_data.json "$AF3_output_path" && rm -rf "$AF3_output_path"/"$NAME"
+write_ledger_record() {  # <done|failed>: record of the current monomer (the streaming controller retries failed jobs)
+    local dp_state=$1
+    ( flock 9; jq -cn --argjson id "$DATA_PIPELINE_ID" --arg name "$NAME" --arg state "$dp_state" \
+        --argjson c "$SLURM_ARRAY_JOB_ID" --argjson d "$SLURM_ARRAY_TASK_ID" \
+        '{"stage": "datapipeline", "id": $id, "name": $name, "state": $state,
+          "reason": (if $state == "failed" then "error" else null end), "array_job": $c, "array_task": $d}' >&9 ) 9>>"$LEDGER"
+}
+
+for i in "${!DATA_PIPELINE_IDS[@]}"; do
+    DATA_PIPELINE_ID=${DATA_PIPELINE_IDS[$i]}
+    NAME=${NAMES[$i]}
+
+    # No statistics row (its search time would be learned by datapipeline_sizing.py) and nothing to publish;
+    # the input is kept for a retry
+    if [[ ! -f "$AF3_output_path"/"$NAME"/"$NAME"_data.json ]]; then
+        echo "Error: the data pipeline wrote no ${NAME}_data.json." >&2
+        rm -rf "$AF3_output_path"/"$NAME"
+        write_ledger_record failed
+        continue
+    fi
+
+    # move file one up and delete old directory (it is always only one file per directory -> messy)
+    mv "$AF3_output_path"/"$NAME"/"$NAME"_data.json "$AF3_output_path" && rm -rf "$AF3_output_path"/"$NAME"
+
+    echo "Extracting MSA and templates"
+    extract_start=$SECONDS
+    python3 $WORKDIR/utilities/extract_msa_and_template_data.py -z "$AF3_output_path"/"$NAME"_data.json
+    extract_seconds=$(( SECONDS - extract_start ))
+
+    if [[ -n "${DATAPIPELINE_STATISTICS_FILE:-}" && -f "$DATAPIPELINE_STATISTICS_FILE" ]]; then
+        # Per-monomer times from this monomer's section of the AlphaFold output (whole call for a single monomer)
+        job_log=$(python3 $WORKDIR/utilities/parse_af3_log.py "$AF3_log" "$NAME" "$start_time")
+        job_start=$(jq -r --arg t "$start_time" '.start_time // $t' <<< "$job_log")
+        job_end=$(jq -r --arg t "$end_time" '.end_time // $t' <<< "$job_log")
+        job_seconds=$search_seconds
+        if (( ${#DATA_PIPELINE_IDS[@]} > 1 )); then
+            job_seconds=$(( $(date -u -d "$job_end" +%s) - $(date -u -d "$job_start" +%s) ))
+        fi
+        startup_seconds=$(jq -r '.startup_seconds // empty | floor' <<< "$job_log")
+        sequence_length=$(jq -r '.sequences[0].protein.sequence | length' "${USER_INPUT_FILES[$i]}")
+        echo "${PIPELINE_RUN_ID},${DATA_PIPELINE_ID},${NAME},${SLURM_ARRAY_JOB_ID},${SLURM_ARRAY_TASK_ID},$(hostname),${sequence_length},${job_start},${job_end},${db_staging_seconds:-0},${job_seconds},${SLURM_CPUS_PER_TASK},${#DATA_PIPELINE_IDS[@]},${input_copy_seconds},${startup_seconds},${extract_seconds}" >> $DATAPIPELINE_STATISTICS_FILE
+    fi
+
+    # Share the result with other runs and users (no-op without monomer_store_path in the cluster config)
+    python3 $WORKDIR/utilities/monomer_store.py publish "$AF3_output_path"/"$NAME"_data.json
+
+    # The input is kept for a retry
+    if [[ -f "$AF3_output_path"/"$NAME"_data.json ]]; then
+        rm -rf "${USER_INPUT_FILES[$i]}"
+        write_ledger_record done
+    else
+        write_ledger_record failed
+    fi
+done
 
-echo "Extracting MSA and templates"
-python3 $WORKDIR/utilities/extract_msa_and_template_data.py -z "$AF3_output_path"/"$NAME"_data.json
\ No newline at end of file
+rm -rf $AF3_input_path
+rm -f $AF3_log
@@ -0,0 +1,79 @@
+#!/bin/bash
+#SBATCH --job-name=AF3_node
+#SBATCH --nodes=1
+#SBATCH --exclusive
+#SBATCH --signal=B:USR1@300                     # Warning 5 minutes before the time limit (failure ledger)
+#SBATCH --output=slurm-output/slurm-%j-%x.out # %j (Job ID) %x (Job Name)
+echo "Job ran on:" $(hostname)
+echo ""
+
+# Whole-node mode (NODE_TYPE): one worker per GPU or MIG instance of the node claims up to JOBS_PER_TASK consecutive
+# INFERENCE_IDs at a time from pending_jobs/<PIPELINE_RUN_ID>/node_queue.json and runs them on its device with
+# af3_inference_only_slurm.sh. Workers of a node share the node-local input cache and JAX compilation cache.
+WORKDIR=$(pwd)
+RUN_DIR=$WORKDIR/pending_jobs/${PIPELINE_RUN_ID}
+NODE_DIR=$WORKDIR/tmp/node_${SLURM_JOB_ID}
+NODE_END=$(( $(date +%s) + NODE_MINUTES * 60 ))
+IFS=',' read -ra seed_array <<< "$SEEDS"
+mkdir -p "$NODE_DIR"
+
+if ! devices=$(python3 $WORKDIR/utilities/node_queue.py devices "$NODE_TYPE"); then
+    echo "Error: could not assign the GPUs of $(hostname) to GPU profiles." >&2
+    exit 1
+fi
+
+worker() {
+    local index=$1 device=$2 device_profile=$3 claim minutes_left profile first last task jobs enable_xla
+    while [[ ! -f "$NODE_DIR/stop" ]]; do
+        # 5 minutes before the end the time limit warning stops the running jobs
+        minutes_left=$(( (NODE_END - $(date +%s)) / 60 - 5 ))
+        if ! claim=$(python3 $WORKDIR/utilities/node_queue.py claim "$RUN_DIR" "$device_profile" \
+                --minutes-left "$minutes_left" --seeds "${#seed_array[@]}"); then
+            break
+        fi
+        read -r profile first last task jobs enable_xla <<< "$claim"
+        echo "Device $index ($device_profile): ${profile} inference jobs ${first}-${last}"
+        CUDA_VISIBLE_DEVICES=$device APPTAINERENV_CUDA_VISIBLE_DEVICES=$device \
+        NODE_WORKER=$index NODE_TASK_ID=$task DEVICE_PROFILE=$device_profile \
+        GPU_PROFILE=$profile ENABLE_XLA=$enable_xla TOTAL_INFERENCE_JOBS=$jobs RANGE_START=0 RANGE_END=$(( jobs - 1 )) \
+        FIRST_INFERENCE_ID=$first LAST_TASK_INFERENCE_ID=$last \
+            bash $WORKDIR/utilities/af3_inference_only_slurm.sh \
+            >> "slurm-output/slurm-${SLURM_JOB_ID}-${SLURM_JOB_NAME}_${index}.out" 2>&1 &
+        echo $! > "$NODE_DIR/worker_${index}.pid"
+        wait $!
+        rm -f "$NODE_DIR/worker_${index}.pid"
+        touch "$NODE_DIR/ran"
+    done
+    echo "Device $index ($device_profile): no more jobs that fit the time left."
+}
+
+# Time limit warning: no new claims, running jobs are stopped and recorded by af3_inference_only_slurm.sh
+trap 'touch "$NODE_DIR/stop"; echo "Time limit reached, stopping the workers."
+      for pid_file in "$NODE_DIR"/worker_*.pid; do [[ -f "$pid_file" ]] && kill -USR1 "$(cat "$pid_file")" 2>/dev/null; done' USR1
+
+index=0
+while read -r device device_profile; do
+    worker "$index" "$device" "$device_profile" &
+    index=$(( index + 1 ))
+done <<< "$devices"
+echo "Started $index workers."
+# wait returns early when the signal arrives
+while [[ -n "$(jobs -pr)" ]]; do
+    wait
+done
+trap - USR1
+
+# Jobs left: continue in a new node job (unless nothing fitted the time limit of this one)
+if [[ -f "$NODE_DIR/ran" ]] && (( $(python3 $WORKDIR/utilities/node_queue.py remaining "$RUN_DIR" --node-type "$NODE_TYPE") > 0 )); then
+    next_job=$(sbatch --parsable \
+                      --partition=${INFERENCE_PARTITION} \
+                      --gres=${NODE_GRES} \
+                      --time=${NODE_MINUTES} \
+                      --export=ALL \
+                      $WORKDIR/utilities/af3_inference_node.sh)
+    echo "Submitted node job $next_job for the remaining jobs."
+fi
+python3 $WORKDIR/utilities/node_queue.py status "$RUN_DIR"
+
+rm -rf $WORKDIR/tmp/af3_cache_${SLURM_JOB_ID}
+rm -rf "$NODE_DIR"
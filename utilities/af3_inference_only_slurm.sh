@@ -4,58 +4,186 @@
 #SBATCH --ntasks=1
 #SBATCH --threads-per-core=1                    # Disable Multithreading
 #SBATCH --hint=nomultithread
+#SBATCH --signal=B:USR1@300                     # Warning 5 minutes before the time limit (failure ledger)
 #SBATCH --output=slurm-output/slurm-%A_%a-%x.out # %j (Job ID) %x (Job Name)
 echo "Job ran on:" $(hostname)
 echo ""
 
-export INFERENCE_ID=$(( SLURM_ARRAY_TASK_ID + START_OFFSET ))
-scontrol update jobid=${SLURM_ARRAY_JOB_ID}_${SLURM_ARRAY_TASK_ID} comment="Task $((INFERENCE_ID + 1)) of ${TOTAL_INFERENCE_JOBS}"
+# Every array task runs JOBS_PER_TASK consecutive inference jobs in one AlphaFold call (START_OFFSET counts tasks).
+# The array covers the INFERENCE_IDs RANGE_START-RANGE_END of the profile (jobs with the same predicted walltime).
+# With SEEDS_PER_TASK, every job is split into SEED_SHARDS consecutive tasks that run a slice of its seeds each.
+JOBS_PER_TASK=${JOBS_PER_TASK:-1}
+RANGE_START=${RANGE_START:-0}
+RANGE_END=${RANGE_END:-$(( TOTAL_INFERENCE_JOBS - 1 ))}
+IFS=',' read -ra seed_array <<< "$SEEDS"
+SEEDS_PER_TASK=${SEEDS_PER_TASK:-0}
+if (( SEEDS_PER_TASK > 0 && SEEDS_PER_TASK < ${#seed_array[@]} )); then
+    SEED_SHARDS=$(( (${#seed_array[@]} + SEEDS_PER_TASK - 1) / SEEDS_PER_TASK ))
+    JOBS_PER_TASK=1
+else
+    SEED_SHARDS=1
+fi
+if [[ -n "${NODE_WORKER:-}" ]]; then
+    # Whole-node mode (utilities/af3_inference_node.sh): the worker of device NODE_WORKER claimed the INFERENCE_IDs
+    # FIRST_INFERENCE_ID-LAST_TASK_INFERENCE_ID as task NODE_TASK_ID of the node job. All node jobs of a run share
+    # the results directories.
+    TASK_JOB_ID=$SLURM_JOB_ID
+    TASK_ID=$NODE_TASK_ID
+    TASK_PIN=${SLURM_JOB_ID}_${NODE_TASK_ID}
+    RESULTS_PREFIX=$PIPELINE_RUN_ID
+    LAST_INFERENCE_ID=$RANGE_END
+else
+    TASK_JOB_ID=$SLURM_ARRAY_JOB_ID
+    TASK_ID=$SLURM_ARRAY_TASK_ID
+    TASK_PIN=$SLURM_JOB_ID
+    RESULTS_PREFIX=$SLURM_ARRAY_JOB_ID
+    TOTAL_INFERENCE_TASKS=$(( (RANGE_END - RANGE_START + JOBS_PER_TASK) / JOBS_PER_TASK * SEED_SHARDS ))
+    TASK_INDEX=$(( SLURM_ARRAY_TASK_ID + START_OFFSET ))
+    SEED_SHARD=$(( TASK_INDEX % SEED_SHARDS ))
+    FIRST_INFERENCE_ID=$(( RANGE_START + TASK_INDEX / SEED_SHARDS * JOBS_PER_TASK ))
+    LAST_TASK_INFERENCE_ID=$(( FIRST_INFERENCE_ID + JOBS_PER_TASK - 1 ))
+    if (( LAST_TASK_INFERENCE_ID > RANGE_END )); then
+        LAST_TASK_INFERENCE_ID=$RANGE_END
+    fi
+    scontrol update jobid=${SLURM_ARRAY_JOB_ID}_${SLURM_ARRAY_TASK_ID} comment="Task $((TASK_INDEX + 1)) of ${TOTAL_INFERENCE_TASKS}"
 
-# Compute start and end of the bucket
-bucket_start=$(( (INFERENCE_ID / RESULTS_PER_DIR) * RESULTS_PER_DIR ))
+    # Last job of this array (for the last bucket)
+    LAST_INFERENCE_ID=$(( RANGE_START + ((SLURM_ARRAY_TASK_MAX + START_OFFSET) / SEED_SHARDS + 1) * JOBS_PER_TASK - 1 ))
+    if (( LAST_INFERENCE_ID > RANGE_END )); then
+        LAST_INFERENCE_ID=$RANGE_END
+    fi
+fi
+
+# Compute start and end of the bucket, counted from RANGE_START
+# (JOBS_PER_TASK divides RESULTS_PER_DIR, so all jobs of a task share it)
+bucket_start=$(( RANGE_START + ((FIRST_INFERENCE_ID - RANGE_START) / RESULTS_PER_DIR) * RESULTS_PER_DIR ))
 bucket_end=$(( bucket_start + RESULTS_PER_DIR - 1 ))
 
 # Handle last bucket
-LAST_INFERENCE_ID=$(( SLURM_ARRAY_TASK_MAX + START_OFFSET ))
 if [ $bucket_end -gt $LAST_INFERENCE_ID ]; then
     bucket_end=$LAST_INFERENCE_ID
 fi
 
 WORKDIR=$(pwd)
-user_input_file=$WORKDIR/pending_jobs/${PIPELINE_RUN_ID}/${GPU_PROFILE}/${INFERENCE_ID}_*.json
-AF3_input_file=$(basename $user_input_file)
-AF3_input_path=$WORKDIR/tmp/input_${SLURM_ARRAY_JOB_ID}/${SLURM_ARRAY_TASK_ID}
-AF3_output_path=$WORKDIR/results/${SLURM_ARRAY_JOB_ID}_${GPU_PROFILE}_${bucket_start}-${bucket_end}
-AF3_cache_path=$WORKDIR/tmp/af3_cache_${SLURM_ARRAY_JOB_ID}/${SLURM_ARRAY_TASK_ID} # Cache directory
-export APPTAINER_TMPDIR=$WORKDIR/tmp/apptainer_${SLURM_ARRAY_JOB_ID}/${SLURM_ARRAY_TASK_ID}
-
-# --- Only the first task handles submitting the next chunk ---
-if [[ "$SLURM_ARRAY_TASK_ID" -eq 0 ]]; then
+AF3_input_path=$WORKDIR/tmp/input_${TASK_JOB_ID}/${TASK_ID}
+AF3_output_path=$WORKDIR/results/${RESULTS_PREFIX}_${GPU_PROFILE}_${bucket_start}-${bucket_end}
+# Seed shards write into their own directory, the last one to finish merges all of them into AF3_output_path
+SHARDS_DIR=$WORKDIR/tmp/seed_shards_${PIPELINE_RUN_ID}/${GPU_PROFILE}_${FIRST_INFERENCE_ID}
+if (( SEED_SHARDS > 1 )); then
+    AF3_run_output_path=$SHARDS_DIR/$SEED_SHARD
+else
+    AF3_run_output_path=$AF3_output_path
+fi
+# JAX compilation cache: persistent and shared per container/GPU/XLA setting if jax_cache_path is configured
+# (in whole-node mode by the GPU the job runs on, which can be larger than the one of its profile)
+JAX_CACHE_SHARED=$(python3 $WORKDIR/utilities/jax_cache.py dir "${DEVICE_PROFILE:-$GPU_PROFILE}")
+if [[ -z "$JAX_CACHE_SHARED" && -n "${NODE_WORKER:-}" ]]; then
+    AF3_cache_path=$WORKDIR/tmp/af3_cache_${SLURM_JOB_ID}/${DEVICE_PROFILE} # shared by the workers, removed by the node job
+elif [[ -z "$JAX_CACHE_SHARED" ]]; then
+    AF3_cache_path=$WORKDIR/tmp/af3_cache_${TASK_JOB_ID}/${TASK_ID} # Cache directory
+elif [[ "$(jq -r '.jax_cache_stage_local // false' "$CLUSTER_CONFIG")" == "true" ]]; then
+    AF3_cache_path=${TMPDIR:-/tmp}/af3_jax_cache/$(basename "$JAX_CACHE_SHARED") # node-local copy, shared by tasks on this node
+else
+    AF3_cache_path=$JAX_CACHE_SHARED
+fi
+# Node-local cache of MSAs and templates shared by all tasks on this node if input_cache_path is configured
+INPUT_CACHE=$(python3 $WORKDIR/utilities/input_cache.py dir)
+AF3_log=$WORKDIR/tmp/af3_log_${TASK_JOB_ID}_${TASK_ID}.log # AlphaFold output with timestamps
+if [[ -n "${NODE_WORKER:-}" ]]; then
+    SLURM_LOG="slurm-output/slurm-${SLURM_JOB_ID}-${SLURM_JOB_NAME}_${NODE_WORKER}.out"
+else
+    SLURM_LOG="slurm-output/slurm-${SLURM_ARRAY_JOB_ID}_${SLURM_ARRAY_TASK_ID}-${SLURM_JOB_NAME}.out"
+fi
+export APPTAINER_TMPDIR=$WORKDIR/tmp/apptainer_${TASK_JOB_ID}/${TASK_ID}
+
+# --- Only the first task handles submitting the next chunk (not with the streaming controller, in whole-node mode or
+# for jobs resubmitted by utilities/resume_run.sh) ---
+if [[ -z "${NODE_WORKER:-}" && "$SLURM_ARRAY_TASK_ID" -eq 0 && "${CONTROLLER_MANAGED:-false}" != "true" && "${RESUMED:-false}" != "true" ]]; then
     next_start=$(( START_OFFSET + SLURM_ARRAY_TASK_COUNT ))
-    if (( next_start < TOTAL_INFERENCE_JOBS )); then
+    if (( next_start < TOTAL_INFERENCE_TASKS )); then
         next_end=$(( next_start + OUR_ARRAY_SIZE - 1 ))
-        if (( next_end >= TOTAL_INFERENCE_JOBS )); then
-            next_end=$(( TOTAL_INFERENCE_JOBS - 1 ))
+        if (( next_end >= TOTAL_INFERENCE_TASKS )); then
+            next_end=$(( TOTAL_INFERENCE_TASKS - 1 ))
         fi
-        # Submit the next chunk
-        sbatch --array=0-$(( next_end - next_start )) \
+        # Submit the next chunk (listed for utilities/resume_batch.sh, which waits for it)
+        next_job=$(sbatch --parsable \
+               --array=0-$(( next_end - next_start )) \
                --partition=${INFERENCE_PARTITION} \
                --gres=${GPU_TYPE}:1 \
                --time=${GPU_TIME} \
                --dependency=afterok:${SLURM_ARRAY_JOB_ID} \
                --export=ALL,START_OFFSET=$next_start \
-               $WORKDIR/utilities/af3_inference_only_slurm.sh
-        echo "Submitted next chunk: $next_start-$next_end (dependent on job ${SLURM_ARRAY_JOB_ID})"
+               $WORKDIR/utilities/af3_inference_only_slurm.sh)
+        echo "$next_job" >> "$WORKDIR/pending_jobs/${PIPELINE_RUN_ID}/inference_jobs"
+        echo "Submitted next chunk: $next_start-$next_end as job $next_job (dependent on job ${SLURM_ARRAY_JOB_ID})"
     fi
 fi
 # --- End of Task-0 block ---
 
+# A job that runs again after one of its seed shards failed only reruns the shards that did not finish
+# (merge_seed_shards.py keeps the shards and the state each one ended with until all of them are done)
+if (( SEED_SHARDS > 1 )); then
+    if [[ "$(cat "$SHARDS_DIR/$SEED_SHARD.end" 2>/dev/null)" == "done" ]]; then
+        echo "Seed shard $((SEED_SHARD + 1)) of ${SEED_SHARDS} of inference ID ${FIRST_INFERENCE_ID} already finished."
+        exit 0
+    fi
+    rm -rf "$AF3_run_output_path"  # output of an earlier attempt of this shard
+fi
+
 mkdir -p "$AF3_input_path"
 mkdir -p "$AF3_output_path"
+mkdir -p "$AF3_run_output_path"
 mkdir -p "$AF3_cache_path"
 mkdir -p "$APPTAINER_TMPDIR"
-python3 utilities/copy_json_and_dependency_files.py $user_input_file "$AF3_input_path"
-rm $user_input_file
+if [[ -n "$JAX_CACHE_SHARED" && "$AF3_cache_path" != "$JAX_CACHE_SHARED" ]]; then
+    python3 $WORKDIR/utilities/jax_cache.py sync "$JAX_CACHE_SHARED" "$AF3_cache_path"
+fi
+cache_entries_before=$(python3 $WORKDIR/utilities/jax_cache.py count "$AF3_cache_path")
+
+# Failure ledger of the run: one record per job and attempt (see utilities/run_ledger.py)
+LEDGER=$WORKDIR/pending_jobs/${PIPELINE_RUN_ID}/ledger.jsonl
+
+# Stage the inputs of all jobs of this task (the pending JSON is only removed once the job succeeded)
+staging_start=$SECONDS
+declare -a INFERENCE_IDS INFERENCE_NAMES COMPOUND_IDS USER_INPUT_FILES JOB_SEEDS MERGE_INTO
+for (( id = FIRST_INFERENCE_ID; id <= LAST_TASK_INFERENCE_ID; id++ )); do
+    if [[ "${VIRTUAL_JOBS:-false}" == "true" ]]; then
+        # Decode the INFERENCE_ID from the job plan and build the AF3 JSON on the fly
+        user_input_file=$(python3 $WORKDIR/utilities/job_plan.py materialize "$WORKDIR/pending_jobs/${PIPELINE_RUN_ID}" "$GPU_PROFILE" "$id")
+    else
+        user_input_file=$(echo $WORKDIR/pending_jobs/${PIPELINE_RUN_ID}/${GPU_PROFILE}/${id}_*.json)
+    fi
+    if [[ ! -f "$user_input_file" ]]; then
+        echo "ERROR: No input for inference ID ${id}." >&2
+        ( flock 9; jq -cn --arg profile "$GPU_PROFILE" --argjson id "$id" \
+            '{"stage": "inference", "profile": $profile, "id": $id, "state": "failed", "reason": "no_input"}' >&9 ) 9>>"$LEDGER"
+        continue
+    fi
+    AF3_input_file=$(basename $user_input_file)
+    if [[ -z "$INPUT_CACHE" ]] || ! python3 utilities/input_cache.py stage "$user_input_file" "$AF3_input_path" --pin "$TASK_PIN"; then
+        python3 utilities/copy_json_and_dependency_files.py $user_input_file "$AF3_input_path"
+    fi
+    if (( SEED_SHARDS > 1 )); then
+        jq --argjson k "$SEED_SHARD" --argjson n "$SEEDS_PER_TASK" '.modelSeeds |= .[$k * $n:($k + 1) * $n]' \
+            "$AF3_input_path/$AF3_input_file" > "$AF3_input_path/$AF3_input_file.tmp" \
+            && mv "$AF3_input_path/$AF3_input_file.tmp" "$AF3_input_path/$AF3_input_file"
+    fi
+
+    # Extract the protein name, compound id and seeds from the JSON
+    INFERENCE_IDS+=("$id")
+    USER_INPUT_FILES+=("$user_input_file")
+    INFERENCE_NAMES+=("$(jq -r '.name' "$AF3_input_path/$AF3_input_file")")
+    COMPOUND_IDS+=("$(jq -r '.sequences[-1].ligand?.description' "$AF3_input_path/$AF3_input_file")")
+    JOB_SEEDS+=("$(jq -c '.modelSeeds' "$AF3_input_path/$AF3_input_file")")
+    # Retries (streaming controller or utilities/resume_run.sh): result directory of the failed job that the seeds
+    # are added to
+    if [[ "${CONTROLLER_MANAGED:-false}" == "true" || "${RESUMED:-false}" == "true" ]]; then
+        MERGE_INTO+=("$(python3 $WORKDIR/utilities/run_ledger.py get "$WORKDIR/pending_jobs/${PIPELINE_RUN_ID}" inference "$GPU_PROFILE" "$id" merge_into)")
+    else
+        MERGE_INTO+=("")
+    fi
+done
+staging_seconds=$(( SECONDS - staging_start ))
 
 if [[ "$ENABLE_XLA" == "true" ]]; then
     echo "XLA activated"
@@ -65,74 +193,214 @@ if [[ "$ENABLE_XLA" == "true" ]]; then
 else
     echo "XLA not activated"
 fi
-export APPTAINER_BINDPATH="/${AF3_input_path}:/root/af_input,${AF3_output_path}:/root/af_output,${AF3_MODEL_PATH}:/root/models,${AF3_DB_PATH}:/root/public_databases,${AF3_cache_path}:/root/jax_cache_dir"
+export APPTAINER_BINDPATH="/${AF3_input_path}:/root/af_input,${AF3_run_output_path}:/root/af_output,${AF3_MODEL_PATH}:/root/models,${AF3_DB_PATH}:/root/public_databases,${AF3_cache_path}:/root/jax_cache_dir"
+if [[ -n "$INPUT_CACHE" ]]; then
+    export APPTAINER_BINDPATH="${APPTAINER_BINDPATH},${INPUT_CACHE}:/root/af_input_cache"
+fi
+
+if (( ${#INFERENCE_IDS[@]} == 0 )); then
+    echo "ERROR: No input could be prepared for inference IDs ${FIRST_INFERENCE_ID}-${LAST_TASK_INFERENCE_ID}." >&2
+    exit 1
+elif (( ${#INFERENCE_IDS[@]} == 1 )); then
+    af3_input_arg="--json_path=/root/af_input/${AF3_input_file}"
+else
+    af3_input_arg="--input_dir=/root/af_input"
+fi
 
-# Extract the protein name  and compound id from the JSON
-export INFERENCE_NAME=$(jq -r '.name' "$AF3_input_path"/"$AF3_input_file")
-export COMPOUND_ID=$(jq -r '.sequences[-1].ligand?.description' "$AF3_input_path/$AF3_input_file")
-export INFERENCE_DIR=${AF3_output_path}/${INFERENCE_NAME}
+# Custom buckets must match the ones the jobs were assigned to profiles with
+AF3_BUCKETS=$(jq -r '.af3_buckets // empty | join(",")' "$CLUSTER_CONFIG")
 
-echo "Running AlphaFold job for ${INFERENCE_NAME} (index ${SLURM_ARRAY_TASK_ID}, total-index: ${INFERENCE_ID})"
+echo "Running AlphaFold for ${#INFERENCE_IDS[@]} job(s): ${INFERENCE_NAMES[*]} (index ${TASK_ID}, total-index: ${FIRST_INFERENCE_ID}-${LAST_TASK_INFERENCE_ID}, seeds ${JOB_SEEDS[*]})"
 
 start_time=$(date -u +"%Y-%m-%dT%H:%M:%SZ")
 
-af_output=$(apptainer exec --writable-tmpfs --nv ${AF3_CONTAINER_PATH} python /app/alphafold/run_alphafold.py \
+# AlphaFold runs in the background, so that the time limit warning (USR1) can stop it and the jobs are recorded
+timed_out=false
+trap 'timed_out=true; echo "Time limit reached, stopping AlphaFold."; kill -TERM %1 2>/dev/null' USR1
+
+apptainer exec --writable-tmpfs --nv ${AF3_CONTAINER_PATH} python /app/alphafold/run_alphafold.py \
     --run_data_pipeline=false \
-    --json_path=/root/af_input/${AF3_input_file} \
+    $af3_input_arg \
     --model_dir=/root/models \
     --output_dir=/root/af_output \
     --jax_compilation_cache_dir=/root/jax_cache_dir \
-2>&1 | tee -a "slurm-output/slurm-${SLURM_ARRAY_JOB_ID}_${SLURM_ARRAY_TASK_ID}-${SLURM_JOB_NAME}.out")
+    ${AF3_BUCKETS:+--buckets=$AF3_BUCKETS} \
+2>&1 | tee -a "$SLURM_LOG" \
+     | awk '{ print strftime("%Y-%m-%dT%H:%M:%SZ", systime(), 1) "\t" $0; fflush() }' > "$AF3_log" &
+wait
+if [[ "$timed_out" == "true" ]]; then
+    wait  # the first wait returns when the signal arrives
+fi
+trap - USR1
 
 unset APPTAINER_BINDPATH
+end_time=$(date -u +"%Y-%m-%dT%H:%M:%SZ")
 
-if [[ -n "${INFERENCE_STATISTICS_FILE:-}" && -f "$INFERENCE_STATISTICS_FILE" ]]; then
-    end_time=$(date -u +"%Y-%m-%dT%H:%M:%SZ")
-    read bucket_size tokens < <(echo "$af_output" | awk '/Got bucket size/ {
-        match($0, /Got bucket size ([0-9]+) for input with ([0-9]+)/, a);
-        print a[1], a[2];
-        exit
-    }')
-
-    confidences=$(python3 $WORKDIR/utilities/collect_af3_confidences.py "${INFERENCE_DIR}" "${INFERENCE_NAME}")
-
-    jq -cn  --arg runid "$PIPELINE_RUN_ID" \
-            --arg profile "$GPU_PROFILE" \
-            --argjson a "$INFERENCE_ID" \
-            --arg b "$INFERENCE_NAME" \
-            --arg compoundid "$COMPOUND_ID" \
-            --argjson c "$SLURM_ARRAY_JOB_ID" \
-            --argjson d "$SLURM_ARRAY_TASK_ID" \
-            --arg e "$(hostname)" \
-            --argjson f "$tokens" \
-            --argjson g "$bucket_size" \
-            --arg h "$start_time" \
-            --arg i "$end_time" \
-            --argjson confidences "$confidences" \
-            '{
-                "pipeline_run_id": $runid,
-                "gpu_profile": $profile,
-                "inference_id": $a,
-                "name": $b,
-                "compound_id": (if $compoundid == "null" then null else $compoundid end),
-                "array_job": $c,
-                "array_task": $d,
-                "hostname": $e,
-                "tokens": $f,
-                "bucket_size": $g,
-                "start_time": $h,
-                "end_time": $i,
-                "af3_confidences": $confidences
-            }' >> "$INFERENCE_STATISTICS_FILE"
-fi
-
-rm -rf $AF3_cache_path
-rm -rf $APPTAINER_TMPDIR
-rm -rf $AF3_input_path
+# Nothing new was compiled if the cache did not grow
+cache_entries_after=$(python3 $WORKDIR/utilities/jax_cache.py count "$AF3_cache_path")
+if (( cache_entries_before > 0 && cache_entries_after == cache_entries_before )); then
+    cache_hit=true
+else
+    cache_hit=false
+fi
+
+# "done" if AlphaFold wrote the results of a job, otherwise the reason it failed
+job_outcome() {  # <inference dir> <name> <parse_af3_log.py output>
+    if [[ -f "$1/$2_model.cif" ]]; then
+        echo done
+    elif [[ "$(jq -r '.oom' <<< "$3")" == "true" ]]; then
+        echo oom
+    elif [[ "$timed_out" == "true" ]]; then
+        echo timeout
+    else
+        echo error
+    fi
+}
+
+for i in "${!INFERENCE_IDS[@]}"; do
+    export INFERENCE_ID=${INFERENCE_IDS[$i]}
+    export INFERENCE_NAME=${INFERENCE_NAMES[$i]}
+    export COMPOUND_ID=${COMPOUND_IDS[$i]}
+    export INFERENCE_DIR=${AF3_run_output_path}/${INFERENCE_NAME}
+    num_seeds=$(jq 'length' <<< "${JOB_SEEDS[$i]}")
+
+    # Per-job times, bucket size, tokens, seeds and out-of-memory errors from this job's section of the AlphaFold output
+    job_log=$(python3 $WORKDIR/utilities/parse_af3_log.py "$AF3_log" "$INFERENCE_NAME" "$start_time")
+    outcome=$(job_outcome "$INFERENCE_DIR" "$INFERENCE_NAME" "$job_log")
+
+    # Walltime prediction and the statistics queries only learn from records with outcome "done"
+    if [[ -n "${INFERENCE_STATISTICS_FILE:-}" && -f "$INFERENCE_STATISTICS_FILE" ]]; then
+        confidences_start=$SECONDS
+        confidences=$(python3 $WORKDIR/utilities/collect_af3_confidences.py "${INFERENCE_DIR}" "${INFERENCE_NAME}")
+        confidences_seconds=$(( SECONDS - confidences_start ))
+
+        jq -cn  --arg runid "$PIPELINE_RUN_ID" \
+                --arg profile "$GPU_PROFILE" \
+                --argjson a "$INFERENCE_ID" \
+                --arg b "$INFERENCE_NAME" \
+                --arg compoundid "$COMPOUND_ID" \
+                --argjson c "$TASK_JOB_ID" \
+                --argjson d "$TASK_ID" \
+                --arg e "$(hostname)" \
+                --argjson log "$job_log" \
+                --argjson packed "${#INFERENCE_IDS[@]}" \
+                --argjson seeds "$num_seeds" \
+                --arg outcome "$outcome" \
+                --argjson shard "$( (( SEED_SHARDS > 1 )) && echo "$SEED_SHARD" || echo null )" \
+                --argjson cachehit "$cache_hit" \
+                --argjson staging "$staging_seconds" \
+                --argjson collecting "$confidences_seconds" \
+                --arg h "$start_time" \
+                --arg i "$end_time" \
+                --argjson confidences "$confidences" \
+                '{
+                    "pipeline_run_id": $runid,
+                    "gpu_profile": $profile,
+                    "inference_id": $a,
+                    "name": $b,
+                    "compound_id": (if $compoundid == "null" then null else $compoundid end),
+                    "array_job": $c,
+                    "array_task": $d,
+                    "hostname": $e,
+                    "tokens": $log.tokens,
+                    "bucket_size": $log.bucket_size,
+                    "start_time": (if $packed > 1 then ($log.start_time // $h) else $h end),
+                    "end_time": (if $packed > 1 then ($log.end_time // $i) else $i end),
+                    "jobs_in_task": $packed,
+                    "num_seeds": $seeds,
+                    "seeds_inferred": ($log.seeds_inferred | length),
+                    "outcome": $outcome,
+                    "seed_shard": $shard,
+                    "jax_cache_hit": $cachehit,
+                    "compile_seconds": $log.compile_seconds,
+                    "staging_seconds": $staging,
+                    "startup_seconds": $log.startup_seconds,
+                    "featurisation_seconds": $log.featurisation_seconds,
+                    "model_seconds": $log.model_seconds,
+                    "extraction_seconds": $log.extraction_seconds,
+                    "output_seconds": $log.output_seconds,
+                    "confidences_seconds": $collecting,
+                    "af3_confidences": $confidences
+                }' >> "$INFERENCE_STATISTICS_FILE"
+    fi
+
+    seeds_dir=$INFERENCE_DIR
+
+    # Seed shards: the last one to end merges all of them, or records the job as failed if a shard failed (the
+    # shards are kept until the job runs again); the others end here without a ledger record
+    if (( SEED_SHARDS > 1 )); then
+        merge_state=$(python3 $WORKDIR/utilities/merge_seed_shards.py shards "$SHARDS_DIR" "$INFERENCE_NAME" "$SEED_SHARDS" \
+                      "$AF3_output_path" "$SEED_SHARD" "$outcome")
+        if [[ "$merge_state" == "waiting" ]]; then
+            echo "Seed shard $((SEED_SHARD + 1)) of ${SEED_SHARDS} of ${INFERENCE_NAME} ended (${outcome}), other shards pending."
+            continue
+        fi
+        JOB_SEEDS[$i]=$(jq -c '.modelSeeds' "${USER_INPUT_FILES[$i]}")
+        if [[ "$merge_state" == "merged" ]]; then
+            export INFERENCE_DIR=${AF3_output_path}/${INFERENCE_NAME}
+            echo "Merged ${SEED_SHARDS} seed shards of ${INFERENCE_NAME} into ${INFERENCE_DIR}."
+        else
+            outcome=${merge_state:-error}
+            export INFERENCE_DIR=${AF3_output_path}/${INFERENCE_NAME}
+            seeds_dir=$SHARDS_DIR
+            echo "Seed shards of ${INFERENCE_NAME} failed (${outcome}), finished shards are kept in ${SHARDS_DIR}."
+        fi
+    fi
+
+    # Ledger record (the streaming controller retries failed jobs); seeds with results on disk are kept
+    if [[ "$outcome" == "done" ]]; then
+        job_state=done; reason=""
+        rm -f "${USER_INPUT_FILES[$i]}"
+    else
+        job_state=failed; reason=$outcome
+    fi
+    if [[ -n "${MERGE_INTO[$i]}" && "$job_state" == "done" ]] \
+        && python3 $WORKDIR/utilities/merge_seed_shards.py retry "$INFERENCE_DIR" "$INFERENCE_NAME" "${MERGE_INTO[$i]}"; then
+        export INFERENCE_DIR=${MERGE_INTO[$i]}/${INFERENCE_NAME}
+        echo "Added the results of retry ${INFERENCE_ID} of ${INFERENCE_NAME} to ${INFERENCE_DIR}."
+    fi
+    # (of all shards if the job is recorded with its shards: <shard>/<name>/seed-*)
+    seeds_done=$(find "$seeds_dir" -maxdepth 3 -type d -name 'seed-*_sample-0' 2>/dev/null \
+                 | sed -E 's/.*seed-(-?[0-9]+)_sample-0$/\1/' | jq -cs '.')
+    ( flock 9; jq -cn --arg profile "$GPU_PROFILE" --argjson id "$INFERENCE_ID" --arg name "$INFERENCE_NAME" \
+        --arg state "$job_state" --arg reason "$reason" --argjson seeds "${JOB_SEEDS[$i]}" --argjson done "$seeds_done" \
+        --argjson log "$job_log" --argjson c "$TASK_JOB_ID" --argjson d "$TASK_ID" --arg dir "$INFERENCE_DIR" \
+        --arg merge "${MERGE_INTO[$i]}" \
+        '{"stage": "inference", "profile": $profile, "id": $id, "name": $name, "state": $state,
+          "reason": (if $reason == "" then null else $reason end), "seeds": $seeds, "seeds_done": $done,
+          "seeds_inferred": $log.seeds_inferred, "array_job": $c, "array_task": $d, "result_dir": $dir,
+          "merge_into": (if $merge == "" then null else $merge end)}' >&9 ) 9>>"$LEDGER"
 
-# --- Postprocessing ---
-if [[ -n "${POSTPROCESSING_SCRIPT:-}" && -f "$POSTPROCESSING_SCRIPT" ]]; then
-    sbatch --output="slurm-output/slurm-${SLURM_ARRAY_JOB_ID}_${SLURM_ARRAY_TASK_ID}-${SLURM_JOB_NAME}.out" \
-           --open-mode=append \
-           ${POSTPROCESSING_SCRIPT}
+    # Results index: job name, proteins and compound -> result directory (see utilities/results_index.py)
+    python3 $WORKDIR/utilities/results_index.py --results-dir "$WORKDIR/results" register "$INFERENCE_DIR" \
+        "$AF3_input_path/$(basename "${USER_INPUT_FILES[$i]}")" --state "$job_state" \
+        --run "$PIPELINE_RUN_ID" --profile "$GPU_PROFILE" --id "$INFERENCE_ID"
+
+    # --- Postprocessing (one job per inference job, or queued for the postprocessing workers) ---
+    if [[ -n "${POSTPROCESSING_SCRIPT:-}" && -f "$POSTPROCESSING_SCRIPT" ]]; then
+        if (( ${POSTPROCESSING_WORKERS:-0} > 0 )); then
+            python3 $WORKDIR/utilities/postprocessing_queue.py enqueue "$WORKDIR/pending_jobs/${PIPELINE_RUN_ID}/postprocessing" \
+                --workers "$POSTPROCESSING_WORKERS"
+        else
+            sbatch --output="$SLURM_LOG" \
+                   --open-mode=append \
+                   ${POSTPROCESSING_SCRIPT}
+        fi
+    fi
+done
+
+if [[ -z "$JAX_CACHE_SHARED" ]]; then
+    [[ -n "${NODE_WORKER:-}" ]] || rm -rf $AF3_cache_path
+else
+    if [[ "$AF3_cache_path" != "$JAX_CACHE_SHARED" ]]; then
+        python3 $WORKDIR/utilities/jax_cache.py sync "$AF3_cache_path" "$JAX_CACHE_SHARED"
+        python3 $WORKDIR/utilities/jax_cache.py prune "$AF3_cache_path"
+    fi
+    python3 $WORKDIR/utilities/jax_cache.py prune "$JAX_CACHE_SHARED"
 fi
+if [[ -n "$INPUT_CACHE" ]]; then
+    python3 $WORKDIR/utilities/input_cache.py release --pin "$TASK_PIN"
+fi
+rm -rf $APPTAINER_TMPDIR
+rm -rf $AF3_input_path
+rm -f $AF3_log
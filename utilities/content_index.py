@@ -0,0 +1,138 @@
+import os
+import sys
+import gzip
+import json
+import uuid
+import hashlib
+import argparse
+from monomer_manifest import stat_entry
+
+INDEX_DIR = ".index"  # <dir>/.index/<sha256 of the text><extension> -> {"name": file name, "file": [size, mtime_ns]}
+CHUNK_SIZE = 1 << 20
+
+
+def file_ext(name):
+    """Extension including .gz (e.g. .cif.gz), so plain and gzipped copies are indexed separately."""
+    root, ext = os.path.splitext(name)
+    return os.path.splitext(root)[1] + ext if ext == ".gz" else ext
+
+def text_chunks(path):
+    """Text of a (gzipped) MSA or template file, read the way the extractor wrote it."""
+    opener = gzip.open(path, "rt", newline="") if path.endswith(".gz") else open(path, "r", newline="")
+    with opener as f:
+        while True:
+            chunk = f.read(CHUNK_SIZE)
+            if not chunk:
+                return
+            yield chunk
+
+def content_hash(chunks):
+    h = hashlib.sha256()
+    for chunk in chunks:
+        h.update(chunk.encode("utf-8", "surrogatepass"))
+    return h.hexdigest()
+
+def entry_path(directory, digest, ext):
+    return os.path.join(directory, INDEX_DIR, digest + ext)
+
+def lookup(directory, digest, ext):
+    """Name of the indexed file with this text, or None if there is none or it was changed or removed since."""
+    try:
+        with open(entry_path(directory, digest, ext), "r") as f:
+            entry = json.load(f)
+        if stat_entry(os.path.join(directory, entry["name"])) == entry["file"]:
+            return entry["name"]
+    except (OSError, KeyError, TypeError, ValueError):
+        pass
+    return None
+
+def add(directory, digest, name):
+    """
+    Index a file of directory by its text. Returns the indexed name: name, or the file with the same text that
+    another task indexed first. Entries are created with link(), which never replaces an existing entry.
+    """
+    path = entry_path(directory, digest, file_ext(name))
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump({"name": name, "file": stat_entry(os.path.join(directory, name))}, f)
+    try:
+        os.link(tmp_path, path)
+    except FileExistsError:
+        existing = lookup(directory, digest, file_ext(name))
+        if existing is not None:
+            return existing
+        # the indexed file is gone or was rewritten
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return name
+
+def claim(directory, tmp_path, base, ext, named=None):
+    """
+    Give a finished file the first free name of base, base_1, base_2, ... without replacing a file; returns the name.
+    named(tmp_path, name) adapts the file to a name before it is taken (e.g. the file name in a gzip header).
+    """
+    idx = 0
+    while True:
+        name = f"{base}_{idx}{ext}" if idx else f"{base}{ext}"
+        if os.path.exists(os.path.join(directory, name)):
+            idx += 1
+            continue
+        if named:
+            named(tmp_path, name)
+        try:
+            os.link(tmp_path, os.path.join(directory, name))
+        except FileExistsError:
+            idx += 1
+            continue
+        os.remove(tmp_path)
+        return name
+
+def store(directory, tmp_path, digest, base, ext, named=None):
+    """
+    Add a finished file (tmp_path) with the given text hash under a free name (see claim) and index it. Returns the
+    indexed name; if a concurrent task indexed the same text first, the new file is removed again and that task's
+    file is returned.
+    """
+    name = claim(directory, tmp_path, base, ext, named)
+    indexed = add(directory, digest, name)
+    if indexed != name:
+        os.remove(os.path.join(directory, name))
+    return indexed
+
+def migrate(directory):
+    """Index the existing files of a directory. Returns (files indexed, files whose text was already indexed)."""
+    indexed, duplicates = 0, 0
+    for entry in sorted(os.scandir(directory), key=lambda e: e.name):
+        if entry.name.startswith(".") or not entry.is_file():
+            continue
+        try:
+            digest = content_hash(text_chunks(entry.path))
+        except (OSError, EOFError, UnicodeDecodeError) as e:
+            print(f"Warning: could not index {entry.path}: {e}", file=sys.stderr)
+            continue
+        if add(directory, digest, entry.name) == entry.name:
+            indexed += 1
+        else:
+            duplicates += 1
+    return indexed, duplicates
+
+def main():
+    parser = argparse.ArgumentParser(description="Content-hash index of the MSA and template files in monomer_data/.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    p_migrate = subparsers.add_parser("migrate", help="Index existing MSA and template files (e.g. written before the index existed)")
+    p_migrate.add_argument("directories", nargs="*", default=["monomer_data/templates", "monomer_data/msas"])
+    args = parser.parse_args()
+
+    if args.command == "migrate":
+        for directory in args.directories:
+            if not os.path.isdir(directory):
+                print(f"Warning: {directory} does not exist", file=sys.stderr)
+                continue
+            indexed, duplicates = migrate(directory)
+            print(f"{directory}: {indexed} files indexed, {duplicates} duplicates of indexed files")
+
+if __name__ == "__main__":
+    main()
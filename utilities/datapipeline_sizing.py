@@ -0,0 +1,192 @@
+import os
+import sys
+import csv
+import json
+import math
+import argparse
+from datetime import datetime
+from walltime_predictor import quantile, TIME_FORMAT, DEFAULT_QUANTILE, DEFAULT_MARGIN, DEFAULT_MIN_SAMPLES, SAFETY_MINUTES
+
+ARRAYS_FILE = "datapipeline_arrays.json"  # pending_jobs/<PIPELINE_RUN_ID>/datapipeline_arrays.json
+# Resources of the data pipeline tasks before resource classes (#SBATCH header of af3_datapipeline_only_slurm.sh)
+DEFAULT_CLASS = {"max_length": None, "cpus": 8, "mem_gb": 64, "max_minutes": 360}
+DEFAULT_STAGE_MINUTES = 30  # database staging allowance per task without db_stage_minutes or staging history
+
+
+def load_classes(cluster_conf):
+    """Resource classes by sequence length (ascending max_length, the last one without limit)."""
+    classes = [dict(DEFAULT_CLASS, **c) for c in cluster_conf.get("datapipeline_classes") or []]
+    classes.sort(key=lambda c: (c["max_length"] is None, c["max_length"] or 0))
+    if not classes or classes[-1]["max_length"] is not None:
+        classes.append(dict(DEFAULT_CLASS))
+    return classes
+
+def class_index(length, classes):
+    return next(i for i, c in enumerate(classes) if c["max_length"] is None or length <= c["max_length"])
+
+def record_minutes(row):
+    """Search time of one monomer: search_seconds if recorded, else the time between start and end."""
+    if row.get("search_seconds"):
+        return float(row["search_seconds"]) / 60
+    try:
+        start = datetime.strptime(row["start_time"], TIME_FORMAT)
+        end = datetime.strptime(row["end_time"], TIME_FORMAT)
+    except (KeyError, TypeError, ValueError):
+        return None
+    return (end - start).total_seconds() / 60
+
+def load_history(stats_file):
+    """(sequence length, minutes) of the monomers in the data pipeline statistics CSV."""
+    history = []
+    if not stats_file or not os.path.exists(stats_file):
+        return history
+    with open(stats_file, "r", newline="") as f:
+        for row in csv.DictReader(f):
+            try:
+                length = int(row["sequence_length"])
+            except (KeyError, TypeError, ValueError):
+                continue
+            minutes = record_minutes(row)
+            if minutes is not None and minutes > 0:
+                history.append((length, minutes))
+    return history
+
+def load_staging_history(stats_file):
+    """Minutes of the tasks in the data pipeline statistics CSV that staged the databases (db_staging_seconds > 0)."""
+    history = []
+    if not stats_file or not os.path.exists(stats_file):
+        return history
+    with open(stats_file, "r", newline="") as f:
+        for row in csv.DictReader(f):
+            try:
+                seconds = float(row.get("db_staging_seconds") or 0)
+            except ValueError:
+                continue
+            if seconds > 0:
+                history.append(seconds / 60)
+    return history
+
+def stage_minutes(stats_file, cluster_conf):
+    """
+    Minutes added to every data pipeline task for staging the databases (db_stage.py), as any task can be the first
+    on a cold node: db_stage_minutes if configured, else the quantile of the recorded staging times, 0 without
+    db_stage_path.
+    """
+    if not cluster_conf.get("db_stage_path"):
+        return 0
+    if cluster_conf.get("db_stage_minutes") is not None:
+        return int(cluster_conf["db_stage_minutes"])
+    history = load_staging_history(stats_file)
+    if len(history) < int(cluster_conf.get("walltime_min_samples", DEFAULT_MIN_SAMPLES)):
+        return DEFAULT_STAGE_MINUTES
+    q = float(cluster_conf.get("walltime_quantile", DEFAULT_QUANTILE))
+    return math.ceil(quantile(history, q) * (1 + float(cluster_conf.get("walltime_margin", DEFAULT_MARGIN))))
+
+class SearchTimeModel:
+    """Quantile of the minutes per monomer for every resource class."""
+
+    def __init__(self, history, classes, q=DEFAULT_QUANTILE, margin=DEFAULT_MARGIN, min_samples=DEFAULT_MIN_SAMPLES):
+        samples = {}
+        for length, minutes in history:
+            samples.setdefault(class_index(length, classes), []).append(minutes)
+        self.minutes = {i: math.ceil(quantile(values, q) * (1 + margin)) + SAFETY_MINUTES
+                        for i, values in samples.items() if len(values) >= min_samples}
+        self.classes = classes
+
+    def predict(self, i):
+        """Minutes per monomer of a class; its max_minutes without history."""
+        limit = self.classes[i]["max_minutes"]
+        return min(self.minutes[i], limit) if i in self.minutes else limit
+
+def load_model(stats_file, cluster_conf, classes):
+    return SearchTimeModel(load_history(stats_file), classes,
+                           float(cluster_conf.get("walltime_quantile", DEFAULT_QUANTILE)),
+                           float(cluster_conf.get("walltime_margin", DEFAULT_MARGIN)),
+                           int(cluster_conf.get("walltime_min_samples", DEFAULT_MIN_SAMPLES)))
+
+def input_lengths(inputs_dir):
+    """Sequence length per DATA_PIPELINE_ID of the data pipeline inputs (<id>_<name>.json)."""
+    lengths = {}
+    for entry in os.scandir(inputs_dir):
+        prefix, _, _ = entry.name.partition("_")
+        if entry.name.endswith(".json") and prefix.isdigit():
+            with open(entry.path, "r") as f:
+                lengths[int(prefix)] = len(json.load(f)["sequences"][0]["protein"]["sequence"])
+    return [lengths[i] for i in range(len(lengths))]
+
+def plan_arrays(lengths, classes, model, max_per_task, partition_max_minutes, max_array_size, staging=0):
+    """
+    Arrays of data pipeline tasks over the DATA_PIPELINE_IDs (ordered by length, so every class is one ID range):
+    up to max_per_task monomers per task as long as the task fits the partition MaxTime, with the class's CPUs and
+    memory, at most max_array_size tasks per array. Every task gets staging minutes on top of its searches.
+    """
+    arrays = []
+    start = 0
+    while start < len(lengths):
+        i = class_index(lengths[start], classes)
+        end = start
+        while end + 1 < len(lengths) and class_index(lengths[end + 1], classes) == i:
+            end += 1
+        minutes = model.predict(i)
+        pack = max(1, max_per_task)
+        if partition_max_minutes > 0:
+            budget = max(1, partition_max_minutes - staging)
+            minutes = min(minutes, budget)
+            pack = max(1, min(pack, budget // minutes))
+        task_minutes = minutes * pack + staging
+        if partition_max_minutes > 0:
+            task_minutes = min(task_minutes, partition_max_minutes)
+        tasks = math.ceil((end - start + 1) / pack)
+        for chunk in range(0, tasks, max_array_size):
+            first = start + chunk * pack
+            arrays.append({"first": first, "last": min(end, first + max_array_size * pack - 1), "pack": pack,
+                           "cpus": classes[i]["cpus"], "mem_gb": classes[i]["mem_gb"], "minutes": task_minutes,
+                           "class": i})
+        start = end + 1
+    return arrays
+
+def array_of(arrays, job_id):
+    """Array entry containing a DATA_PIPELINE_ID."""
+    return next(a for a in arrays if a["first"] <= job_id <= a["last"])
+
+def load_arrays(run_dir):
+    with open(os.path.join(run_dir, ARRAYS_FILE), "r") as f:
+        return json.load(f)
+
+def main():
+    parser = argparse.ArgumentParser(description="Pack data pipeline jobs into tasks and size their resources.")
+    parser.add_argument("--cluster-config", default=os.environ.get("CLUSTER_CONFIG"), help="Cluster configuration JSON")
+    parser.add_argument("--stats", default=os.environ.get("DATAPIPELINE_STATISTICS_FILE"), help="Data pipeline statistics CSV")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    p_plan = subparsers.add_parser("plan", help=f"Write <run_dir>/{ARRAYS_FILE} for the data pipeline inputs and print one line per array")
+    p_plan.add_argument("inputs_dir", help="data_pipeline_inputs/<PIPELINE_RUN_ID>")
+    p_plan.add_argument("run_dir", help="pending_jobs/<PIPELINE_RUN_ID>")
+    p_plan.add_argument("--max-per-task", type=int, default=1, help="MONOMERS_PER_TASK")
+    p_plan.add_argument("--partition-max-minutes", type=int, default=0, help="MaxTime of the data pipeline partition (0: unlimited)")
+    p_plan.add_argument("--max-array-size", type=int, required=True)
+    args = parser.parse_args()
+
+    with open(args.cluster_config, "r") as f:
+        cluster_conf = json.load(f)
+    if args.command == "plan":
+        classes = load_classes(cluster_conf)
+        model = load_model(args.stats, cluster_conf, classes)
+        try:
+            lengths = input_lengths(args.inputs_dir)
+        except (OSError, KeyError, IndexError, json.JSONDecodeError) as e:
+            print(f"Error: could not read the data pipeline inputs in {args.inputs_dir}: {e}", file=sys.stderr)
+            sys.exit(1)
+        staging = stage_minutes(args.stats, cluster_conf)
+        arrays = plan_arrays(lengths, classes, model, args.max_per_task, args.partition_max_minutes,
+                             args.max_array_size, staging)
+        if staging:
+            print(f"Database staging: {staging} min added to every task")
+        os.makedirs(args.run_dir, exist_ok=True)
+        with open(os.path.join(args.run_dir, ARRAYS_FILE), "w") as f:
+            json.dump(arrays, f, indent=2)
+        for a in arrays:
+            print(f"Data pipeline jobs {a['first']}-{a['last']}: {a['pack']} per task, {a['cpus']} CPUs, "
+                  f"{a['mem_gb']} GB, {a['minutes']} min per task")
+
+if __name__ == "__main__":
+    main()
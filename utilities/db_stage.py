@@ -0,0 +1,158 @@
+import os
+import sys
+import json
+import time
+import fcntl
+import shutil
+import argparse
+import subprocess
+from monomer_store import db_version, touch, EVICTION_GRACE_SECONDS
+
+COMPLETE_FILE = "complete"    # written after all databases of a version are staged
+LAST_USED_FILE = "last_used"
+FREE_SPACE_MARGIN = 1.1       # required free space relative to the databases to stage
+DEFAULT_ZST_RATIO = 5.0       # assumed decompressed/compressed size of .zst files that do not record their size
+ZSTD_MAGIC = 0xFD2FB528
+
+
+def load_stage_config(cluster_config_path):
+    """
+    Returns (node-local staging directory or None, database directory, database file names or None for all,
+    decompression ratio assumed for .zst files without recorded size).
+    """
+    with open(cluster_config_path, "r") as f:
+        conf = json.load(f)
+    path = conf.get("db_stage_path")
+    ratio = float(conf.get("db_stage_zst_ratio") or DEFAULT_ZST_RATIO)
+    if not path:
+        return None, conf["af3_db_path"], None, ratio
+    return os.path.expandvars(path), conf["af3_db_path"], conf.get("db_stage_files"), ratio
+
+def database_files(db_path, names=None):
+    """Sequence databases to stage: the given names or all top-level files. Directories (e.g. mmcif_files) stay shared."""
+    if names is None:
+        names = sorted(e.name for e in os.scandir(db_path) if e.is_file())
+    return [os.path.join(db_path, name) for name in names]
+
+def staged_name(src_path):
+    """Name of a database on the node; .zst files are decompressed."""
+    name = os.path.basename(src_path)
+    return name[:-4] if name.endswith(".zst") else name
+
+def zstd_content_size(path):
+    """Decompressed size recorded in the header of the first zstd frame, None if the frame does not record it."""
+    with open(path, "rb") as f:
+        header = f.read(18)
+    if len(header) < 6 or int.from_bytes(header[:4], "little") != ZSTD_MAGIC:
+        return None  # e.g. a skippable frame first (pzstd)
+    descriptor = header[4]
+    size_flag = descriptor >> 6
+    single_segment = descriptor >> 5 & 1
+    offset = 5 + (0 if single_segment else 1) + (0, 1, 2, 4)[descriptor & 3]
+    size_bytes = (1 if single_segment else 0, 2, 4, 8)[size_flag]
+    if size_bytes == 0 or len(header) < offset + size_bytes:
+        return None
+    size = int.from_bytes(header[offset:offset + size_bytes], "little")
+    return size + 256 if size_bytes == 2 else size
+
+def staged_size(src_path, zst_ratio=DEFAULT_ZST_RATIO):
+    """Size of a database on the node; for .zst files the recorded decompressed size, else an estimate by zst_ratio."""
+    size = os.path.getsize(src_path)
+    if not src_path.endswith(".zst"):
+        return size
+    content_size = zstd_content_size(src_path)
+    if content_size is None or content_size < size:
+        return size * zst_ratio  # no recorded size, or only that of the first of several frames
+    return content_size
+
+def copy_database(src_path, target_dir):
+    """Copy or decompress one database; a partial copy is removed if this fails."""
+    tmp_path = os.path.join(target_dir, f".{staged_name(src_path)}.tmp")
+    try:
+        if src_path.endswith(".zst"):
+            subprocess.run(["zstd", "-q", "-d", "-f", src_path, "-o", tmp_path], check=True)
+        else:
+            shutil.copyfile(src_path, tmp_path)
+        os.replace(tmp_path, os.path.join(target_dir, staged_name(src_path)))
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+def remove_stale_versions(stage_path, current):
+    """Delete staged database versions other than the current one that no task used within the grace period."""
+    now = time.time()
+    for entry in os.scandir(stage_path):
+        if not entry.is_dir() or entry.name == current:
+            continue
+        try:
+            last_used = os.stat(os.path.join(entry.path, LAST_USED_FILE)).st_mtime
+        except FileNotFoundError:
+            last_used = entry.stat().st_mtime
+        if now - last_used > EVICTION_GRACE_SECONDS:
+            shutil.rmtree(entry.path, ignore_errors=True)
+
+def stage(stage_path, db_path, names=None, zst_ratio=DEFAULT_ZST_RATIO):
+    """
+    Return (directory with node-local copies of the databases or None, seconds spent staging).
+    The first task on a node copies the databases of the current database version, later tasks reuse the copy.
+    Tasks that find another task staging, or too little free space, use the shared databases instead of waiting.
+    If copying fails, the incomplete version directory is removed.
+    """
+    version = db_version(db_path)
+    target = os.path.join(stage_path, version)
+    if os.path.exists(os.path.join(target, COMPLETE_FILE)):
+        touch(os.path.join(target, LAST_USED_FILE))
+        return target, 0.0
+
+    start = time.monotonic()
+    os.makedirs(stage_path, exist_ok=True)
+    with open(os.path.join(stage_path, f".{version}.lock"), "w") as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return None, 0.0
+        if os.path.exists(os.path.join(target, COMPLETE_FILE)):
+            touch(os.path.join(target, LAST_USED_FILE))
+            return target, time.monotonic() - start
+
+        remove_stale_versions(stage_path, version)
+        files = database_files(db_path, names)
+        os.makedirs(target, exist_ok=True)
+        missing = [f for f in files if not os.path.exists(os.path.join(target, staged_name(f)))]
+        needed = sum(staged_size(f, zst_ratio) for f in missing) * FREE_SPACE_MARGIN
+        if shutil.disk_usage(stage_path).free < needed:
+            print(f"Warning: not enough space in {stage_path} to stage the databases, using {db_path}", file=sys.stderr)
+            return None, time.monotonic() - start
+        try:
+            for src_path in missing:
+                copy_database(src_path, target)
+        except BaseException:
+            shutil.rmtree(target, ignore_errors=True)
+            raise
+        touch(os.path.join(target, LAST_USED_FILE))
+        touch(os.path.join(target, COMPLETE_FILE))
+    return target, time.monotonic() - start
+
+def main():
+    parser = argparse.ArgumentParser(description="Node-local copies of the sequence databases for data pipeline tasks.")
+    parser.add_argument("--cluster-config", default=os.environ.get("CLUSTER_CONFIG"), help="Cluster configuration JSON")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("stage", help="Stage the databases on this node if needed; prints '<seconds> <directory>' (no directory: use the shared databases)")
+    args = parser.parse_args()
+
+    if args.command == "stage":
+        stage_path, db_path, names, zst_ratio = load_stage_config(args.cluster_config)
+        if not stage_path:
+            print("0")
+            return
+        try:
+            target, seconds = stage(stage_path, db_path, names, zst_ratio)
+        except (OSError, subprocess.CalledProcessError) as e:
+            print(f"Warning: could not stage the databases in {stage_path}: {e}", file=sys.stderr)
+            print("0")
+            return
+        print(f"{seconds:.0f} {target or ''}".rstrip())
+
+if __name__ == "__main__":
+    main()
@@ -1,146 +1,355 @@
+import io
 import os
+import re
 import json
 import gzip
+import uuid
+import shutil
+import hashlib
 import argparse
+import content_index
+from job_plan import dumps_compact_lists
+from monomer_manifest import record_monomer
 
-# Argument parsing
-parser = argparse.ArgumentParser(description="Extract MSAs and templates from AlphaFold3 JSON.")
-parser.add_argument("input_file", help="Path to the input JSON file")
-parser.add_argument("-z", "--gzip", action="store_true", help="Gzip the output files")
-args = parser.parse_args()
+CHUNK_SIZE = 1 << 20  # characters read from the input JSON at a time
+NUMBER_END_REGEX = re.compile(r"[\s,\]}]")
+LINE_BREAK_REGEX = re.compile("[\n\r\v\f\x1c\x1d\x1e\x85\u2028\u2029]")  # as str.splitlines
+# Strings written to files while parsing (path of keys and list indices, None matches every index)
+STREAMED_PATHS = {
+    ("sequences", None, "protein", "unpairedMsa"),
+    ("sequences", None, "protein", "pairedMsa"),
+    ("sequences", None, "protein", "templates", None, "mmcif"),
+}
 
-use_gzip = args.gzip
-input_file = args.input_file
 
-# Folders relative to input file location
-input_dir = os.path.dirname(os.path.abspath(input_file))
-msa_folder = os.path.join(input_dir, "msas")
-template_folder = os.path.join(input_dir, "templates")
-os.makedirs(msa_folder, exist_ok=True)
-os.makedirs(template_folder, exist_ok=True)
+class Payload:
+    """A JSON string value that was written to a temporary file instead of being kept in memory."""
 
-# Load JSON
-with open(input_file) as f:
-    data = json.load(f)
+    def __init__(self, path, length, first_line, digest):
+        self.path = path
+        self.length = length
+        self.first_line = first_line  # as content.splitlines()[0]
+        self.digest = digest  # as content_index.content_hash of the written file
 
-# Get the name for MSA files
-name = data.get("name", "protein")
+    def __bool__(self):
+        return self.length > 0
 
-def dumps_compact_lists(obj, indent=2):
-    def _dump(o, level=0):
-        if isinstance(o, dict):
+class StreamingParser:
+    """
+    JSON parser that reads the input in chunks and writes the strings at STREAMED_PATHS straight to temporary files
+    in tmp_dir (as Payload), so peak memory does not depend on the size of MSAs and templates.
+    Everything else is parsed into the same objects as json.load returns.
+    """
+
+    def __init__(self, f, tmp_dir):
+        self.f = f
+        self.tmp_dir = tmp_dir
+        self.buf = ""
+        self.pos = 0
+        self.payloads = []
+
+    def _fill(self):
+        """Read the next chunk; returns False at the end of the file."""
+        chunk = self.f.read(CHUNK_SIZE)
+        if not chunk:
+            return False
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def _peek(self):
+        """Next non-whitespace character (not consumed)."""
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in " \t\r\n":
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._fill():
+                raise ValueError("Unexpected end of JSON")
+
+    def _expect(self, char):
+        if self._peek() != char:
+            raise ValueError(f"Expected '{char}' at character {self.pos} of the current chunk")
+        self.pos += 1
+
+    def _escaped(self, index):
+        """Whether the character at index is preceded by an odd number of backslashes."""
+        start = index
+        while start > self.pos and self.buf[start - 1] == "\\":
+            start -= 1
+        return (index - start) % 2 == 1
+
+    def _safe_end(self):
+        """End of the buffer without an incomplete escape or a high surrogate whose low surrogate may follow."""
+        end = len(self.buf)
+        while True:
+            start = self.buf.rfind("\\", max(self.pos, end - 6), end)
+            if start < 0 or self._escaped(start):
+                return end
+            if self.buf[start + 1:start + 2] == "u":
+                escape = self.buf[start:start + 6]
+                if len(escape) == 6 and not (start + 6 == end and escape[2] in "dD" and escape[3] in "89abAB"):
+                    return end
+            elif start + 1 < end:
+                return end
+            end = start
+
+    def _string_runs(self):
+        """Yield the raw body of the string at the current position in pieces that end on complete escapes."""
+        self._expect('"')
+        while True:
+            end = self.buf.find('"', self.pos)
+            while end >= 0 and self._escaped(end):
+                end = self.buf.find('"', end + 1)
+            if end >= 0:
+                yield self.buf[self.pos:end]
+                self.pos = end + 1
+                return
+            end = self._safe_end()
+            yield self.buf[self.pos:end]
+            self.pos = end
+            if not self._fill():
+                raise ValueError("Unterminated JSON string")
+
+    def _read_string(self):
+        return json.loads('"' + "".join(self._string_runs()) + '"')
+
+    def _stream_string(self):
+        path = os.path.join(self.tmp_dir, f".payload_{uuid.uuid4().hex}")
+        self.payloads.append(path)
+        length = 0
+        head, first_line = "", None
+        digest = hashlib.sha256()
+        with open(path, "w") as out:
+            for run in self._string_runs():
+                text = json.loads('"' + run + '"')
+                out.write(text)
+                length += len(text)
+                digest.update(text.encode("utf-8", "surrogatepass"))
+                if first_line is None:
+                    head += text
+                    if LINE_BREAK_REGEX.search(text):
+                        first_line, head = head.splitlines()[0], ""
+        if first_line is None and head:
+            first_line = head.splitlines()[0]
+        return Payload(path, length, first_line, digest.hexdigest())
+
+    def _literal(self):
+        """Number, true, false or null (json.loads of the token keeps int and float apart like json.load)."""
+        while True:
+            match = NUMBER_END_REGEX.search(self.buf, self.pos)
+            if match:
+                token = self.buf[self.pos:match.start()]
+                self.pos = match.start()
+                return json.loads(token)
+            if not self._fill():
+                token = self.buf[self.pos:]
+                self.pos = len(self.buf)
+                return json.loads(token)
+
+    def value(self, path=()):
+        char = self._peek()
+        if char == "{":
+            self.pos += 1
+            obj = {}
+            if self._peek() == "}":
+                self.pos += 1
+                return obj
+            while True:
+                key = self._read_string()
+                self._expect(":")
+                obj[key] = self.value(path + (key,))
+                char = self._peek()
+                self.pos += 1
+                if char == "}":
+                    return obj
+                if char != ",":
+                    raise ValueError(f"Expected ',' or '}}' in object at {path}")
+        if char == "[":
+            self.pos += 1
             items = []
-            for k, v in o.items():
-                items.append(
-                    " " * ((level+1) * indent) + json.dumps(k) + ": " + _dump(v, level+1)
-                )
-            return "{\n" + ",\n".join(items) + "\n" + " " * (level * indent) + "}"
-        elif isinstance(o, list):
-            # check if list contains any dicts (or nested dicts)
-            if any(isinstance(el, dict) for el in o):
-                # pretty-print with indentation
-                items = []
-                for el in o:
-                    items.append(" " * ((level+1) * indent) + _dump(el, level+1))
-                return "[\n" + ",\n".join(items) + "\n" + " " * (level * indent) + "]"
-            else:
-                # collapse into one line
-                return "[" + ",".join(_dump(el, level) for el in o) + "]"
-        else:
-            return json.dumps(o)
-
-    return _dump(obj, 0)
-
-def dump_compact_lists(obj, filename, indent=2):
-    with open(filename, "w") as f:
-        f.write(dumps_compact_lists(obj, indent))
-
-def file_content_matches(path, new_content):
-    """Check if file exists and has identical content."""
-    if not os.path.exists(path):
-        return False
-    with open(path, "r") as f:
-        existing_content = f.read()
-    return existing_content == new_content
-
-def get_unique_cif_path(base_path, new_content, use_gzip):
+            if self._peek() == "]":
+                self.pos += 1
+                return items
+            while True:
+                items.append(self.value(path + (None,)))
+                char = self._peek()
+                self.pos += 1
+                if char == "]":
+                    return items
+                if char != ",":
+                    raise ValueError(f"Expected ',' or ']' in list at {path}")
+        if char == '"':
+            return self._stream_string() if path in STREAMED_PATHS else self._read_string()
+        return self._literal()
+
+def load_streaming(input_file, tmp_dir):
+    """Parse input_file; returns (data, paths of all payload files)."""
+    with open(input_file, "r") as f:
+        parser = StreamingParser(f, tmp_dir)
+        try:
+            data = parser.value()
+        except BaseException:
+            remove_files(parser.payloads)
+            raise
+    return data, parser.payloads
+
+def remove_files(paths):
+    for path in paths:
+        if os.path.exists(path):
+            os.remove(path)
+
+def payload_chunks(payload):
+    with open(payload.path, "r", newline="") as f:
+        while True:
+            chunk = f.read(CHUNK_SIZE)
+            if not chunk:
+                return
+            yield chunk
+
+def write_tmp(directory, name, payload, use_gzip):
+    """Finished file with the payload under a temporary name in directory (gzipped as name with use_gzip); returns its path."""
+    if not use_gzip:
+        return payload.path
+    tmp_path = os.path.join(directory, f".{name}.{uuid.uuid4().hex}.tmp")
+    with open(tmp_path, "wb") as raw:
+        # header file name as gzip.open(name) writes it
+        with gzip.GzipFile(filename=name, mode="wb", fileobj=raw) as gz:
+            with io.TextIOWrapper(gz) as text:
+                for chunk in payload_chunks(payload):
+                    text.write(chunk)
+    os.remove(payload.path)
+    return tmp_path
+
+def set_gzip_name(path, name):
+    """Set the file name in the header of a gzip file written by write_tmp to name (as gzip.open(name) writes it)."""
+    fname = os.path.basename(name).encode("latin-1")
+    fname = (fname[:-3] if fname.endswith(b".gz") else fname) + b"\0"
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    with open(path, "rb") as f:
+        header = f.read(10)  # magic, method, flags (FNAME only), mtime, extra flags, OS
+        old = b""
+        while not old.endswith(b"\0"):
+            old += f.read(1)
+        if old == fname:
+            return
+        with open(tmp_path, "wb") as out:
+            out.write(header + fname)
+            shutil.copyfileobj(f, out)
+    os.replace(tmp_path, path)
+
+def write_msa(msa_folder, base, payload, use_gzip):
     """
-    Return a path for the mmcif file.
-    If base exists and is identical -> reuse.
-    If base exists but differs -> create base_1, base_2, etc.
+    Write an MSA to <base>.a3m[.gz] (replacing an older one under a temporary name and rename). If the index knows a
+    file with the same content, it is hard-linked instead of compressing the MSA again. Returns the file name.
     """
-    ext = ".cif.gz" if use_gzip else ".cif"
-    base, _ = os.path.splitext(base_path)
-    candidate = base + ext
-    idx = 1
-
-    while os.path.exists(candidate):
-        # If file content matches -> reuse existing
-        if use_gzip:
-            with gzip.open(candidate, "rt") as f:
-                if f.read() == new_content:
-                    print(f"[INFO] Reusing existing mmcif file: {candidate}")
-                    return candidate
-        else:
-            if file_content_matches(candidate, new_content):
-                print(f"[INFO] Reusing existing mmcif file: {candidate}")
-                return candidate
-
-        # Otherwise, try with suffix
-        candidate = f"{base}_{idx}{ext}"
-        idx += 1
-
-    # Return the first free candidate path
-    print(f"[NEW] Will create new mmcif file: {candidate}")
-    return candidate
-
-# Helper to write gzipped or plain files
-def write_file(path, content):
-    if use_gzip:
-        gz_path = path + ".gz"
-        with gzip.open(gz_path, "wt") as gz:
-            gz.write(content)
-        return gz_path
+    ext = ".a3m.gz" if use_gzip else ".a3m"
+    name = base + ext
+    existing = content_index.lookup(msa_folder, payload.digest, ext)
+    if existing == name:
+        return name
+    if existing:
+        tmp_path = os.path.join(msa_folder, f".{name}.{uuid.uuid4().hex}.tmp")
+        os.link(os.path.join(msa_folder, existing), tmp_path)
     else:
-        with open(path, "w") as f:
-            f.write(content)
-        return path
-
-# Iterate over sequences
-for seq_entry in data.get("sequences", []):
-    protein = seq_entry.get("protein", {})
-
-    # Handle unpaired MSA
-    if "unpairedMsa" in protein and protein["unpairedMsa"]:
-        unpaired_content = protein.pop("unpairedMsa")
-        unpaired_file = os.path.join(msa_folder, f"{name}_unpaired.a3m")
-        protein["unpairedMsaPath"] = os.path.relpath(write_file(unpaired_file, unpaired_content), input_dir)
-
-    # Handle paired MSA
-    if "pairedMsa" in protein and protein["pairedMsa"]:
-        paired_content = protein.pop("pairedMsa")
-        paired_file = os.path.join(msa_folder, f"{name}_paired.a3m")
-        protein["pairedMsaPath"] = os.path.relpath(write_file(paired_file, paired_content), input_dir)
-
-    # Handle templates
-    for template in protein.get("templates", []):
-        if "mmcif" in template and template["mmcif"]:
-            cif_content = template.pop("mmcif")
-            pdb_id_line = cif_content.splitlines()[0]
-            pdb_id = pdb_id_line.replace("data_", "").strip()
-            base_path = os.path.join(template_folder, pdb_id)
-
-            # Deduplication + versioning check
-            cif_path = get_unique_cif_path(base_path, cif_content, use_gzip)
-
-            # If not already existing, write the file
-            if not os.path.exists(cif_path):
-                write_file(cif_path.replace(".gz", "") if use_gzip else cif_path, cif_content)
-
-            template["mmcifPath"] = os.path.relpath(cif_path, input_dir)
-
-# Save updated JSON in-place
-dump_compact_lists(data, input_file)
-
-print(f"Updated JSON saved in-place: {input_file}")
-print(f"Output files {'gzipped' if use_gzip else 'plain'} in {msa_folder}/ and {template_folder}/")
+        tmp_path = write_tmp(msa_folder, name, payload, use_gzip)
+    os.replace(tmp_path, os.path.join(msa_folder, name))
+    content_index.add(msa_folder, payload.digest, name)
+    return name
+
+def write_template(template_folder, pdb_id, payload, use_gzip):
+    """
+    Return the file name of an mmcif template.
+    Templates with the same content are found in the content index and reused; new ones get the first free name
+    of <pdb_id>, <pdb_id>_1, <pdb_id>_2, ... (files are only created by link, so concurrent tasks never collide).
+    """
+    ext = ".cif.gz" if use_gzip else ".cif"
+    existing = content_index.lookup(template_folder, payload.digest, ext)
+    if existing:
+        print(f"[INFO] Reusing existing mmcif file: {os.path.join(template_folder, existing)}")
+        return existing
+    tmp_path = write_tmp(template_folder, pdb_id + ext, payload, use_gzip)
+    try:
+        # versioned names (<pdb_id>_1, ...) are also the file name in the gzip header
+        name = content_index.store(template_folder, tmp_path, payload.digest, pdb_id, ext,
+                                   set_gzip_name if use_gzip else None)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    print(f"[NEW] Created mmcif file: {os.path.join(template_folder, name)}")
+    return name
+
+def extract(input_file, use_gzip):
+    # Folders relative to input file location
+    input_dir = os.path.dirname(os.path.abspath(input_file))
+    msa_folder = os.path.join(input_dir, "msas")
+    template_folder = os.path.join(input_dir, "templates")
+    os.makedirs(msa_folder, exist_ok=True)
+    os.makedirs(template_folder, exist_ok=True)
+
+    # Payload files are created next to their destination, so that they can be renamed into place
+    data, payloads = load_streaming(input_file, msa_folder)
+    try:
+        # Get the name for MSA files
+        name = data.get("name", "protein")
+
+        # Iterate over sequences
+        for seq_entry in data.get("sequences", []):
+            protein = seq_entry.get("protein", {})
+
+            # Handle unpaired MSA
+            if "unpairedMsa" in protein and protein["unpairedMsa"]:
+                unpaired_file = write_msa(msa_folder, f"{name}_unpaired", protein.pop("unpairedMsa"), use_gzip)
+                protein["unpairedMsaPath"] = os.path.relpath(os.path.join(msa_folder, unpaired_file), input_dir)
+
+            # Handle paired MSA
+            if "pairedMsa" in protein and protein["pairedMsa"]:
+                paired_file = write_msa(msa_folder, f"{name}_paired", protein.pop("pairedMsa"), use_gzip)
+                protein["pairedMsaPath"] = os.path.relpath(os.path.join(msa_folder, paired_file), input_dir)
+
+            # Handle templates
+            for template in protein.get("templates", []):
+                if "mmcif" in template and template["mmcif"]:
+                    cif_payload = template.pop("mmcif")
+                    pdb_id = cif_payload.first_line.replace("data_", "").strip()
+
+                    # Deduplication + versioning via the content index
+                    cif_file = write_template(template_folder, pdb_id, cif_payload, use_gzip)
+                    template["mmcifPath"] = os.path.relpath(os.path.join(template_folder, cif_file), input_dir)
+    finally:
+        remove_files(payloads)
+
+    # Empty payloads were not extracted and stay in the JSON
+    for seq_entry in data.get("sequences", []):
+        protein = seq_entry.get("protein", {})
+        for key in ("unpairedMsa", "pairedMsa"):
+            if isinstance(protein.get(key), Payload):
+                protein[key] = ""
+        for template in protein.get("templates", []):
+            if isinstance(template.get("mmcif"), Payload):
+                template["mmcif"] = ""
+
+    # Save updated JSON in-place (renamed over the input, so readers never see a partial file)
+    tmp_path = f"{input_file}.{uuid.uuid4().hex}.tmp"
+    with open(tmp_path, "w") as f:
+        f.write(dumps_compact_lists(data))
+    os.replace(tmp_path, input_file)
+    return data, msa_folder, template_folder
+
+def main():
+    parser = argparse.ArgumentParser(description="Extract MSAs and templates from AlphaFold3 JSON.")
+    parser.add_argument("input_file", help="Path to the input JSON file")
+    parser.add_argument("-z", "--gzip", action="store_true", help="Gzip the output files")
+    args = parser.parse_args()
+
+    data, msa_folder, template_folder = extract(args.input_file, args.gzip)
+
+    # Register the finished monomer so that pre-flight checks don't have to parse it again
+    if args.input_file.endswith("_data.json"):
+        record_monomer(args.input_file, data)
+
+    print(f"Updated JSON saved in-place: {args.input_file}")
+    print(f"Output files {'gzipped' if args.gzip else 'plain'} in {msa_folder}/ and {template_folder}/")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,141 @@
+import os
+import sys
+import json
+import time
+import uuid
+import shutil
+import hashlib
+import argparse
+from jax_cache import cache_entries, prune
+from monomer_store import rewrite_paths
+
+CONTAINER_DIR = "/root/af_input_cache"  # bind target of the node-local cache
+PIN_DIR = ".pins"                       # <cache>/.pins/<SLURM job id>: entries in use by a running task
+PIN_MAX_AGE_SECONDS = 7 * 24 * 3600     # pins of tasks that died without releasing them expire
+
+
+def load_input_cache_config(cluster_config_path):
+    """Returns (node-local cache directory or None, size limit in bytes or None). $TMPDIR etc. are expanded on the node."""
+    with open(cluster_config_path, "r") as f:
+        conf = json.load(f)
+    path = conf.get("input_cache_path")
+    if not path:
+        return None, None
+    max_gb = conf.get("input_cache_max_gb")
+    return os.path.expandvars(path), int(float(max_gb) * 1024**3) if max_gb else None
+
+def entry_name(src_path):
+    """
+    Cache file name of an MSA or template: resolved path, size and modification time of the source.
+    MSAs and templates are never changed in place once written, so this identifies their content without reading it.
+    """
+    real_path = os.path.realpath(src_path)
+    st = os.stat(real_path)
+    key = hashlib.sha256(f"{real_path}:{st.st_size}:{st.st_mtime_ns}".encode()).hexdigest()[:32]
+    return key + os.path.splitext(real_path)[1]
+
+def fetch(src_path, cache):
+    """Return the cache entry of a file, copying it to a temporary name and renaming it on a miss."""
+    name = entry_name(src_path)
+    path = os.path.join(cache, name)
+    if os.path.exists(path):
+        os.utime(path, None)  # last use for eviction
+        return name, False
+    tmp_path = os.path.join(cache, f".{name}.{uuid.uuid4().hex}")
+    try:
+        shutil.copyfile(src_path, tmp_path)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return name, True
+
+def stage(json_file, cache, dest_dir, pin):
+    """
+    Copy an AF3 input JSON to dest_dir with its MSA and template paths pointing into the cache as bound into the container.
+    Missing entries are fetched from shared storage, all entries used are added to the task's pin file.
+    """
+    json_dir = os.path.dirname(os.path.abspath(json_file))
+    with open(json_file, "r") as f:
+        data = json.load(f)
+    names, fetched = [], 0
+
+    def cached(rel_path):
+        nonlocal fetched
+        name, copied = fetch(os.path.join(json_dir, rel_path), cache)
+        names.append(name)
+        fetched += copied
+        return f"{CONTAINER_DIR}/{name}"
+
+    os.makedirs(os.path.join(cache, PIN_DIR), exist_ok=True)
+    for sequence in data["sequences"]:
+        for block in sequence.values():
+            if isinstance(block, dict):
+                rewrite_paths(block, cached)
+    with open(os.path.join(cache, PIN_DIR, pin), "a") as f:
+        f.write("".join(f"{name}\n" for name in names))
+    with open(os.path.join(dest_dir, os.path.basename(json_file)), "w") as f:
+        json.dump(data, f)
+    return len(names), fetched
+
+def pinned(cache):
+    """Entries pinned by tasks that may still be running."""
+    names = set()
+    pin_dir = os.path.join(cache, PIN_DIR)
+    now = time.time()
+    for entry in cache_entries(pin_dir):
+        try:
+            if now - entry.stat().st_mtime > PIN_MAX_AGE_SECONDS:
+                os.remove(entry.path)
+                continue
+            with open(entry.path, "r") as f:
+                names.update(line.strip() for line in f)
+        except FileNotFoundError:
+            continue
+    return names
+
+def release(cache, pin, max_bytes):
+    """Drop the task's pin and evict least recently used entries that no running task pinned until the cache fits max_bytes."""
+    try:
+        os.remove(os.path.join(cache, PIN_DIR, pin))
+    except FileNotFoundError:
+        pass
+    if not max_bytes:
+        return 0
+    return prune(cache, max_bytes, keep=pinned(cache))
+
+def main():
+    parser = argparse.ArgumentParser(description="Node-local cache of MSAs and templates shared by the inference tasks of a node.")
+    parser.add_argument("--cluster-config", default=os.environ.get("CLUSTER_CONFIG"), help="Cluster configuration JSON")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("dir", help="Print the cache directory on this node (empty if not configured)")
+    p_stage = subparsers.add_parser("stage", help="Write an AF3 JSON to dest_dir with its MSAs and templates served from the cache")
+    p_stage.add_argument("json_file")
+    p_stage.add_argument("dest_dir")
+    p_stage.add_argument("--pin", required=True, help="Pin name of the task (e.g. its SLURM job id)")
+    p_release = subparsers.add_parser("release", help="Unpin the entries of a task and apply input_cache_max_gb")
+    p_release.add_argument("--pin", required=True)
+    args = parser.parse_args()
+
+    cache, max_bytes = load_input_cache_config(args.cluster_config)
+    if args.command == "dir":
+        print(cache or "")
+        return
+    if not cache:
+        print("Error: no input_cache_path in the cluster config.", file=sys.stderr)
+        sys.exit(1)
+    if args.command == "stage":
+        try:
+            os.makedirs(cache, exist_ok=True)
+            used, fetched = stage(args.json_file, cache, args.dest_dir, args.pin)
+        except (OSError, KeyError, json.JSONDecodeError) as e:
+            print(f"Error: could not stage {args.json_file}: {e}", file=sys.stderr)
+            sys.exit(1)
+        print(f"Staged {args.json_file}: {used} MSA/template files, {fetched} fetched into {cache}")
+    elif args.command == "release":
+        removed = release(cache, args.pin, max_bytes)
+        if removed:
+            print(f"Evicted {removed} entries from the input cache {cache}", file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+import os
+import sys
+import json
+import uuid
+import fcntl
+import shutil
+import hashlib
+import argparse
+
+
+def load_cache_config(cluster_config_path):
+    with open(cluster_config_path, "r") as f:
+        return json.load(f)
+
+def cache_key(conf, profile):
+    """Compiled executables depend on container (JAX/XLA version), GPU type and XLA memory settings."""
+    container = conf["af3_container_path"]
+    st = os.stat(container)
+    profile_conf = conf["gpu_profiles"][profile]
+    parts = [
+        f"{os.path.basename(container)}:{st.st_size}:{int(st.st_mtime)}",
+        profile_conf["gres"],
+        f"xla={bool(profile_conf.get('enable_xla', False))}",
+    ]
+    return hashlib.sha256("\n".join(parts).encode()).hexdigest()[:16]
+
+def cache_dir(cluster_config_path, profile):
+    """Persistent cache directory for a profile, or empty if no jax_cache_path is configured."""
+    conf = load_cache_config(cluster_config_path)
+    if not conf.get("jax_cache_path"):
+        return ""
+    return os.path.join(conf["jax_cache_path"], cache_key(conf, profile))
+
+def cache_entries(path):
+    """Cache files (temporary files of concurrent writers excluded)."""
+    try:
+        return [e for e in os.scandir(path) if e.is_file() and not e.name.startswith(("_temp_", ".", "tmp"))]
+    except FileNotFoundError:
+        return []
+
+def sync(src, dst):
+    """Copy cache files missing in dst. Each file is copied to a temporary name and renamed, so readers never see partial files."""
+    os.makedirs(dst, exist_ok=True)
+    existing = {e.name for e in cache_entries(dst)}
+    copied = 0
+    for entry in cache_entries(src):
+        if entry.name in existing:
+            continue
+        tmp_path = os.path.join(dst, f".{entry.name}.{uuid.uuid4().hex}")
+        try:
+            shutil.copy2(entry.path, tmp_path)
+            os.replace(tmp_path, os.path.join(dst, entry.name))
+            copied += 1
+        except OSError as e:
+            print(f"Warning: could not copy {entry.path}: {e}", file=sys.stderr)
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+    return copied
+
+def prune(path, max_bytes, keep=()):
+    """Delete least recently used cache files (except those named in keep) until the directory is below max_bytes."""
+    if not os.path.isdir(path):
+        return 0
+    removed = 0
+    with open(os.path.join(path, ".prune.lock"), "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        entries = []
+        for entry in cache_entries(path):
+            try:
+                st = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((max(st.st_atime, st.st_mtime), st.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, file_path in sorted(entries):
+            if total <= max_bytes:
+                break
+            if os.path.basename(file_path) in keep:
+                continue
+            try:
+                os.remove(file_path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            removed += 1
+    return removed
+
+def main():
+    parser = argparse.ArgumentParser(description="Persistent JAX compilation cache shared by inference tasks.")
+    parser.add_argument("--cluster-config", default=os.environ.get("CLUSTER_CONFIG"), help="Cluster configuration JSON")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    p_dir = subparsers.add_parser("dir", help="Print the cache directory of a GPU profile (empty if not configured)")
+    p_dir.add_argument("profile")
+    p_count = subparsers.add_parser("count", help="Print the number of cache entries")
+    p_count.add_argument("path")
+    p_sync = subparsers.add_parser("sync", help="Copy entries missing in dst from src")
+    p_sync.add_argument("src")
+    p_sync.add_argument("dst")
+    p_prune = subparsers.add_parser("prune", help="Apply jax_cache_max_gb to a cache directory")
+    p_prune.add_argument("path")
+    args = parser.parse_args()
+
+    if args.command == "dir":
+        print(cache_dir(args.cluster_config, args.profile))
+    elif args.command == "count":
+        print(len(cache_entries(args.path)))
+    elif args.command == "sync":
+        print(f"Copied {sync(args.src, args.dst)} JAX cache entries to {args.dst}", file=sys.stderr)
+    elif args.command == "prune":
+        max_gb = load_cache_config(args.cluster_config).get("jax_cache_max_gb")
+        if max_gb:
+            removed = prune(args.path, int(float(max_gb) * 1024**3))
+            if removed:
+                print(f"Pruned {removed} JAX cache entries from {args.path}", file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,612 @@
+import os
+import sys
+import json
+import copy
+import math
+import shutil
+import struct
+import bisect
+import argparse
+import itertools
+import multiprocessing
+from collections import Counter
+
+PLAN_FILE = "inference_plan.json"
+TABLE_FILE = "jobs.idx"
+MONOMER_DIR = "monomer_data"
+# Token buckets AlphaFold 3 pads inputs to (run_alphafold.py --buckets default). Larger inputs are not padded.
+DEFAULT_BUCKETS = (256, 512, 768, 1024, 1280, 1536, 2048, 2560, 3072, 3584, 4096, 4608, 5120)
+WRITE_CHUNK_SIZE = 500     # job files per task of the writer pool
+MAX_WRITE_PROCESSES = 8
+
+
+def _dumps_compact(o, level, indent):
+    if isinstance(o, dict):
+        items = []
+        for k, v in o.items():
+            items.append(
+                " " * ((level+1) * indent) + json.dumps(k) + ": " + _dumps_compact(v, level+1, indent)
+            )
+        return "{\n" + ",\n".join(items) + "\n" + " " * (level * indent) + "}"
+    elif isinstance(o, list):
+        if any(isinstance(el, dict) for el in o):
+            items = []
+            for el in o:
+                items.append(" " * ((level+1) * indent) + _dumps_compact(el, level+1, indent))
+            return "[\n" + ",\n".join(items) + "\n" + " " * (level * indent) + "]"
+        else:
+            return "[" + ",".join(_dumps_compact(el, level, indent) for el in o) + "]"
+    else:
+        return json.dumps(o)
+
+def dumps_compact_lists(obj, indent=2):
+    return _dumps_compact(obj, 0, indent)
+
+def dump_compact_lists(obj, filename, indent=2):
+    with open(filename, "w") as f:
+        f.write(dumps_compact_lists(obj, indent))
+
+def chain_id(idx: int) -> str:
+    if idx >= 26:
+        raise ValueError("Too many proteins in a job (max 26 supported: A-Z).")
+    return chr(65 + idx)
+
+def build_job(choice, compound, protein_to_monomer_seqobj, model_seeds):
+    """
+    Build the AF3 input for one protein combination (plus optional compound).
+    Returns (job_name, job_data, token_size).
+    """
+    sequences = []
+    for pos, protein in enumerate(choice):
+        seq_obj = copy.deepcopy(protein_to_monomer_seqobj[protein])
+        if "protein" not in seq_obj or not isinstance(seq_obj["protein"], dict):
+            raise ValueError(f"Invalid monomer JSON for protein '{protein}': missing or malformed 'protein' key.")
+        seq_obj["protein"]["id"] = chain_id(pos)
+        seq_obj["protein"]["description"] = protein
+        sequences.append(seq_obj)
+
+    ligand_atoms = 0
+    ligand_name_id = ""
+    sequence_extension = []
+    if compound:
+        ligand_chain_id = chain_id(len(sequences))
+        sequence_extension = [{"ligand": {"id": ligand_chain_id, "description": compound["ID"], "smiles": compound["SMILES"]}}]
+        ligand_atoms = compound["Atoms"]
+        ligand_name_id = "_" + str(compound["ID"])
+
+    job_name = "_".join(choice) + ligand_name_id
+    job_data = {
+        "dialect": "alphafold3",
+        "version": 4,
+        "name": job_name,
+        "sequences": sequences + sequence_extension,
+        "modelSeeds": model_seeds,
+        "bondedAtomPairs": None,
+        "userCCD": None
+    }
+
+    token_size = sum(len(seq_obj["protein"]["sequence"]) for seq_obj in sequences if seq_obj.get("protein")) + ligand_atoms
+    return job_name, job_data, token_size
+
+class JobWriter:
+    """
+    Render AF3 job JSONs byte-identical to dumps_compact_lists(build_job(...)) from text fragments:
+    every monomer is serialized once per chain position instead of deep-copied and serialized per job.
+    """
+
+    def __init__(self, protein_to_monomer_seqobj, model_seeds, indent=2):
+        self.seqobjs = protein_to_monomer_seqobj
+        self.indent = indent
+        self.fragments = {}  # (protein, chain position) -> serialized sequence entry
+        pad = " " * indent
+        self.head = "{\n" + pad + '"dialect": "alphafold3",\n' + pad + '"version": 4,\n' + pad + '"name": '
+        self.tail = (",\n" + pad + '"modelSeeds": ' + _dumps_compact(model_seeds, 1, indent) + ",\n"
+                     + pad + '"bondedAtomPairs": null,\n' + pad + '"userCCD": null\n}')
+
+    def _entry(self, seq_obj):
+        return " " * (2 * self.indent) + _dumps_compact(seq_obj, 2, self.indent)
+
+    def fragment(self, protein, pos):
+        key = (protein, pos)
+        if key not in self.fragments:
+            seq_obj = self.seqobjs[protein]
+            if "protein" not in seq_obj or not isinstance(seq_obj["protein"], dict):
+                raise ValueError(f"Invalid monomer JSON for protein '{protein}': missing or malformed 'protein' key.")
+            # same key order as setting id and description on a copy
+            seq_obj = dict(seq_obj, protein=dict(seq_obj["protein"], id=chain_id(pos), description=protein))
+            self.fragments[key] = self._entry(seq_obj)
+        return self.fragments[key]
+
+    def render(self, choice, compound):
+        """Return (job_name, JSON text) of one protein combination (plus optional compound)."""
+        entries = [self.fragment(protein, pos) for pos, protein in enumerate(choice)]
+        job_name = "_".join(choice)
+        if compound:
+            entries.append(self._entry({"ligand": {"id": chain_id(len(choice)), "description": compound["ID"],
+                                                   "smiles": compound["SMILES"]}}))
+            job_name += "_" + str(compound["ID"])
+        pad = " " * self.indent
+        sequences = "[\n" + ",\n".join(entries) + "\n" + pad + "]" if entries else "[]"
+        return job_name, self.head + json.dumps(job_name) + ",\n" + pad + '"sequences": ' + sequences + self.tail
+
+    def write(self, job_file, choice, compound):
+        with open(job_file, "w") as f:
+            f.write(self.render(choice, compound)[1])
+
+_writer = None
+
+def _init_writer(writer):
+    global _writer
+    _writer = writer
+
+def _write_chunk(chunk):
+    for job_file, choice, compound in chunk:
+        _writer.write(job_file, choice, compound)
+    return len(chunk)
+
+def write_jobs(writer, jobs, processes=None, chunk_size=WRITE_CHUNK_SIZE):
+    """
+    Write (job_file, choice, compound) jobs with a JobWriter, spread over a process pool of the available CPUs
+    (at most MAX_WRITE_PROCESSES). Target directories must exist.
+    """
+    if processes is None:
+        processes = min(len(os.sched_getaffinity(0)), MAX_WRITE_PROCESSES)
+    if processes <= 1 or len(jobs) < 2 * chunk_size:
+        _init_writer(writer)
+        _write_chunk(jobs)
+        return
+    chunks = [jobs[i:i + chunk_size] for i in range(0, len(jobs), chunk_size)]
+    # forked workers inherit the writer and its fragments
+    with multiprocessing.Pool(processes, initializer=_init_writer, initargs=(writer,)) as pool:
+        for _ in pool.imap_unordered(_write_chunk, chunks):
+            pass
+
+def link_monomer_dirs(target_dir, monomer_dir=MONOMER_DIR, subdirs=("msas", "templates", "store")):
+    """Create target_dir and relative symlinks to the monomer MSA/template/store directories (once per profile)."""
+    os.makedirs(target_dir, exist_ok=True)
+    for subdir in subdirs:
+        link = os.path.join(target_dir, subdir)
+        target = os.path.relpath(os.path.abspath(os.path.join(monomer_dir, subdir)), start=os.path.abspath(target_dir))
+        os.path.islink(link) or os.symlink(target, link, target_is_directory=True)
+
+# ------------------------------
+# AF3 token buckets
+# ------------------------------
+
+def load_buckets(cluster_conf):
+    """Buckets from the optional af3_buckets cluster config key (passed to run_alphafold.py as --buckets)."""
+    return sorted(int(b) for b in (cluster_conf.get("af3_buckets") or DEFAULT_BUCKETS))
+
+def parse_buckets(text):
+    return sorted(int(b) for b in text.split(",") if b.strip()) if text else list(DEFAULT_BUCKETS)
+
+def bucket_index(token_size, buckets):
+    """Index of the bucket a job is padded to; len(buckets) for jobs above the largest bucket."""
+    return bisect.bisect_left(buckets, token_size)
+
+def padded_size(token_size, buckets):
+    i = bucket_index(token_size, buckets)
+    return buckets[i] if i < len(buckets) else token_size
+
+def effective_limit(token_limit, buckets):
+    """Largest token size whose padded size still fits token_limit (-1 if none does)."""
+    if token_limit >= buckets[-1]:
+        return token_limit
+    return max((b for b in buckets if b <= token_limit), default=-1)
+
+def bucket_windows(lo, hi, buckets):
+    """Split the token window [lo, hi] into per-bucket windows (bucket index, lo, hi), ascending."""
+    windows = []
+    prev = 0
+    for i, bucket in enumerate(list(buckets) + [None]):
+        w_lo = max(lo, prev + 1 if i else 0)
+        w_hi = hi if bucket is None else min(hi, bucket)
+        if w_lo <= w_hi:
+            windows.append((i, w_lo, w_hi))
+        if bucket is None or bucket >= hi:
+            break
+        prev = bucket
+    return windows
+
+# ------------------------------
+# Counting and unranking of the virtual job space
+# ------------------------------
+
+def suffix_counts(dim_lengths, cap):
+    """
+    suffix[d][s] = number of ways to pick one entry from each of the dimensions d..n-1
+    so that their lengths sum to s. Sums above cap are collected in suffix[d][cap + 1].
+    Cost is O(dimensions * distinct lengths * cap), independent of the number of jobs.
+    """
+    size = cap + 2
+    current = [0] * size
+    current[0] = 1
+    suffix = [current]
+    for lengths in reversed(dim_lengths):
+        nxt = [0] * size
+        for length, multiplicity in Counter(lengths).items():
+            for s, c in enumerate(current):
+                if c:
+                    nxt[min(s + length, cap + 1)] += multiplicity * c
+        suffix.append(nxt)
+        current = nxt
+    suffix.reverse()
+    return suffix
+
+class TokenSpace:
+    """Product of dimensions whose entries have a token length, addressable by rank within a token window."""
+
+    def __init__(self, dim_lengths, suffix):
+        self.dim_lengths = dim_lengths
+        self.cap = len(suffix[0]) - 2
+        # prefix sums for O(1) range counts
+        self.prefix = []
+        for counts in suffix:
+            acc = [0]
+            for c in counts:
+                acc.append(acc[-1] + c)
+            self.prefix.append(acc)
+
+    def count(self, d, lo, hi):
+        """Number of completions from dimension d on with token sum in [lo, hi]."""
+        lo = max(lo, 0)
+        hi = min(hi, self.cap + 1)
+        if lo > hi:
+            return 0
+        return self.prefix[d][hi + 1] - self.prefix[d][lo]
+
+    def unrank(self, k, lo, hi):
+        """Return the index tuple of the k-th combination (in product order) with token sum in [lo, hi]."""
+        partial = 0
+        choice = []
+        for d, lengths in enumerate(self.dim_lengths):
+            for i, length in enumerate(lengths):
+                c = self.count(d + 1, lo - partial - length, hi - partial - length)
+                if k < c:
+                    choice.append(i)
+                    partial += length
+                    break
+                k -= c
+            else:
+                raise IndexError("Rank outside of token window.")
+        return tuple(choice)
+
+def dimensions_overlap(key_lists):
+    seen = set()
+    for keys in key_lists:
+        if seen.intersection(keys):
+            return True
+        seen.update(keys)
+    return False
+
+def identical_dimension_groups(key_lists):
+    """
+    Group dimensions with identical protein sets. Returns a list of (proteins, multiplicity)
+    or None if two different groups share proteins (no closed form for deduplication).
+    """
+    groups = {}
+    for keys in key_lists:
+        key_set = frozenset(keys)
+        groups[key_set] = groups.get(key_set, 0) + 1
+    if dimensions_overlap([list(key_set) for key_set in groups]):
+        return None
+    return [(sorted(key_set), k) for key_set, k in groups.items()]
+
+def count_cartesian_jobs(key_lists):
+    """
+    Number of unique cartesian jobs (order of chains does not matter) without enumeration:
+    k identical dimensions of n proteins give C(n + k - 1, k) multisets, disjoint groups multiply.
+    Returns None if dimensions overlap partially.
+    """
+    groups = identical_dimension_groups(key_lists)
+    if groups is None:
+        return None
+    total = 1
+    for proteins, k in groups:
+        total *= math.comb(len(proteins) + k - 1, k)
+    return total
+
+def multiset_histogram(lengths, k, cap):
+    """hist[s] = number of multisets of size k drawn from lengths with sum s (sums above cap in hist[cap + 1])."""
+    size = cap + 2
+    f = [[0] * size for _ in range(k + 1)]
+    f[0][0] = 1
+    for length in lengths:
+        # ascending j reuses rows already updated with this entry -> repetitions allowed
+        for j in range(1, k + 1):
+            prev, row = f[j - 1], f[j]
+            for s, c in enumerate(prev):
+                if c:
+                    row[min(s + length, cap + 1)] += c
+    return f[k]
+
+def convolve_histograms(a, b, cap):
+    out = [0] * (cap + 2)
+    for s, c in enumerate(a):
+        if c:
+            for t, d in enumerate(b):
+                if d:
+                    out[min(s + t, cap + 1)] += c * d
+    return out
+
+def cartesian_token_histogram(key_lists, protein_lengths, cap):
+    """
+    Token histogram of the unique cartesian jobs (sums above cap collected in the last bin).
+    Returns None if dimensions overlap partially.
+    """
+    groups = identical_dimension_groups(key_lists)
+    if groups is None:
+        return None
+    hist = [0] * (cap + 2)
+    hist[0] = 1
+    for proteins, k in groups:
+        hist = convolve_histograms(hist, multiset_histogram([protein_lengths[p] for p in proteins], k, cap), cap)
+    return hist
+
+# ------------------------------
+# Plan writing
+# ------------------------------
+
+def profile_windows(profiles, profile_limits, buckets):
+    """Token window [lo, hi] for every profile (smallest profile whose token_limit fits the padded size)."""
+    windows = {}
+    lo = 0
+    for profile in profiles:
+        hi = max(effective_limit(profile_limits[profile], buckets), lo - 1)
+        windows[profile] = (lo, hi)
+        lo = hi + 1
+    return windows
+
+class TableWriter:
+    """Append fixed-width index records (one per job) to <run_dir>/<profile>/jobs.idx."""
+
+    def __init__(self, path, width, append=False):
+        self.record = struct.Struct(f"<{width}I")
+        self.f = open(path, "ab" if append else "wb")
+
+    def append(self, values):
+        self.f.write(self.record.pack(*values))
+
+    def close(self):
+        self.f.close()
+
+def record_width(mode, key_lists, seed_mask=False):
+    """Number of uint32 fields of an index table record (dimension positions, compound index, optional seed mask)."""
+    return (len(key_lists) if mode == "cartesian" else 1) + 1 + int(seed_mask)
+
+def plan_width(plan):
+    return record_width(plan["mode"], plan["dimensions"], plan.get("seed_mask", False))
+
+def plan_record(plan):
+    """struct.Struct of the index table records of a plan."""
+    return struct.Struct(f"<{plan_width(plan)}I")
+
+def seed_mask(seeds, subset):
+    """Bit mask of the seeds in subset (bit i stands for seeds[i]); 0 stands for all seeds."""
+    if set(seeds) <= set(subset):
+        return 0
+    if len(seeds) > 32:
+        raise ValueError("Seed subsets are only supported for up to 32 seeds.")
+    return sum(1 << i for i, seed in enumerate(seeds) if seed in subset)
+
+def masked_seeds(seeds, mask):
+    return [seed for i, seed in enumerate(seeds) if mask & (1 << i)] if mask else list(seeds)
+
+def write_plan(run_dir, mode, key_lists, protein_to_input_seq, compounds, model_seeds, profiles, profile_limits, buckets,
+               streaming=False):
+    """
+    Write a compact plan instead of one JSON per job. Disjoint cartesian dimensions are
+    counted and addressed combinatorially; overlapping dimensions (which need deduplication)
+    and collapsed mode fall back to an index table of fixed-width records per profile.
+    INFERENCE_IDs of a profile are ordered by AF3 bucket. Returns (jobs per profile, number of too big jobs).
+    With streaming, the index tables start empty and pipeline_controller.py appends jobs as their monomers finish
+    (and retries of failed jobs, which may only cover some of the seeds: records end with a seed mask).
+    """
+    os.makedirs(run_dir, exist_ok=True)
+    for profile in profiles:
+        link_monomer_dirs(os.path.join(run_dir, profile))
+
+    windows = profile_windows(profiles, profile_limits, buckets)
+    cap = windows[profiles[-1]][1] if profiles else 0
+    compound_atoms = [c["Atoms"] for c in compounds]
+
+    plan = {
+        "format": 1,
+        "mode": mode,
+        "dimensions": key_lists,
+        "sequences": {name: protein_to_input_seq[name] for keys in key_lists for name in keys},
+        "compounds": compounds,
+        "seeds": model_seeds,
+        "monomer_dir": MONOMER_DIR,
+        "buckets": buckets,
+        "profiles": {},
+    }
+
+    if streaming:
+        plan["dedup"] = "canonical" if mode == "cartesian" else "sorted-dimension"
+        plan["index"] = "stream"
+        plan["seed_mask"] = True
+        for profile in profiles:
+            open(os.path.join(run_dir, profile, TABLE_FILE), "wb").close()
+        window_counts = {p: [] for p in profiles}
+        job_counts = {p: 0 for p in profiles}
+        too_big = 0
+    elif mode == "cartesian" and not dimensions_overlap(key_lists):
+        plan["dedup"] = "none"
+        plan["index"] = "computed"
+        dim_lengths = [[len(protein_to_input_seq[k]) for k in keys] for keys in key_lists]
+        if compounds:
+            dim_lengths.append(compound_atoms)
+        suffix = suffix_counts(dim_lengths, cap)
+        space = TokenSpace(dim_lengths, suffix)
+        plan["suffix_counts"] = suffix
+        window_counts = {p: [(b, lo, hi, space.count(0, lo, hi)) for b, lo, hi in bucket_windows(*windows[p], buckets)]
+                         for p in profiles}
+        job_counts = {p: sum(w[3] for w in window_counts[p]) for p in profiles}
+        total = 1
+        for lengths in dim_lengths:
+            total *= len(lengths)
+        too_big = total - sum(job_counts.values())
+    else:
+        plan["dedup"] = "canonical" if mode == "cartesian" else "sorted-dimension"
+        plan["index"] = "table"
+        width = record_width(mode, key_lists)
+        # One temporary table per (profile, bucket), concatenated in bucket order below
+        writers = {}
+        window_counts = {p: [[b, lo, hi, 0] for b, lo, hi in bucket_windows(*windows[p], buckets)] for p in profiles}
+        job_counts = {p: 0 for p in profiles}
+        too_big = 0
+        seen = set()
+        if mode == "cartesian":
+            iterator = itertools.product(*[range(len(keys)) for keys in key_lists])
+        else:
+            iterator = ((i,) for i in range(len(key_lists)))
+        for positions in iterator:
+            if mode == "cartesian":
+                names = [key_lists[d][i] for d, i in enumerate(positions)]
+            else:
+                names = key_lists[positions[0]]
+            canon = tuple(sorted(names))
+            if canon in seen:
+                continue
+            seen.add(canon)
+            protein_tokens = sum(len(protein_to_input_seq[n]) for n in names)
+            for c_idx, atoms in enumerate(compound_atoms or [0]):
+                token_size = protein_tokens + atoms
+                for profile in profiles:
+                    if token_size <= windows[profile][1]:
+                        b = bucket_index(token_size, buckets)
+                        if (profile, b) not in writers:
+                            writers[profile, b] = TableWriter(os.path.join(run_dir, profile, f"{TABLE_FILE}.{b}.tmp"), width)
+                        writers[profile, b].append(positions + (c_idx,))
+                        job_counts[profile] += 1
+                        for window in window_counts[profile]:
+                            if window[0] == b:
+                                window[3] += 1
+                        break
+                else:
+                    too_big += 1
+        for writer in writers.values():
+            writer.close()
+        for profile in profiles:
+            with open(os.path.join(run_dir, profile, TABLE_FILE), "wb") as out:
+                for b, _, _, _ in window_counts[profile]:
+                    part = os.path.join(run_dir, profile, f"{TABLE_FILE}.{b}.tmp")
+                    if os.path.exists(part):
+                        with open(part, "rb") as f:
+                            shutil.copyfileobj(f, out)
+                        os.remove(part)
+
+    for profile in profiles:
+        lo, hi = windows[profile]
+        plan["profiles"][profile] = {
+            "min": lo, "max": hi, "jobs": job_counts[profile],
+            "windows": [{"bucket": buckets[b] if b < len(buckets) else None, "min": w_lo, "max": w_hi, "jobs": n}
+                        for b, w_lo, w_hi, n in window_counts[profile] if n],
+        }
+    plan["too_big_jobs"] = too_big
+    save_plan(run_dir, plan)
+    return job_counts, too_big
+
+def save_plan(run_dir, plan):
+    tmp_path = os.path.join(run_dir, PLAN_FILE + ".tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(plan, f)
+    os.replace(tmp_path, os.path.join(run_dir, PLAN_FILE))
+
+# ------------------------------
+# Plan decoding
+# ------------------------------
+
+def load_plan(run_dir):
+    with open(os.path.join(run_dir, PLAN_FILE), "r") as f:
+        return json.load(f)
+
+def job_count(plan, run_dir, profile):
+    if plan["index"] == "stream":
+        # streamed tables grow while the run is going on
+        return os.path.getsize(os.path.join(run_dir, profile, TABLE_FILE)) // plan_record(plan).size
+    return plan["profiles"][profile]["jobs"]
+
+def read_record(plan, run_dir, profile, inference_id):
+    """Raw index table record of an INFERENCE_ID (table and stream plans)."""
+    record = plan_record(plan)
+    with open(os.path.join(run_dir, profile, TABLE_FILE), "rb") as f:
+        f.seek(inference_id * record.size)
+        return record.unpack(f.read(record.size))
+
+def decode(plan, run_dir, profile, inference_id):
+    """Return (protein names, compound or None, seeds) for an INFERENCE_ID of a profile."""
+    key_lists = plan["dimensions"]
+    compounds = plan["compounds"]
+    profile_info = plan["profiles"][profile]
+    count = job_count(plan, run_dir, profile)
+    if not 0 <= inference_id < count:
+        raise IndexError(f"INFERENCE_ID {inference_id} out of range for profile '{profile}' ({count} jobs).")
+
+    if plan["index"] == "computed":
+        sequences = plan["sequences"]
+        dim_lengths = [[len(sequences[k]) for k in keys] for keys in key_lists]
+        if compounds:
+            dim_lengths.append([c["Atoms"] for c in compounds])
+        space = TokenSpace(dim_lengths, plan["suffix_counts"])
+        rank = inference_id
+        for window in profile_info["windows"]:
+            if rank < window["jobs"]:
+                break
+            rank -= window["jobs"]
+        positions = space.unrank(rank, window["min"], window["max"])
+        if not compounds:
+            positions = positions + (0,)
+    else:
+        positions = read_record(plan, run_dir, profile, inference_id)
+
+    mask = 0
+    if plan.get("seed_mask"):
+        positions, mask = positions[:-1], positions[-1]
+    if plan["mode"] == "cartesian":
+        names = [key_lists[d][i] for d, i in enumerate(positions[:-1])]
+    else:
+        names = list(key_lists[positions[0]])
+    compound = compounds[positions[-1]] if compounds else None
+    return names, compound, masked_seeds(plan["seeds"], mask)
+
+def load_monomer_seqobj(monomer_dir, name):
+    path = os.path.join(monomer_dir, f"{name}_data.json")
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"Missing monomer result: {path}")
+    with open(path, "r") as f:
+        md = json.load(f)
+    return md["sequences"][0].copy()
+
+def materialize(run_dir, profile, inference_id):
+    """Build the AF3 JSON for one INFERENCE_ID next to the profile's msas/templates links and return its path."""
+    plan = load_plan(run_dir)
+    names, compound, seeds = decode(plan, run_dir, profile, inference_id)
+    seqobjs = {name: load_monomer_seqobj(plan["monomer_dir"], name) for name in set(names)}
+    job_name, job_data, _ = build_job(names, compound, seqobjs, seeds)
+    job_file = os.path.join(run_dir, profile, f"{inference_id}_{job_name}.json")
+    # Seed shards of a job materialize the same file at the same time
+    tmp_path = f"{job_file}.{os.getpid()}.tmp"
+    dump_compact_lists(job_data, tmp_path)
+    os.replace(tmp_path, job_file)
+    return job_file
+
+def main():
+    parser = argparse.ArgumentParser(description="Decode an INFERENCE_ID of a virtual job plan into an AF3 input JSON.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    p_mat = subparsers.add_parser("materialize", help="Write the AF3 JSON of one job and print its path")
+    p_mat.add_argument("run_dir", help="pending_jobs/<PIPELINE_RUN_ID>")
+    p_mat.add_argument("profile", help="GPU profile")
+    p_mat.add_argument("inference_id", type=int, help="INFERENCE_ID within the profile")
+    args = parser.parse_args()
+
+    if args.command == "materialize":
+        try:
+            print(materialize(args.run_dir, args.profile, args.inference_id))
+        except (IndexError, KeyError, FileNotFoundError) as e:
+            print(f"Error: {e}", file=sys.stderr)
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
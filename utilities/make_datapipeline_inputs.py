@@ -1,19 +1,35 @@
 import os
 import json
 import sys
+from monomer_manifest import load_manifest, is_current, record_monomer
+from monomer_store import load_store_config, lookup, link, publish, normalize_sequence, verify_linked
+from planner import load_run_plan
 
 PIPELINE_RUN_ID = os.environ["PIPELINE_RUN_ID"]
 INPUT_FILE = os.environ["INPUT_FILE"]
+CLUSTER_CONFIG = os.environ.get("CLUSTER_CONFIG")
 output_dir = os.path.join("data_pipeline_inputs", PIPELINE_RUN_ID)
 monomer_dir = "monomer_data"
 
 os.makedirs(output_dir, exist_ok=True)
 
-with open(INPUT_FILE, "r") as f:
-    dimensions = json.load(f)
+# Proteins as validated by planner.py; plain input JSON for runs without an up to date plan
+plan = load_run_plan(os.path.join("pending_jobs", PIPELINE_RUN_ID), INPUT_FILE)
+if plan is None:
+    with open(INPUT_FILE, "r") as f:
+        dimensions = json.load(f)
+else:
+    dimensions = [plan["proteins"]]
 
 first_seen_sequences = {}
-file_index = 0
+new_monomers = []  # (protein name, sequence) that run through the data pipeline
+
+# Optional shared monomer store: identical sequences are only searched once across runs and users
+store, store_max_bytes, store_db_version, store_container_version = load_store_config(CLUSTER_CONFIG) if CLUSTER_CONFIG else (None, None, None, None)
+queued_sequences = {}  # normalized sequence -> protein name that runs through the data pipeline
+
+# Manifest of finished monomers: avoids parsing every _data.json and stat'ing its MSAs and templates
+manifest = load_manifest(monomer_dir)
 
 
 def check_existing_monomer_data(protein_name):
@@ -26,6 +42,13 @@ def check_existing_monomer_data(protein_name):
     Prints short messages to stderr for any missing or invalid items.
     """
     monomer_file = os.path.join(monomer_dir, f"{protein_name}_data.json")
+    record = manifest.get(protein_name)
+    if is_current(record, monomer_dir):
+        # MSAs and templates linked from the monomer store disappear when the store evicts the entry
+        if verify_linked(monomer_dir, protein_name, record["seqobj"]["protein"]):
+            return True
+        sys.stderr.write(f"[{protein_name}] Monomer store entry was evicted or replaced\n")
+        return False
     if not os.path.exists(monomer_file):
         return False
 
@@ -77,6 +100,8 @@ def check_existing_monomer_data(protein_name):
         sys.stderr.write(f"[{protein_name}] 'templates' is not a list in {monomer_file}\n")
         return False
 
+    verify_linked(monomer_dir, protein_name, protein_block)  # keeps linked store entries from being evicted
+    record_monomer(monomer_file, data)  # next pre-flight check can use the manifest
     return True  # All checks passed
 
 
@@ -90,29 +115,28 @@ for dim_idx, dimension in enumerate(dimensions):
 
             # Skip creation if existing monomer data is complete
             if check_existing_monomer_data(protein_name):
+                if store and not lookup(store, protein_seq, store_db_version, store_container_version):
+                    # Seed the shared store with data computed before it was configured
+                    publish(store, os.path.join(monomer_dir, f"{protein_name}_data.json"),
+                            store_db_version, store_container_version, store_max_bytes)
                 continue
 
-            # Otherwise, create new JSON
-            out_json = {
-                "name": protein_name,
-                "sequences": [
-                    {
-                        "protein": {
-                            "id": "A",
-                            "sequence": protein_seq
-                        }
-                    }
-                ],
-                "dialect": "alphafold3",
-                "version": 3,
-                "modelSeeds": [0]
-            }
-
-            out_path = os.path.join(output_dir, f"{file_index}_{protein_name}.json")
-            with open(out_path, "w") as out_f:
-                json.dump(out_json, out_f, indent=4)
+            if store:
+                # Reuse an identical sequence from the shared store
+                entry = lookup(store, protein_seq, store_db_version, store_container_version)
+                if entry:
+                    link(entry, protein_name, monomer_dir)
+                    sys.stderr.write(f"[{protein_name}] Linked to monomer store entry {os.path.basename(entry)}\n")
+                    continue
+                # Same sequence under another name in this run: it is linked from the store before inference
+                normalized = normalize_sequence(protein_seq)
+                if normalized in queued_sequences:
+                    sys.stderr.write(f"[{protein_name}] Same sequence as {queued_sequences[normalized]}, reusing its data pipeline results\n")
+                    continue
+                queued_sequences[normalized] = protein_name
 
-            file_index += 1
+            # Otherwise, create new JSON
+            new_monomers.append((protein_name, protein_seq))
 
         else:
             if first_seen_sequences[protein_name] != protein_seq:
@@ -123,5 +147,28 @@ for dim_idx, dimension in enumerate(dimensions):
                 )
                 sys.exit(1)
 
+# DATA_PIPELINE_IDs by decreasing length: the longest searches start first and every resource class
+# (see datapipeline_sizing.py) is a contiguous ID range
+new_monomers.sort(key=lambda monomer: -len(monomer[1]))
+for file_index, (protein_name, protein_seq) in enumerate(new_monomers):
+    out_json = {
+        "name": protein_name,
+        "sequences": [
+            {
+                "protein": {
+                    "id": "A",
+                    "sequence": protein_seq
+                }
+            }
+        ],
+        "dialect": "alphafold3",
+        "version": 3,
+        "modelSeeds": [0]
+    }
+
+    out_path = os.path.join(output_dir, f"{file_index}_{protein_name}.json")
+    with open(out_path, "w") as out_f:
+        json.dump(out_json, out_f, indent=4)
+
 # Return the number of created JSON files
-print(file_index)
+print(len(new_monomers))
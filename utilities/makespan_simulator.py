@@ -0,0 +1,211 @@
+import os
+import sys
+import json
+import heapq
+import argparse
+from collections import Counter
+from job_plan import convolve_histograms, padded_size, profile_windows
+from planner import RUN_PLAN_FILE, job_histogram, load_run_plan
+from walltime_predictor import load_history, WalltimeModel, DEFAULT_MIN_SAMPLES
+
+SPILL_STEPS = 1000  # jobs are spilled in steps of 1/SPILL_STEPS of all jobs of the run
+
+
+def parse_gpus(text):
+    """'40g=32,80g=8' -> {"40g": 32, "80g": 8}"""
+    gpus = {}
+    for item in text.split(","):
+        profile, _, count = item.strip().partition("=")
+        if not profile or not count.isdigit() or int(count) <= 0:
+            raise ValueError(f"Error: invalid GPU count '{item.strip()}' (expected <profile>=<number of GPUs>).")
+        gpus[profile] = int(count)
+    return gpus
+
+def token_counts(plan):
+    """Jobs per token size of a run plan (planner.py), compounds included, and the number of too big jobs."""
+    profiles = plan["profiles"]
+    windows = profile_windows([p["name"] for p in profiles], {p["name"]: p["token_limit"] for p in profiles},
+                              plan["buckets"])
+    cap = windows[profiles[-1]["name"]][1]
+    lengths = {protein: len(sequence) for protein, sequence in plan["proteins"].items()}
+    _, histogram, _ = job_histogram(plan["settings"]["mode"], plan["dimensions"], lengths, cap)
+    if plan["compounds"]:
+        atoms = [0] * (cap + 2)
+        for compound in plan["compounds"]:
+            atoms[min(compound["Atoms"], cap + 1)] += 1
+        histogram = convolve_histograms(histogram, atoms, cap)
+    return {tokens: jobs for tokens, jobs in enumerate(histogram[:cap + 1]) if jobs}, histogram[cap + 1]
+
+def smallest_fit(plan, counts):
+    """Jobs per profile and padded size with every job on the smallest profile that fits (make_inference_inputs.py)."""
+    names = [p["name"] for p in plan["profiles"]]
+    windows = profile_windows(names, {p["name"]: p["token_limit"] for p in plan["profiles"]}, plan["buckets"])
+    assignment = {name: Counter() for name in names}
+    for tokens, jobs in counts.items():
+        for name in names:
+            if tokens <= windows[name][1]:
+                assignment[name][padded_size(tokens, plan["buckets"])] += jobs
+                break
+    return assignment
+
+class RuntimeModel:
+    """
+    Expected minutes of a job per profile and bucket: the median minutes per seed of the completed jobs in the
+    inference statistics (or of the next larger bucket with enough history) times the seeds, max_minutes_per_seed
+    without history.
+    """
+
+    def __init__(self, history, profiles, seeds, min_samples=DEFAULT_MIN_SAMPLES):
+        self.walltime = WalltimeModel(history, q=0.5, margin=0.0, min_samples=min_samples)
+        self.max_minutes_per_seed = {p["name"]: p["max_minutes_per_seed"] for p in profiles}
+        self.seeds = seeds
+        self.fallback = set()  # (profile, bucket) estimated from the configured limit
+
+    def minutes(self, profile, bucket):
+        per_seed = self.walltime.minutes_per_seed(profile, bucket)
+        if per_seed is None:
+            self.fallback.add((profile, bucket))
+            per_seed = self.max_minutes_per_seed[profile]
+        return per_seed * self.seeds
+
+def simulate(assignment, model, gpus):
+    """
+    Run the jobs of every profile on its GPUs, in INFERENCE_ID order (ascending bucket), each job on the GPU that
+    becomes free first. Returns {profile: (jobs, GPU-minutes, minutes until the last job is done)}.
+    """
+    result = {}
+    for profile, buckets in assignment.items():
+        free = [0.0] * gpus[profile]
+        busy = 0.0
+        for bucket in sorted(buckets):
+            minutes = model.minutes(profile, bucket)
+            for _ in range(buckets[bucket]):
+                heapq.heapreplace(free, free[0] + minutes)
+            busy += minutes * buckets[bucket]
+        result[profile] = (sum(buckets.values()), busy, max(free))
+    return result
+
+def spill(assignment, model, gpus):
+    """
+    Move jobs to larger profiles while that lowers the predicted completion of the run (GPU-minutes over GPUs of
+    the profile that finishes last). Returns the new assignment and the jobs moved per (profile, bucket, target).
+    """
+    names = list(assignment)
+    assignment = {profile: Counter(buckets) for profile, buckets in assignment.items()}
+    load = {p: sum(model.minutes(p, b) * n for b, n in assignment[p].items()) / gpus[p] for p in names}
+    step = max(1, sum(sum(buckets.values()) for buckets in assignment.values()) // SPILL_STEPS)
+    moves = Counter()
+    while True:
+        source = max(names, key=lambda p: load[p])
+        best = None
+        for bucket, jobs in assignment[source].items():
+            n = min(step, jobs)
+            for target in names[names.index(source) + 1:]:
+                completion = max(load[source] - model.minutes(source, bucket) * n / gpus[source],
+                                 load[target] + model.minutes(target, bucket) * n / gpus[target])
+                if completion < load[source] and (best is None or completion < best[0]):
+                    best = (completion, bucket, target, n)
+        if best is None:
+            break
+        _, bucket, target, n = best
+        assignment[source][bucket] -= n
+        if not assignment[source][bucket]:
+            del assignment[source][bucket]
+        assignment[target][bucket] += n
+        load[source] -= model.minutes(source, bucket) * n / gpus[source]
+        load[target] += model.minutes(target, bucket) * n / gpus[target]
+        moves[(source, bucket, target)] += n
+    return assignment, moves
+
+def load_model(plan, cluster_conf, stats_file):
+    return RuntimeModel(load_history(stats_file), plan["profiles"], len(plan["settings"]["seeds"]),
+                        int(cluster_conf.get("walltime_min_samples", DEFAULT_MIN_SAMPLES)))
+
+def check_gpus(plan, gpus):
+    missing = [p["name"] for p in plan["profiles"] if p["name"] not in gpus]
+    if missing:
+        raise ValueError(f"Error: no GPU count for GPU profile(s) {', '.join(missing)} of the run.")
+
+def spill_quotas(plan, cluster_conf, stats_file, gpus):
+    """
+    Spill policy for make_inference_inputs.py: {(profile, padded size): Counter(target profile: jobs)}, empty if
+    spilling does not lower the simulated makespan.
+    """
+    check_gpus(plan, gpus)
+    model = load_model(plan, cluster_conf, stats_file)
+    counts, _ = token_counts(plan)
+    assignment = smallest_fit(plan, counts)
+    spilled, moves = spill(assignment, model, gpus)
+    before = max(minutes for _, _, minutes in simulate(assignment, model, gpus).values())
+    after = max(minutes for _, _, minutes in simulate(spilled, model, gpus).values())
+    if after >= before:
+        return {}
+    quotas = {}
+    for (source, bucket, target), jobs in moves.items():
+        quotas.setdefault((source, bucket), Counter())[target] += jobs
+        print(f"Spilling {jobs} jobs of bucket {bucket} from {source} to {target}.", file=sys.stderr)
+    print(f"Predicted makespan: {before / 60:.1f} h -> {after / 60:.1f} h", file=sys.stderr)
+    return quotas
+
+def spill_target(quotas, profile, bucket):
+    """Profile of a job the smallest fit puts on profile: takes one job of the spill quota of its bucket, if any."""
+    targets = quotas.get((profile, bucket))
+    while targets:
+        target = next(iter(targets))
+        targets[target] -= 1
+        if not targets[target]:
+            del targets[target]
+        profile = target
+        targets = quotas.get((profile, bucket))
+    return profile
+
+def print_result(title, result, gpus):
+    print(title)
+    print(f"{'profile':<12} {'GPUs':>6} {'jobs':>10} {'GPU-hours':>10} {'hours':>8}")
+    for profile, (jobs, busy, minutes) in result.items():
+        print(f"{profile:<12} {gpus[profile]:>6} {jobs:>10} {busy / 60:>10.1f} {minutes / 60:>8.1f}")
+    print(f"{'total':<12} {sum(gpus[p] for p in result):>6} {sum(r[0] for r in result.values()):>10} "
+          f"{sum(r[1] for r in result.values()) / 60:>10.1f} {max(r[2] for r in result.values()) / 60:>8.1f}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Estimate the makespan and GPU-hours of a planned run on a "
+                                                 "simulated cluster and spill jobs to larger GPU profiles.")
+    parser.add_argument("--cluster-config", default=os.environ.get("CLUSTER_CONFIG"), help="Cluster configuration JSON")
+    parser.add_argument("--stats", default=os.environ.get("INFERENCE_STATISTICS_FILE"), help="Inference statistics JSONL")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    p_sim = subparsers.add_parser("simulate", help="Compare the smallest-fit assignment of a run with spilling")
+    p_sim.add_argument("run_dir", help=f"pending_jobs/<PIPELINE_RUN_ID> with a {RUN_PLAN_FILE}")
+    p_sim.add_argument("--gpus", default=os.environ.get("SPILL_GPUS"), help="GPUs per profile, e.g. 40g=32,80g=8")
+    args = parser.parse_args()
+
+    with open(args.cluster_config, "r") as f:
+        cluster_conf = json.load(f)
+    plan = load_run_plan(args.run_dir)
+    if plan is None:
+        print(f"Error: no current {RUN_PLAN_FILE} in {args.run_dir} (run planner.py first).", file=sys.stderr)
+        sys.exit(1)
+    try:
+        gpus = parse_gpus(args.gpus or "")
+        check_gpus(plan, gpus)
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        sys.exit(1)
+
+    if args.command == "simulate":
+        model = load_model(plan, cluster_conf, args.stats)
+        counts, too_big = token_counts(plan)
+        assignment = smallest_fit(plan, counts)
+        print_result("Smallest profile that fits:", simulate(assignment, model, gpus), gpus)
+        spilled, moves = spill(assignment, model, gpus)
+        print()
+        print_result("With spilling to larger profiles:", simulate(spilled, model, gpus), gpus)
+        for (source, bucket, target), jobs in sorted(moves.items()):
+            print(f"  {jobs} jobs of bucket {bucket}: {source} -> {target}")
+        if too_big:
+            print(f"{too_big} jobs too big for every profile (not simulated).")
+        if model.fallback:
+            print("No history (max_minutes_per_seed used) for: "
+                  + ", ".join(f"{p} bucket {b}" for p, b in sorted(model.fallback)))
+
+if __name__ == "__main__":
+    main()
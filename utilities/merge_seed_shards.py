@@ -0,0 +1,135 @@
+import os
+import sys
+import json
+import fcntl
+import shutil
+import argparse
+
+
+def shard_dirs(shards_dir, name, num_shards):
+    """AlphaFold output directory of every seed shard (shard k ran with output_dir <shards_dir>/<k>)."""
+    return [os.path.join(shards_dir, str(k), name) for k in range(num_shards)]
+
+def best_score(shard_dir, name):
+    """Highest ranking score of a shard (the sample AlphaFold wrote as the shard's top-level result)."""
+    with open(os.path.join(shard_dir, f"{name}_ranking_scores.csv"), "r") as f:
+        next(f)
+        return max(float(line.split(",")[2]) for line in f if line.strip())
+
+def end_file(shards_dir, shard):
+    return os.path.join(shards_dir, f"{shard}.end")
+
+def shard_ended(shards_dir, shard):
+    """State a shard ended with ("done" or the reason it failed), None if it did not end yet."""
+    try:
+        with open(end_file(shards_dir, shard), "r") as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        return None
+
+def merge(shards_dir, name, num_shards, output_dir, shard, state):
+    """
+    Merge the results of all seed shards of a job into <output_dir>/<name>, as a single run_alphafold.py call over
+    all seeds writes them: the per-sample directories of all seeds, the top-level model and confidences of the best
+    sample (the first one in seed order on ties) and one ranking_scores.csv in seed order.
+    Shards are contiguous slices of modelSeeds, so concatenating them keeps the seed order.
+    Every shard reports the state it ended with ("done" or the reason it failed); the last one to end merges.
+    Returns "waiting" while shards are running and "merged" once all of them are merged. If a shard failed, its
+    reason is returned and the shards are kept: running the job again only runs the shards that did not finish.
+    """
+    os.makedirs(shards_dir, exist_ok=True)
+    with open(os.path.join(shards_dir, ".lock"), "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        with open(end_file(shards_dir, shard), "w") as f:
+            f.write(state + "\n")
+        states = [shard_ended(shards_dir, k) for k in range(num_shards)]
+        if None in states:
+            return "waiting"
+        failed = [s for s in states if s != "done"]
+        if failed:
+            return failed[0]
+
+        combine(shard_dirs(shards_dir, name, num_shards), name, os.path.join(output_dir, name))
+        shutil.rmtree(shards_dir)
+    return "merged"
+
+def combine(dirs, name, target):
+    """
+    Move the samples of the AlphaFold output directories dirs into target and write the top-level files of the
+    best sample, the ranking_scores.csv and the _data.json of all of them in the order of dirs.
+    target itself may be the first of dirs (results of an earlier run that are kept).
+    """
+    scores = [best_score(d, name) for d in dirs]
+    best_dir = dirs[scores.index(max(scores))]
+    ranking = []
+    seeds = []
+    for k, d in enumerate(dirs):
+        with open(os.path.join(d, f"{name}_ranking_scores.csv"), "r", newline="") as f:
+            lines = f.readlines()
+        ranking.extend(lines if k == 0 else lines[1:])
+        with open(os.path.join(d, f"{name}_data.json"), "r") as f:
+            seeds.extend(json.load(f)["modelSeeds"])
+    with open(os.path.join(dirs[0], f"{name}_data.json"), "r") as f:
+        data = json.load(f)
+
+    os.makedirs(target, exist_ok=True)
+    for d in dirs:
+        if d == target:
+            continue
+        for entry in sorted(os.listdir(d)):
+            if entry.startswith("seed-"):
+                shutil.move(os.path.join(d, entry), os.path.join(target, entry))
+    if best_dir != target:
+        for entry in os.listdir(best_dir):
+            if os.path.isfile(os.path.join(best_dir, entry)):
+                shutil.copyfile(os.path.join(best_dir, entry), os.path.join(target, entry))
+
+    with open(os.path.join(target, f"{name}_ranking_scores.csv"), "w", newline="") as out:
+        out.writelines(ranking)
+    data["modelSeeds"] = seeds
+    with open(os.path.join(target, f"{name}_data.json"), "w") as f:
+        json.dump(data, f, indent=2)
+
+def merge_retry(run_dir, name, output_dir):
+    """
+    Add the results of a finished retry (pipeline_controller.py requeue, a subset of the seeds of a failed job) to
+    the result directory <output_dir>/<name> of the job, which keeps the seeds of the first attempt and of other
+    retries that finished before. The retry's own output directory run_dir is removed.
+    """
+    target = os.path.join(output_dir, name)
+    if os.path.abspath(run_dir) == os.path.abspath(target):
+        return
+    os.makedirs(output_dir, exist_ok=True)
+    with open(os.path.join(output_dir, ".merge.lock"), "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        kept = [target] if os.path.exists(os.path.join(target, f"{name}_ranking_scores.csv")) else []
+        combine(kept + [run_dir], name, target)
+        shutil.rmtree(run_dir)
+
+def main():
+    parser = argparse.ArgumentParser(description="Merge the seed shards or retries of an inference job.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    p_shards = subparsers.add_parser("shards", help="Report the end of a seed shard, merge once all of them finished")
+    p_shards.add_argument("shards_dir", help="Directory with one AlphaFold output directory per shard (0, 1, ...)")
+    p_shards.add_argument("name", help="Inference job name")
+    p_shards.add_argument("num_shards", type=int)
+    p_shards.add_argument("output_dir", help="Results directory that receives <name>/")
+    p_shards.add_argument("shard", type=int, help="Shard that ended")
+    p_shards.add_argument("state", help="'done' or the reason the shard failed")
+    p_retry = subparsers.add_parser("retry", help="Add the results of a finished retry to the job's result directory")
+    p_retry.add_argument("run_dir", help="AlphaFold output directory of the retry (<name>/)")
+    p_retry.add_argument("name", help="Inference job name")
+    p_retry.add_argument("output_dir", help="Results directory of the job's first attempt")
+    args = parser.parse_args()
+
+    try:
+        if args.command == "shards":
+            print(merge(args.shards_dir, args.name, args.num_shards, args.output_dir, args.shard, args.state))
+        elif args.command == "retry":
+            merge_retry(args.run_dir, args.name, args.output_dir)
+    except (OSError, ValueError, KeyError) as e:
+        print(f"Error: could not merge the results of {args.name}: {e}", file=sys.stderr)
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,137 @@
+import os
+import sys
+import json
+import fcntl
+import argparse
+
+MANIFEST_FILE = "manifest.jsonl"
+
+
+def manifest_path(monomer_dir):
+    return os.path.join(monomer_dir, MANIFEST_FILE)
+
+def referenced_paths(protein_block):
+    """Relative MSA/template paths of a monomer 'protein' block."""
+    paths = [protein_block[key] for key in ("unpairedMsaPath", "pairedMsaPath") if key in protein_block]
+    for template in protein_block.get("templates") or []:
+        if isinstance(template, dict) and "mmcifPath" in template:
+            paths.append(template["mmcifPath"])
+    return paths
+
+def stat_entry(path):
+    st = os.stat(path)
+    return [st.st_size, st.st_mtime_ns]
+
+def make_record(monomer_file, data=None):
+    """Manifest record of a finished monomer: sequence object, data file and dependency file stats."""
+    if data is None:
+        with open(monomer_file, "r") as f:
+            data = json.load(f)
+    base_dir = os.path.dirname(monomer_file)
+    seq_obj = data["sequences"][0]
+    protein_block = seq_obj["protein"]
+    return {
+        "name": os.path.basename(monomer_file)[:-len("_data.json")],
+        "sequence": protein_block["sequence"],
+        "length": len(protein_block["sequence"]),
+        "data_file": stat_entry(monomer_file),
+        "files": {rel_path: stat_entry(os.path.join(base_dir, rel_path)) for rel_path in referenced_paths(protein_block)},
+        "seqobj": seq_obj,
+    }
+
+def append_records(monomer_dir, records):
+    """Append records under an exclusive lock, one line each (readers take the last record per name)."""
+    lines = "".join(json.dumps(record, separators=(",", ":")) + "\n" for record in records)
+    with open(manifest_path(monomer_dir), "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        f.write(lines)
+        f.flush()
+        fcntl.flock(f, fcntl.LOCK_UN)
+
+def record_monomer(monomer_file, data=None):
+    append_records(os.path.dirname(monomer_file), [make_record(monomer_file, data)])
+
+def load_manifest(monomer_dir):
+    """name -> latest record. Truncated lines (e.g. from a killed writer) are ignored."""
+    records = {}
+    try:
+        with open(manifest_path(monomer_dir), "r") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                records[record["name"]] = record
+    except FileNotFoundError:
+        pass
+    return records
+
+def is_current(record, monomer_dir, verify_files=False):
+    """
+    True if the monomer file still matches the record. Only the _data.json is stat'ed by default;
+    MSAs and templates are written before it and are only checked with verify_files.
+    """
+    if record is None:
+        return False
+    try:
+        if stat_entry(os.path.join(monomer_dir, f"{record['name']}_data.json")) != record["data_file"]:
+            return False
+        if verify_files:
+            for rel_path, entry in record["files"].items():
+                if stat_entry(os.path.join(monomer_dir, rel_path)) != entry:
+                    return False
+    except OSError:
+        return False
+    return True
+
+def compact(monomer_dir):
+    """Rewrite the manifest with only the latest, still current record per name."""
+    records = load_manifest(monomer_dir)
+    path = manifest_path(monomer_dir)
+    with open(path, "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as f:
+            for record in records.values():
+                if is_current(record, monomer_dir):
+                    f.write(json.dumps(record, separators=(",", ":")) + "\n")
+        os.replace(tmp_path, path)
+    return len(records)
+
+def rebuild(monomer_dir):
+    """Index all existing monomer_data/*_data.json files (e.g. data from before the manifest existed)."""
+    records = []
+    for entry in sorted(os.listdir(monomer_dir)):
+        if not entry.endswith("_data.json"):
+            continue
+        try:
+            records.append(make_record(os.path.join(monomer_dir, entry)))
+        except (OSError, KeyError, IndexError, json.JSONDecodeError) as e:
+            print(f"Warning: could not index {entry}: {e}", file=sys.stderr)
+    path = manifest_path(monomer_dir)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        for record in records:
+            f.write(json.dumps(record, separators=(",", ":")) + "\n")
+    os.replace(tmp_path, path)
+    return len(records)
+
+def main():
+    parser = argparse.ArgumentParser(description="Manifest of finished monomers in monomer_data/.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    p_add = subparsers.add_parser("add", help="Record a finished monomer _data.json")
+    p_add.add_argument("monomer_file")
+    for name, help_text in (("compact", "Drop outdated records"), ("rebuild", "Re-index all *_data.json files")):
+        p = subparsers.add_parser(name, help=help_text)
+        p.add_argument("monomer_dir", nargs="?", default="monomer_data")
+    args = parser.parse_args()
+
+    if args.command == "add":
+        record_monomer(args.monomer_file)
+    elif args.command == "compact":
+        print(f"{compact(args.monomer_dir)} monomers in manifest")
+    elif args.command == "rebuild":
+        print(f"{rebuild(args.monomer_dir)} monomers indexed")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,284 @@
+import os
+import sys
+import json
+import time
+import uuid
+import fcntl
+import shutil
+import hashlib
+import argparse
+from job_plan import dumps_compact_lists
+from monomer_manifest import referenced_paths, record_monomer
+
+STORE_LINK_DIR = "store"  # monomer_data/store/<hash> -> <monomer_store_path>/<hash[:2]>/<hash>
+EVICTION_GRACE_SECONDS = 24 * 3600  # entries used within this time are never evicted (runs may still read them)
+
+
+def normalize_sequence(sequence):
+    return "".join(sequence.split()).upper()
+
+def sequence_hash(sequence):
+    return hashlib.sha256(normalize_sequence(sequence).encode()).hexdigest()
+
+def file_fingerprint(path):
+    st = os.stat(path)
+    return f"{os.path.basename(path)}:{st.st_size}:{int(st.st_mtime)}"
+
+def db_version(db_path):
+    """Fingerprint of the database directory (names, sizes and mtimes of its top-level entries)."""
+    entries = []
+    for entry in sorted(os.listdir(db_path)):
+        entries.append(file_fingerprint(os.path.join(db_path, entry)))
+    return hashlib.sha256("\n".join(entries).encode()).hexdigest()[:16]
+
+def load_store_config(cluster_config_path):
+    """Returns (store path or None, size limit in bytes or None, db version, container version)."""
+    with open(cluster_config_path, "r") as f:
+        conf = json.load(f)
+    store = conf.get("monomer_store_path")
+    if not store:
+        return None, None, None, None
+    max_gb = conf.get("monomer_store_max_gb")
+    max_bytes = int(float(max_gb) * 1024**3) if max_gb else None
+    return store, max_bytes, db_version(conf["af3_db_path"]), file_fingerprint(conf["af3_container_path"])
+
+def entry_dir(store, seq_hash):
+    return os.path.join(store, seq_hash[:2], seq_hash)
+
+def rewrite_paths(protein_block, func):
+    for key in ("unpairedMsaPath", "pairedMsaPath"):
+        if key in protein_block:
+            protein_block[key] = func(protein_block[key])
+    for template in protein_block.get("templates") or []:
+        if isinstance(template, dict) and "mmcifPath" in template:
+            template["mmcifPath"] = func(template["mmcifPath"])
+
+def touch(path):
+    with open(path, "a"):
+        os.utime(path, None)
+
+def lookup(store, sequence, db_ver, container_ver):
+    """Return the store entry directory for a sequence if it is complete and of this database and container version."""
+    path = entry_dir(store, sequence_hash(sequence))
+    try:
+        with open(os.path.join(path, "meta.json"), "r") as f:
+            meta = json.load(f)
+        with open(os.path.join(path, "data.json"), "r") as f:
+            data = json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return None
+    if ((meta.get("db_version"), meta.get("container_version")) != (db_ver, container_ver)
+            or meta.get("sequence") != normalize_sequence(sequence)):
+        return None
+    for rel_path in referenced_paths(data["sequences"][0]["protein"]):
+        if not os.path.exists(os.path.join(path, rel_path)):
+            return None
+    touch(os.path.join(path, "last_used"))
+    return path
+
+def entry_versions(path):
+    """(database version, container version) of a store entry."""
+    try:
+        with open(os.path.join(path, "meta.json"), "r") as f:
+            meta = json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return None, None
+    return meta.get("db_version"), meta.get("container_version")
+
+def publish(store, monomer_file, db_ver, container_ver, max_bytes=None):
+    """
+    Copy a finished monomer (_data.json plus MSAs and templates) into the store.
+    The entry is assembled in a temporary directory and renamed into place, so readers
+    never see partial entries and concurrent publishers of the same sequence are harmless.
+    An entry of another database or container version is replaced.
+    """
+    with open(monomer_file, "r") as f:
+        data = json.load(f)
+    base_dir = os.path.dirname(os.path.abspath(monomer_file))
+    protein_block = data["sequences"][0]["protein"]
+    sequence = protein_block["sequence"]
+    target = entry_dir(store, sequence_hash(sequence))
+    if os.path.isdir(target) and entry_versions(target) == (db_ver, container_ver):
+        return target
+
+    tmp_dir = os.path.join(store, "tmp", uuid.uuid4().hex)
+    os.makedirs(tmp_dir)
+    size = 0
+    copied = {}
+    for rel_path in referenced_paths(protein_block):
+        subdir = "templates" if os.path.basename(os.path.dirname(rel_path)) == "templates" else "msas"
+        new_rel = os.path.join(subdir, os.path.basename(rel_path))
+        if rel_path not in copied:
+            os.makedirs(os.path.join(tmp_dir, subdir), exist_ok=True)
+            shutil.copy2(os.path.join(base_dir, rel_path), os.path.join(tmp_dir, new_rel))
+            size += os.path.getsize(os.path.join(tmp_dir, new_rel))
+        copied[rel_path] = new_rel
+    rewrite_paths(protein_block, lambda p: copied[p])
+    with open(os.path.join(tmp_dir, "data.json"), "w") as f:
+        f.write(dumps_compact_lists(data))
+    meta = {
+        "sequence": normalize_sequence(sequence),
+        "length": len(normalize_sequence(sequence)),
+        "db_version": db_ver,
+        "container_version": container_ver,
+        "created": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "size_bytes": size,
+    }
+    with open(os.path.join(tmp_dir, "meta.json"), "w") as f:
+        json.dump(meta, f, indent=2)
+    touch(os.path.join(tmp_dir, "last_used"))
+
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    with open(os.path.join(store, ".evict.lock"), "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if os.path.isdir(target) and entry_versions(target) != (db_ver, container_ver):
+            # rename the outdated entry aside first, like evict(), so lookups never see a half-deleted entry
+            outdated = os.path.join(store, "tmp", uuid.uuid4().hex)
+            os.rename(target, outdated)
+            shutil.rmtree(outdated, ignore_errors=True)
+            print(f"Replacing {os.path.basename(target)} (other database or container version) in monomer store",
+                  file=sys.stderr)
+        try:
+            os.rename(tmp_dir, target)
+        except OSError:
+            # Someone else published the same sequence first
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+    if max_bytes:
+        evict(store, max_bytes)
+    return target
+
+def evict(store, max_bytes):
+    """Remove least recently used entries until the store is below max_bytes."""
+    with open(os.path.join(store, ".evict.lock"), "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        entries = []
+        for prefix in os.listdir(store):
+            prefix_dir = os.path.join(store, prefix)
+            if len(prefix) != 2 or not os.path.isdir(prefix_dir):
+                continue
+            for seq_hash in os.listdir(prefix_dir):
+                path = os.path.join(prefix_dir, seq_hash)
+                try:
+                    with open(os.path.join(path, "meta.json"), "r") as f:
+                        size = json.load(f).get("size_bytes", 0)
+                    last_used = os.path.getmtime(os.path.join(path, "last_used"))
+                except (OSError, json.JSONDecodeError):
+                    continue
+                entries.append((last_used, size, path))
+        total = sum(size for _, size, _ in entries)
+        now = time.time()
+        for last_used, size, path in sorted(entries):
+            if total <= max_bytes or now - last_used < EVICTION_GRACE_SECONDS:
+                break
+            # rename first so that lookups never see a half-deleted entry
+            doomed = os.path.join(store, "tmp", uuid.uuid4().hex)
+            os.makedirs(os.path.dirname(doomed), exist_ok=True)
+            try:
+                os.rename(path, doomed)
+            except OSError:
+                continue
+            shutil.rmtree(doomed, ignore_errors=True)
+            total -= size
+            print(f"Evicted {os.path.basename(path)} from monomer store", file=sys.stderr)
+
+def verify_linked(monomer_dir, name, protein_block=None):
+    """
+    False if a monomer linked to the store lost its entry because the entry was evicted, or replaced after linking.
+    Only the linked store/<hash> entries are stat'ed, not every MSA and template; they are marked as used, so they
+    are not evicted while runs still read them. True for monomers not linked.
+    """
+    monomer_file = os.path.join(monomer_dir, f"{name}_data.json")
+    if protein_block is None:
+        try:
+            with open(monomer_file, "r") as f:
+                protein_block = json.load(f)["sequences"][0]["protein"]
+        except (OSError, json.JSONDecodeError, KeyError, IndexError):
+            return False
+    hashes = {p.split("/")[1] for p in referenced_paths(protein_block) if p.startswith(STORE_LINK_DIR + "/")}
+    if not hashes:
+        return True
+    try:
+        linked_at = os.stat(monomer_file).st_mtime_ns
+        for seq_hash in hashes:
+            entry = os.path.join(monomer_dir, STORE_LINK_DIR, seq_hash)
+            if os.stat(os.path.join(entry, "meta.json")).st_mtime_ns > linked_at:
+                return False  # replaced by a newer entry (other database or container version)
+            touch(os.path.join(entry, "last_used"))
+    except OSError:
+        return False
+    return True
+
+def link(entry, name, monomer_dir):
+    """Make monomer_data/<name>_data.json point to a store entry via monomer_data/store/<hash>."""
+    seq_hash = os.path.basename(entry)
+    link_dir = os.path.join(monomer_dir, STORE_LINK_DIR)
+    os.makedirs(link_dir, exist_ok=True)
+    link_path = os.path.join(link_dir, seq_hash)
+    if not os.path.islink(link_path):
+        os.symlink(os.path.abspath(entry), link_path, target_is_directory=True)
+    with open(os.path.join(entry, "data.json"), "r") as f:
+        data = json.load(f)
+    data["name"] = name
+    rewrite_paths(data["sequences"][0]["protein"], lambda p: os.path.join(STORE_LINK_DIR, seq_hash, p))
+    tmp_path = os.path.join(monomer_dir, f".{name}_data.json.tmp")
+    with open(tmp_path, "w") as f:
+        f.write(dumps_compact_lists(data))
+    monomer_file = os.path.join(monomer_dir, f"{name}_data.json")
+    os.replace(tmp_path, monomer_file)
+    record_monomer(monomer_file, data)
+
+def link_run(input_file, cluster_config, monomer_dir, names=None):
+    """
+    Link every protein of the input (or only those in names) that has no local monomer data but a store entry.
+    Returns missing names.
+    """
+    store, _, db_ver, container_ver = load_store_config(cluster_config)
+    with open(input_file, "r") as f:
+        dimensions = json.load(f)
+    missing = []
+    done = set()
+    for dimension in dimensions:
+        for name, sequence in dimension.items():
+            if name in done or (names is not None and name not in names):
+                continue
+            done.add(name)
+            if os.path.exists(os.path.join(monomer_dir, f"{name}_data.json")):
+                if verify_linked(monomer_dir, name):
+                    continue
+                print(f"Warning: monomer store entry of {name} was evicted, linking it again", file=sys.stderr)
+            entry = lookup(store, sequence, db_ver, container_ver) if store else None
+            if entry:
+                link(entry, name, monomer_dir)
+                print(f"Linked {name} to monomer store entry {os.path.basename(entry)}", file=sys.stderr)
+            else:
+                missing.append(name)
+    return missing
+
+def main():
+    parser = argparse.ArgumentParser(description="Shared monomer feature store keyed by sequence hash.")
+    parser.add_argument("--cluster-config", default=os.environ.get("CLUSTER_CONFIG"), help="Cluster configuration JSON")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    p_pub = subparsers.add_parser("publish", help="Copy a finished monomer _data.json and its files into the store")
+    p_pub.add_argument("monomer_file")
+    p_link = subparsers.add_parser("link-run", help="Link proteins of an input file that are missing locally")
+    p_link.add_argument("input_file")
+    p_link.add_argument("--monomer-dir", default="monomer_data")
+    subparsers.add_parser("evict", help="Apply the size limit of the store")
+    args = parser.parse_args()
+
+    store, max_bytes, db_ver, container_ver = load_store_config(args.cluster_config)
+    if args.command == "link-run":
+        missing = link_run(args.input_file, args.cluster_config, args.monomer_dir)
+        if missing:
+            print(f"No monomer data for: {', '.join(missing)}", file=sys.stderr)
+        return
+    if not store:
+        print("No monomer_store_path configured. Nothing to do.", file=sys.stderr)
+        return
+    if args.command == "publish":
+        print(publish(store, args.monomer_file, db_ver, container_ver, max_bytes))
+    elif args.command == "evict" and max_bytes:
+        evict(store, max_bytes)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,157 @@
+import os
+import re
+import sys
+import json
+import fcntl
+import argparse
+import subprocess
+
+QUEUE_FILE = "node_queue.json"  # pending_jobs/<PIPELINE_RUN_ID>/node_queue.json: next unclaimed INFERENCE_ID per profile
+MIG_LINE = re.compile(r"^\s+MIG .*\(UUID: (MIG-[^)]+)\)")
+GPU_LINE = re.compile(r"^GPU \d+: .*\(UUID: (GPU-[^)]+)\)")
+
+
+def load_config(cluster_config_path):
+    with open(cluster_config_path, "r") as f:
+        return json.load(f)
+
+def init(run_dir, job_counts):
+    """Queue all INFERENCE_IDs of every profile (job_counts: profile -> number of jobs)."""
+    state = {"profiles": {profile: {"next": 0, "jobs": jobs} for profile, jobs in job_counts.items()}, "tasks": 0}
+    save(run_dir, state)
+    return state
+
+def save(run_dir, state):
+    tmp_path = os.path.join(run_dir, QUEUE_FILE + ".tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(state, f)
+    os.replace(tmp_path, os.path.join(run_dir, QUEUE_FILE))
+
+def load(run_dir):
+    with open(os.path.join(run_dir, QUEUE_FILE), "r") as f:
+        return json.load(f)
+
+def routing(conf, device_profile, queued_profiles):
+    """
+    Profiles a device takes jobs from: its own first, then the queued profiles with a smaller token limit,
+    largest first (jobs padded to a smaller bucket also fit a larger GPU, never the other way round).
+    """
+    profiles = conf["gpu_profiles"]
+    limit = profiles[device_profile]["token_limit"]
+    smaller = [p for p in queued_profiles if p != device_profile and p in profiles and profiles[p]["token_limit"] <= limit]
+    return [device_profile] + sorted(smaller, key=lambda p: -profiles[p]["token_limit"])
+
+def claim(run_dir, conf, device_profile, minutes_left, seeds, jobs_per_task, results_per_dir):
+    """
+    Take up to jobs_per_task consecutive INFERENCE_IDs that fit the remaining minutes of the node job and
+    share a results directory. Returns (profile, first, last, task number, jobs of the profile) or None.
+    """
+    with open(os.path.join(run_dir, QUEUE_FILE + ".lock"), "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        state = load(run_dir)
+        for profile in routing(conf, device_profile, state["profiles"]):
+            queue = state["profiles"].get(profile)
+            if queue is None or queue["next"] >= queue["jobs"]:
+                continue
+            fit = minutes_left // (conf["gpu_profiles"][profile]["max_minutes_per_seed"] * seeds)
+            if fit < 1:
+                continue
+            first = queue["next"]
+            last = min(first + min(jobs_per_task, fit) - 1, queue["jobs"] - 1,
+                       (first // results_per_dir + 1) * results_per_dir - 1)
+            queue["next"] = last + 1
+            state["tasks"] += 1
+            save(run_dir, state)
+            return profile, first, last, state["tasks"] - 1, queue["jobs"]
+    return None
+
+def reachable(conf, node_type, queued_profiles):
+    """Profiles that at least one device of a node type takes jobs from."""
+    return {p for device_profile in set(conf["gpu_nodes"][node_type]["devices"])
+            for p in routing(conf, device_profile, queued_profiles)}
+
+def remaining(run_dir, profiles=None):
+    """Unclaimed jobs (of the given profiles only)."""
+    return sum(queue["jobs"] - queue["next"] for profile, queue in load(run_dir)["profiles"].items()
+               if profiles is None or profile in profiles)
+
+def visible_devices():
+    """CUDA_VISIBLE_DEVICES value of every device in the order of nvidia-smi -L (MIG instances instead of their GPU)."""
+    out = subprocess.run(["nvidia-smi", "-L"], check=True, capture_output=True, text=True).stdout
+    devices = []
+    for line in out.splitlines():
+        gpu = GPU_LINE.match(line)
+        mig = MIG_LINE.match(line)
+        if gpu:
+            devices.append([gpu.group(1)])
+        elif mig and devices:
+            if devices[-1][0].startswith("GPU-"):
+                devices[-1] = []
+            devices[-1].append(mig.group(1))
+    return [uuid for gpu in devices for uuid in gpu]
+
+def main():
+    parser = argparse.ArgumentParser(description="Queue of the INFERENCE_IDs of a run for whole-node GPU jobs.")
+    parser.add_argument("--cluster-config", default=os.environ.get("CLUSTER_CONFIG"))
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    p_init = subparsers.add_parser("init", help="Read make_inference_inputs.py output from stdin and queue all jobs")
+    p_init.add_argument("run_dir", help="pending_jobs/<PIPELINE_RUN_ID>")
+    p_devices = subparsers.add_parser("devices", help="Print the device and GPU profile of every GPU or MIG instance of the node")
+    p_devices.add_argument("node_type", help="Entry of gpu_nodes in the cluster config")
+    p_claim = subparsers.add_parser("claim", help="Print 'profile first last task jobs enable_xla' of the next jobs for a device")
+    p_claim.add_argument("run_dir")
+    p_claim.add_argument("device_profile", help="GPU profile of the device")
+    p_claim.add_argument("--minutes-left", type=int, required=True)
+    p_claim.add_argument("--seeds", type=int, required=True)
+    p_claim.add_argument("--jobs-per-task", type=int, default=int(os.environ.get("JOBS_PER_TASK") or 1))
+    p_claim.add_argument("--results-per-dir", type=int, default=int(os.environ.get("RESULTS_PER_DIR") or 1))
+    p_status = subparsers.add_parser("status", help="Print the claimed and total jobs per profile")
+    p_status.add_argument("run_dir")
+    p_remaining = subparsers.add_parser("remaining", help="Print the number of unclaimed jobs")
+    p_remaining.add_argument("run_dir")
+    p_remaining.add_argument("--node-type", help="Only count jobs the devices of this node type can run")
+    args = parser.parse_args()
+
+    if args.command == "init":
+        counts = {profile: info["jobs"] for profile, info in json.load(sys.stdin)["profiles"].items()}
+        init(args.run_dir, counts)
+        print(f"Queued {sum(counts.values())} jobs for whole-node GPU jobs.")
+        node_type = os.environ.get("NODE_TYPE")
+        if node_type:
+            unreachable = [p for p in counts if counts[p] and p not in reachable(load_config(args.cluster_config), node_type, counts)]
+            if unreachable:
+                print(f"Warning: no device of node type '{node_type}' can run the jobs of GPU profile(s) "
+                      f"{', '.join(unreachable)}.", file=sys.stderr)
+    elif args.command == "devices":
+        conf = load_config(args.cluster_config)
+        node = conf.get("gpu_nodes", {}).get(args.node_type)
+        if node is None:
+            print(f"Error: node type '{args.node_type}' not found in gpu_nodes of the cluster config.", file=sys.stderr)
+            sys.exit(1)
+        devices = visible_devices()
+        if len(devices) != len(node["devices"]):
+            print(f"Error: {len(devices)} GPUs or MIG instances visible, node type '{args.node_type}' "
+                  f"lists {len(node['devices'])} devices.", file=sys.stderr)
+            sys.exit(1)
+        for device, profile in zip(devices, node["devices"]):
+            print(f"{device} {profile}")
+    elif args.command == "claim":
+        conf = load_config(args.cluster_config)
+        claimed = claim(args.run_dir, conf, args.device_profile, args.minutes_left, args.seeds, args.jobs_per_task,
+                        args.results_per_dir)
+        if claimed is None:
+            sys.exit(1)
+        profile, first, last, task, jobs = claimed
+        enable_xla = str(bool(conf["gpu_profiles"][profile].get("enable_xla", False))).lower()
+        print(f"{profile} {first} {last} {task} {jobs} {enable_xla}")
+    elif args.command == "remaining":
+        profiles = None
+        if args.node_type:
+            profiles = reachable(load_config(args.cluster_config), args.node_type, load(args.run_dir)["profiles"])
+        print(remaining(args.run_dir, profiles))
+    elif args.command == "status":
+        for profile, queue in load(args.run_dir)["profiles"].items():
+            print(f"{profile}: {queue['next']} of {queue['jobs']} jobs claimed")
+
+if __name__ == "__main__":
+    main()
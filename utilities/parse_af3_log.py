@@ -0,0 +1,106 @@
+import re
+import sys
+import json
+from datetime import datetime
+
+TIME_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+
+# Lines of the timestamped log look like "<ISO-8601 UTC timestamp>\t<AlphaFold output line>"
+BUCKET_REGEX = re.compile(r"Got bucket size (\d+) for input with (\d+)")
+SEED_INFERENCE_REGEX = re.compile(r"Running model inference with seed (\d+) took ([0-9.]+) seconds")
+FEATURISATION_REGEX = re.compile(r"Featurising data with \d+ seed\(s\) took ([0-9.]+) seconds")
+EXTRACTION_REGEX = re.compile(r"Extracting \d+ inference samples with seed -?\d+ took ([0-9.]+) seconds")
+OUTPUT_START = "Writing outputs with "
+# XLA/JAX messages when the GPU runs out of memory
+OOM_REGEX = re.compile(r"RESOURCE_EXHAUSTED|CUDA_ERROR_OUT_OF_MEMORY|Out of memory while trying to allocate")
+
+
+def read_log(path):
+    entries = []
+    with open(path, "r", errors="replace") as f:
+        for line in f:
+            timestamp, _, message = line.rstrip("\n").partition("\t")
+            entries.append((timestamp, message))
+    return entries
+
+def job_segment(entries, name):
+    """
+    Lines belonging to one fold job when several jobs ran in a single run_alphafold.py call
+    ("Running fold job <name>..." up to "Fold job <name> done"). Falls back to the whole log.
+    """
+    start = end = None
+    for i, (_, message) in enumerate(entries):
+        if start is None and f"Running fold job {name}..." in message:
+            start = i
+        elif start is not None and f"Fold job {name} done" in message:
+            end = i
+            break
+    if start is None:
+        # Only attribute the whole log to this job if it is not split into fold jobs at all
+        if any("Running fold job " in message for _, message in entries):
+            return [], False
+        return entries, False
+    return entries[start:(end + 1 if end is not None else len(entries))], end is not None
+
+def seconds_between(start, end):
+    try:
+        return (datetime.strptime(end, TIME_FORMAT) - datetime.strptime(start, TIME_FORMAT)).total_seconds()
+    except (TypeError, ValueError):
+        return None
+
+def startup_seconds(entries, launch_time):
+    """Container start and AlphaFold initialisation: from the launch until the first fold job starts."""
+    for timestamp, message in entries:
+        if "Running fold job " in message:
+            return seconds_between(launch_time, timestamp)
+    return None
+
+def job_summary(entries, name, launch_time=None):
+    segment, complete = job_segment(entries, name)
+    summary = {"start_time": None, "end_time": None, "bucket_size": None, "tokens": None, "completed": complete,
+               "inference_seconds": [], "compile_seconds": None, "seeds_inferred": [], "oom": False,
+               "startup_seconds": startup_seconds(entries, launch_time) if launch_time else None,
+               "featurisation_seconds": None, "model_seconds": None, "extraction_seconds": None, "output_seconds": None}
+    output_start = None
+    if segment and segment is not entries:
+        summary["start_time"] = segment[0][0]
+        summary["end_time"] = segment[-1][0]
+    for timestamp, message in segment:
+        match = BUCKET_REGEX.search(message)
+        if match and summary["bucket_size"] is None:
+            summary["bucket_size"] = int(match.group(1))
+            summary["tokens"] = int(match.group(2))
+        match = SEED_INFERENCE_REGEX.search(message)
+        if match:
+            summary["seeds_inferred"].append(int(match.group(1)))
+            summary["inference_seconds"].append(float(match.group(2)))
+        match = FEATURISATION_REGEX.search(message)
+        if match:
+            summary["featurisation_seconds"] = float(match.group(1))
+        match = EXTRACTION_REGEX.search(message)
+        if match:
+            summary["extraction_seconds"] = round((summary["extraction_seconds"] or 0) + float(match.group(1)), 2)
+        if OUTPUT_START in message and output_start is None:
+            output_start = timestamp
+        if OOM_REGEX.search(message):
+            summary["oom"] = True
+    # Writing the outputs has no timing line of its own (second resolution of the log timestamps)
+    if output_start is not None and complete:
+        summary["output_seconds"] = seconds_between(output_start, segment[-1][0])
+    # The first seed includes JAX compilation (unless served from the compilation cache)
+    seconds = summary["inference_seconds"]
+    if len(seconds) >= 2:
+        summary["compile_seconds"] = round(max(0.0, seconds[0] - min(seconds[1:])), 2)
+    # Model inference of all seeds without the compilation
+    if seconds:
+        summary["model_seconds"] = round(sum(seconds) - (summary["compile_seconds"] or 0), 2)
+    return summary
+
+def main():
+    if len(sys.argv) not in (3, 4):
+        print(f"Usage: python {sys.argv[0]} <timestamped_log> <inference_name> [<launch_time>]", file=sys.stderr)
+        sys.exit(1)
+    print(json.dumps(job_summary(read_log(sys.argv[1]), sys.argv[2], sys.argv[3] if len(sys.argv) == 4 else None)))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,658 @@
+import os
+import sys
+import json
+import argparse
+import itertools
+import subprocess
+from collections import Counter
+from job_plan import (load_plan, save_plan, plan_width, plan_record, bucket_index, decode, read_record, seed_mask,
+                      link_monomer_dirs, job_count, materialize, TableWriter, TABLE_FILE, PLAN_FILE)
+from run_ledger import SACCT_REASONS, load_ledger, append_records, counts
+from monomer_manifest import load_manifest, is_current
+from monomer_store import link_run, normalize_sequence
+from walltime_predictor import load_model
+from datapipeline_sizing import load_arrays, array_of
+
+STATE_FILE = "stream_state.json"
+CONTROLLER_JOBS = 1  # submit slots kept free for the controller's own resubmission
+DEFAULT_MAX_RETRIES = 2  # per failed job (cluster config max_retries)
+
+
+class SlurmCLI:
+    """SLURM access through the sbatch/squeue commands (a fake pair earlier in PATH works for testing)."""
+
+    def sbatch(self, args):
+        """Submit and return the job ID."""
+        out = subprocess.run(["sbatch", "--parsable"] + args, check=True, capture_output=True, text=True).stdout
+        return out.strip().split(";")[0]
+
+    def active_tasks(self, job_ids):
+        """Number of pending or running array tasks per job ID (jobs without active tasks are left out)."""
+        if not job_ids:
+            return {}
+        out = subprocess.run(["squeue", "-h", "-r", "-o", "%F", "-j", ",".join(job_ids)],
+                             capture_output=True, text=True).stdout
+        return dict(Counter(line for line in out.split() if line in job_ids))
+
+    def task_states(self, job_id):
+        """Final state per array task index of a job from the accounting (sacct); empty without accounting."""
+        try:
+            out = subprocess.run(["sacct", "-n", "-P", "-X", "-j", job_id, "-o", "JobID,State"],
+                                 capture_output=True, text=True).stdout
+        except OSError:
+            return {}
+        states = {}
+        for line in out.splitlines():
+            task_id, _, task_state = line.partition("|")
+            index = task_id.partition("_")[2]
+            if index.isdigit() and task_state:
+                states[int(index)] = task_state.split()[0]  # "CANCELLED by <uid>"
+        return states
+
+def load_state(run_dir, profiles):
+    state = {
+        "ready": [],
+        "released": {p: 0 for p in profiles},
+        "submitted": {p: 0 for p in profiles},
+        # [bucket, first id, last id, seeds per job (None = all)] of released jobs, in ID order
+        "segments": {p: [] for p in profiles},
+        "too_big": 0,
+        "dp_next": 0,
+        "dp_retry": [],  # DATA_PIPELINE_IDs to submit again
+        "retries": {},  # retry_key -> attempt of jobs that are retries
+        "arrays": [],  # submitted arrays that may still have active tasks
+    }
+    try:
+        with open(os.path.join(run_dir, STATE_FILE), "r") as f:
+            state.update(json.load(f))
+    except FileNotFoundError:
+        pass
+    # profiles added for promoted jobs after the state was last saved (the plan is saved first)
+    for profile in profiles:
+        state["released"].setdefault(profile, 0)
+        state["submitted"].setdefault(profile, 0)
+        state["segments"].setdefault(profile, [])
+    return state
+
+def save_state(run_dir, state):
+    tmp_path = os.path.join(run_dir, STATE_FILE + ".tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(state, f)
+    os.replace(tmp_path, os.path.join(run_dir, STATE_FILE))
+
+def retry_key(key):
+    stage, profile, job_id = key
+    return f"{stage}:{profile or ''}:{job_id}"
+
+def add_segment(state, profile, bucket, job_id, num_seeds=None, join=True):
+    """Append a released INFERENCE_ID to the profile's segments (one array per segment)."""
+    segments = state["segments"][profile]
+    if (join and segments and segments[-1][0] == bucket and segments[-1][3] == num_seeds
+            and segments[-1][2] == job_id - 1):
+        segments[-1][2] = job_id
+    else:
+        segments.append([bucket, job_id, job_id, num_seeds])
+
+def ready_monomers(plan, names):
+    """Names whose _data.json matches the manifest (MSAs and templates are written before it)."""
+    manifest = load_manifest(plan["monomer_dir"])
+    return {name for name in names if is_current(manifest.get(name), plan["monomer_dir"])}
+
+def same_sequence(plan, names, ready):
+    """Names that share their sequence with a ready protein; they are linked from the monomer store, not searched."""
+    ready_sequences = {normalize_sequence(plan["sequences"][name]) for name in ready}
+    return {name for name in names if normalize_sequence(plan["sequences"][name]) in ready_sequences}
+
+def released_combinations(plan, ready, new):
+    """
+    Protein position tuples that become runnable when the proteins in new finish, given the already ready ones.
+    Every job is released exactly once: with the last of its proteins. Jobs with the same proteins become
+    runnable together, so deduplication within one protein's step keeps the first one in product order,
+    just like the job generation without streaming.
+    """
+    key_lists = plan["dimensions"]
+    ready = set(ready)
+    for name in sorted(new):
+        ready.add(name)
+        candidates = []
+        if plan["mode"] == "cartesian":
+            for d, keys in enumerate(key_lists):
+                if name not in keys:
+                    continue
+                choices = []
+                for e, other in enumerate(key_lists):
+                    if e == d:
+                        choices.append([keys.index(name)])
+                    else:
+                        # earlier dimensions must not contain name, otherwise that dimension produces the tuple
+                        choices.append([i for i, key in enumerate(other) if key in ready and (e > d or key != name)])
+                candidates.extend(itertools.product(*choices))
+        else:
+            for d, keys in enumerate(key_lists):
+                if name in keys and all(key in ready for key in keys):
+                    candidates.append((d,))
+        seen = set()
+        for positions in sorted(candidates):
+            names = [key_lists[d][i] for d, i in enumerate(positions)] if plan["mode"] == "cartesian" else key_lists[positions[0]]
+            canon = tuple(sorted(names))
+            if canon not in seen:
+                seen.add(canon)
+                yield positions, names
+
+def release(run_dir, plan, state, new):
+    """Append the jobs that became runnable to the index tables. Returns {profile: number of released jobs}."""
+    buckets = plan["buckets"]
+    sequences = plan["sequences"]
+    compound_atoms = [c["Atoms"] for c in plan["compounds"]] or [0]
+    batch = {p: [] for p in plan["profiles"]}
+    for order, (positions, names) in enumerate(released_combinations(plan, state["ready"], new)):
+        protein_tokens = sum(len(sequences[n]) for n in names)
+        for c_idx, atoms in enumerate(compound_atoms):
+            token_size = protein_tokens + atoms
+            for profile, info in plan["profiles"].items():
+                if not info.get("promotion") and token_size <= info["max"]:
+                    batch[profile].append((bucket_index(token_size, buckets), order, tuple(positions) + (c_idx,)))
+                    break
+            else:
+                state["too_big"] += 1
+
+    width = plan_width(plan)
+    released = {}
+    for profile, jobs in batch.items():
+        if not jobs:
+            continue
+        writer = TableWriter(os.path.join(run_dir, profile, TABLE_FILE), width, append=True)
+        for b, _, record in sorted(jobs):
+            writer.append(record + (0,))  # seed mask 0: all seeds
+            add_segment(state, profile, buckets[b] if b < len(buckets) else None, state["released"][profile])
+            state["released"][profile] += 1
+        writer.close()
+        released[profile] = len(jobs)
+    state["ready"] = sorted(set(state["ready"]) | set(new))
+    return released
+
+def next_profile(cluster_conf, profile):
+    """Next larger GPU profile of the cluster config (by token_limit, then enable_xla); None for the largest."""
+    profiles = cluster_conf["gpu_profiles"]
+    def size(p):
+        return profiles[p]["token_limit"], bool(profiles[p].get("enable_xla", False))
+    larger = [p for p in profiles if size(p) > size(profile)]
+    return min(larger, key=size) if larger else None
+
+def add_profile(run_dir, plan, state, profile):
+    """Make a GPU profile that was not selected for the run available for promoted jobs (never for new jobs)."""
+    link_monomer_dirs(os.path.join(run_dir, profile), plan["monomer_dir"])
+    open(os.path.join(run_dir, profile, TABLE_FILE), "ab").close()
+    plan["profiles"][profile] = {"min": None, "max": None, "jobs": 0, "windows": [], "promotion": True}
+    save_plan(run_dir, plan)
+    state["released"].setdefault(profile, 0)
+    state["submitted"].setdefault(profile, 0)
+    state["segments"].setdefault(profile, [])
+
+def settle(slurm, array, ledger):
+    """Ledger records for the tasks of a finished array that ended without writing their own (killed by SLURM)."""
+    stage, profile = array["stage"], array["profile"]
+    silent = [job_id for job_id in range(array["first"], array["last"] + 1)
+              if ledger.get((stage, profile, job_id), {"state": "queued"})["state"] == "queued"]
+    if not silent:
+        return []
+    task_states = slurm.task_states(array["job"])
+    records = []
+    for job_id in silent:
+        task = (job_id - array["first"]) // array.get("pack", 1)
+        records.append({"stage": stage, "profile": profile, "id": job_id, "state": "failed",
+                        "reason": SACCT_REASONS.get(task_states.get(task), "lost"),
+                        "array_job": array["job"], "array_task": task,
+                        "merge_into": ledger.get((stage, profile, job_id), {}).get("merge_into")})
+    return records
+
+def requeue(run_dir, plan, state, ledger, cluster_conf):
+    """
+    Queue a retry for every failed job, at most max_retries times per job. Returns the ledger records to append.
+    Data pipeline jobs are submitted again. Inference jobs are appended to an index table again: jobs that ran out
+    of GPU memory to the next larger GPU profile, jobs that timed out split into two halves of their missing seeds
+    (with the configured maximum walltime). Seeds whose results were written are not run again.
+    Retries add their results to the result directory of the failed job (merge_into), so that all seeds of a job
+    end up in one directory; jobs that failed without a record use results/<PIPELINE_RUN_ID>_retries.
+    """
+    max_retries = int(cluster_conf.get("max_retries", DEFAULT_MAX_RETRIES))
+    buckets = plan["buckets"]
+    writers = {}
+    records = []
+    for key, failed in sorted(ledger.items(), key=lambda item: str(item[0])):
+        if failed["state"] != "failed":
+            continue
+        stage, profile, job_id = key
+        reason = failed.get("reason") or "error"
+        attempt = state["retries"].get(retry_key(key), 0)
+        base = {"stage": stage, "profile": profile, "id": job_id, "name": failed.get("name"),
+                "merge_into": failed.get("merge_into")}
+        target = next_profile(cluster_conf, profile) if reason == "oom" else profile
+        if attempt >= max_retries or (stage == "inference" and target is None):
+            detail = "no larger GPU profile" if attempt < max_retries else f"failed {attempt + 1} times"
+            records.append(dict(base, state="abandoned", reason=reason, detail=detail))
+            print(f"Warning: giving up {stage} job {profile or ''} {job_id} ({reason}, {detail}).", file=sys.stderr)
+            continue
+        if stage == "datapipeline":
+            state["dp_retry"].append(job_id)
+            state["retries"][retry_key(key)] = attempt + 1
+            records.append(dict(base, state="queued", reason=reason, attempt=attempt + 1))
+            continue
+
+        names, compound, seeds = decode(plan, run_dir, profile, job_id)
+        done = set(failed.get("seeds_done") or [])
+        missing = [seed for seed in seeds if seed not in done] or seeds
+        if len(plan["seeds"]) > 32:
+            parts = [plan["seeds"]]  # no seed masks
+        elif reason == "timeout" and len(missing) > 1:
+            parts = [missing[:len(missing) // 2], missing[len(missing) // 2:]]
+        else:
+            parts = [missing]
+        if target not in plan["profiles"]:
+            add_profile(run_dir, plan, state, target)
+        if target not in writers:
+            writers[target] = TableWriter(os.path.join(run_dir, target, TABLE_FILE), plan_width(plan),
+                                          append=True)
+        positions = read_record(plan, run_dir, profile, job_id)[:-1]
+        tokens = sum(len(plan["sequences"][n]) for n in names) + (compound["Atoms"] if compound else 0)
+        b = bucket_index(tokens, buckets)
+        if failed.get("merge_into"):
+            merge_into = failed["merge_into"]  # a retry that failed again
+        elif failed.get("result_dir"):
+            merge_into = os.path.dirname(failed["result_dir"])
+        else:
+            merge_into = os.path.abspath(os.path.join("results", f"{os.path.basename(os.path.normpath(run_dir))}_retries"))
+        retries = []
+        for k, part in enumerate(parts):
+            new_id = state["released"][target]
+            writers[target].append(positions + (seed_mask(plan["seeds"], part),))
+            state["released"][target] += 1
+            # bucket None: the walltime prediction falls back to the configured limit; parts of a job never share
+            # a task (AlphaFold writes jobs of the same name to different directories)
+            add_segment(state, target, None if reason == "timeout" or b >= len(buckets) else buckets[b], new_id, len(part),
+                        join=k == 0)
+            state["retries"][retry_key(("inference", target, new_id))] = attempt + 1
+            records.append({"stage": "inference", "profile": target, "id": new_id, "name": failed.get("name"),
+                            "state": "queued", "attempt": attempt + 1, "seeds": part,
+                            "retry_of": {"profile": profile, "id": job_id}, "merge_into": merge_into})
+            retries.append({"profile": target, "id": new_id})
+        records.append(dict(base, state="retried", reason=reason, retries=retries))
+        retry_ids = ", ".join(str(r["id"]) for r in retries)
+        print(f"Retrying {profile} inference job {job_id} ({reason}) as {target} job(s) {retry_ids}.", file=sys.stderr)
+    for writer in writers.values():
+        writer.close()
+    return records
+
+def truncate_tables(run_dir, plan, state):
+    """Drop records appended by a controller that died before saving its state (they are released again)."""
+    record_size = plan_record(plan).size
+    for profile in plan["profiles"]:
+        path = os.path.join(run_dir, profile, TABLE_FILE)
+        if os.path.getsize(path) > state["released"][profile] * record_size:
+            os.truncate(path, state["released"][profile] * record_size)
+
+def jobs_per_task(requested, results_per_dir):
+    """Largest pack size <= JOBS_PER_TASK that divides RESULTS_PER_DIR."""
+    pack = max(1, requested)
+    while results_per_dir % pack != 0:
+        pack -= 1
+    return pack
+
+def gpu_type_of(profile_conf):
+    # removing hardcoded amount of gpus because we can only utilize 1 (as in submit_data_pipeline_part_2.sh)
+    prefix, _, count = profile_conf["gres"].rpartition(":")
+    gpu_type = prefix if prefix and count.isdigit() else profile_conf["gres"]
+    return gpu_type if gpu_type.startswith("gpu") else f"gpu:{gpu_type}"
+
+def submit_datapipeline(slurm, env, sizing, first, last, pack):
+    """Submit DATA_PIPELINE_IDs first-last as one array of pack monomers per task with the resources of their class."""
+    exports = {"START_OFFSET": 0, "DP_RANGE_START": first, "DP_RANGE_END": last, "DP_JOBS_PER_TASK": pack,
+               "CONTROLLER_MANAGED": "true"}
+    minutes = sizing["minutes"] // sizing["pack"] * pack
+    job_id = slurm.sbatch([
+        f"--array=0-{(last - first + pack) // pack - 1}",
+        f"--partition={env['DATAPIPELINE_PARTITION']}",
+        f"--cpus-per-task={sizing['cpus']}",
+        f"--mem={sizing['mem_gb']}G",
+        f"--time={minutes}",
+        "--export=ALL," + ",".join(f"{k}={v}" for k, v in exports.items()),
+        "utilities/af3_datapipeline_only_slurm.sh",
+    ])
+    print(f"Submitted data pipeline jobs {first}-{last} ({pack} per task, {minutes} min per task): job {job_id}",
+          file=sys.stderr)
+    return {"job": job_id, "stage": "datapipeline", "profile": None, "first": first, "last": last, "pack": pack}
+
+def submit_inference(slurm, env, cluster_conf, model, profile, bucket, first, last, pack, num_seeds=None):
+    """Submit the INFERENCE_IDs first-last of a profile as one array of pack jobs per task (of num_seeds seeds)."""
+    profile_conf = cluster_conf["gpu_profiles"][profile]
+    num_seeds = num_seeds or len([s for s in env["SEEDS"].split(",") if s.strip()])
+    gpu_time = model.predict(profile, bucket, num_seeds, profile_conf["max_minutes_per_seed"] * num_seeds)
+    gpu_type = gpu_type_of(profile_conf)
+    exports = {
+        "RANGE_START": first, "RANGE_END": last, "START_OFFSET": 0, "TOTAL_INFERENCE_JOBS": last + 1,
+        "GPU_PROFILE": profile, "GPU_TYPE": gpu_type, "ENABLE_XLA": str(profile_conf.get("enable_xla", False)).lower(),
+        "GPU_TIME": gpu_time * pack, "JOBS_PER_TASK": pack, "CONTROLLER_MANAGED": "true",
+    }
+    job_id = slurm.sbatch([
+        f"--array=0-{(last - first + pack) // pack - 1}",
+        f"--partition={env['INFERENCE_PARTITION']}",
+        f"--gres={gpu_type}:1",
+        f"--time={gpu_time * pack}",
+        "--export=ALL," + ",".join(f"{k}={v}" for k, v in exports.items()),
+        "utilities/af3_inference_only_slurm.sh",
+    ])
+    print(f"Submitted {profile} inference jobs {first}-{last} (bucket {bucket}, {gpu_time * pack} min per task): "
+          f"job {job_id}", file=sys.stderr)
+    return {"job": job_id, "stage": "inference", "profile": profile, "first": first, "last": last, "pack": pack}
+
+def tick(run_dir, slurm, env, cluster_conf, ready_func=None):
+    """
+    One controller step:
+    - forget arrays without active tasks and count the active ones (tasks that did not report are failed),
+    - queue retries for failed jobs,
+    - release the inference jobs whose monomers finished since the last step,
+    - top up the queue to MAX_SUBMIT_JOBS array tasks, data pipeline first (it unblocks inference),
+      in arrays of at most MAX_ARRAY_SIZE tasks.
+    Returns True once every job was submitted and no submitted task is left in the queue.
+    """
+    plan = load_plan(run_dir)
+    state = load_state(run_dir, plan["profiles"])
+    truncate_tables(run_dir, plan, state)
+    max_array = int(env.get("MAX_ARRAY_SIZE", 1000))
+    max_submit = int(env.get("MAX_SUBMIT_JOBS") or max_array)
+    total_dp = int(env.get("TOTAL_DATAPIPELINE_JOBS", 0))
+    pack = jobs_per_task(int(env.get("JOBS_PER_TASK", 1)), int(env["RESULTS_PER_DIR"]))
+
+    active = slurm.active_tasks([a["job"] for a in state["arrays"]])
+    ledger = load_ledger(run_dir)
+    settled = []
+    for array in state["arrays"]:
+        if not active.get(array["job"]):
+            settled.extend(settle(slurm, array, ledger))
+    if settled:
+        append_records(run_dir, settled)
+        ledger = load_ledger(run_dir)
+    state["arrays"] = [a for a in state["arrays"] if active.get(a["job"])]
+    in_flight = sum(active.values())
+    dp_running = any(a["stage"] == "datapipeline" for a in state["arrays"])
+    budget = max(0, max_submit - CONTROLLER_JOBS - in_flight)
+
+    retry_records = requeue(run_dir, plan, state, ledger, cluster_conf)
+    if retry_records:
+        # state first: a controller dying in between queues the retries again instead of losing them
+        save_state(run_dir, state)
+        append_records(run_dir, retry_records)
+
+    # Data pipeline: checked before the readiness check, so that a finished data pipeline means final monomers
+    dp_finished = state["dp_next"] >= total_dp and not dp_running and not state["dp_retry"]
+    dp_arrays = load_arrays(run_dir) if total_dp else []
+    while state["dp_next"] < total_dp and budget > 0:
+        sizing = array_of(dp_arrays, state["dp_next"])
+        first, dp_pack = state["dp_next"], sizing["pack"]
+        last = min(sizing["last"], first + min(budget, max_array) * dp_pack - 1)
+        state["arrays"].append(submit_datapipeline(slurm, env, sizing, first, last, dp_pack))
+        state["dp_next"] = last + 1
+        budget -= (last - first + dp_pack) // dp_pack
+    while state["dp_retry"] and budget > 0:
+        job_id = state["dp_retry"].pop(0)
+        state["arrays"].append(submit_datapipeline(slurm, env, array_of(dp_arrays, job_id), job_id, job_id, 1))
+        budget -= 1
+
+    all_names = set(plan["sequences"])
+    missing = all_names - set(state["ready"])
+    if ready_func is None:
+        new = ready_monomers(plan, missing)
+        # Proteins sharing a sequence with a finished one are linked from the monomer store; only those are looked up
+        linkable = same_sequence(plan, missing - new, set(state["ready"]) | new)
+        if linkable and env.get("INPUT_FILE") and env.get("CLUSTER_CONFIG"):
+            link_run(env["INPUT_FILE"], env["CLUSTER_CONFIG"], plan["monomer_dir"], linkable)
+            new |= ready_monomers(plan, linkable)
+    else:
+        new = ready_func(plan, missing)
+    if new:
+        release(run_dir, plan, state, new)
+
+    # Inference: released but unsubmitted jobs, one array per bucket segment (walltime per bucket)
+    model = load_model(env.get("INFERENCE_STATISTICS_FILE"), cluster_conf)
+    for profile in plan["profiles"]:
+        for bucket, seg_first, seg_last, num_seeds in state["segments"][profile]:
+            while budget > 0 and seg_first <= state["submitted"][profile] <= seg_last:
+                first = state["submitted"][profile]
+                last = min(seg_last, first + min(budget, max_array) * pack - 1)
+                state["arrays"].append(submit_inference(slurm, env, cluster_conf, model, profile, bucket, first, last, pack,
+                                                        num_seeds))
+                state["submitted"][profile] = last + 1
+                budget -= (last - first + pack) // pack
+        # segments that are completely submitted are not needed anymore
+        state["segments"][profile] = [seg for seg in state["segments"][profile] if seg[2] >= state["submitted"][profile]]
+    save_state(run_dir, state)
+
+    finished = counts(load_ledger(run_dir))
+    released = sum(state["released"].values())
+    unsubmitted = released - sum(state["submitted"].values())
+    print(f"{len(state['ready'])}/{len(all_names)} monomers ready, data pipeline {state['dp_next']}/{total_dp} submitted "
+          f"({finished['datapipeline', 'done']} done, {finished['datapipeline', 'queued']} retrying, "
+          f"{finished['datapipeline', 'abandoned']} given up), inference {released} released, {unsubmitted} waiting "
+          f"({finished['inference', 'done']} done, {finished['inference', 'retried']} retried, "
+          f"{finished['inference', 'abandoned']} given up), {in_flight} task(s) in queue", file=sys.stderr)
+
+    if not dp_finished or new or unsubmitted or state["arrays"]:
+        return False
+    still_missing = all_names - set(state["ready"])
+    if still_missing:
+        print(f"Warning: no monomer data for {len(still_missing)} protein(s) after the data pipeline finished: "
+              f"{', '.join(sorted(still_missing))}", file=sys.stderr)
+    print(f"All runnable jobs finished: {finished['inference', 'done']} done, {finished['inference', 'abandoned']} "
+          f"given up ({state['too_big']} too big).", file=sys.stderr)
+    if finished["datapipeline", "abandoned"] or finished["inference", "abandoned"]:
+        print("Jobs that were given up can be retried with: bash utilities/resume_run.sh "
+              f"{os.path.basename(os.path.normpath(run_dir))}", file=sys.stderr)
+    return True
+
+def resume(run_dir):
+    """
+    Prepare a finished or interrupted streaming run for a new controller: jobs that were given up get a new set of
+    retries and submitted jobs without any record are marked as lost, the next tick queues both again.
+    Completed jobs and seeds are never submitted again. Returns the number of jobs to retry.
+    """
+    plan = load_plan(run_dir)
+    state = load_state(run_dir, plan["profiles"])
+    ledger = load_ledger(run_dir)
+    # jobs of arrays in the state are settled by the next tick
+    tracked = {(a["stage"], a["profile"], job_id) for a in state["arrays"] for job_id in range(a["first"], a["last"] + 1)}
+    keys = [("datapipeline", None, job_id) for job_id in range(state["dp_next"]) if job_id not in state["dp_retry"]]
+    keys += [("inference", profile, job_id) for profile in plan["profiles"] for job_id in range(state["submitted"][profile])]
+    records = []
+    for key in keys:
+        record = ledger.get(key)
+        if key in tracked or (record and record["state"] not in ("queued", "abandoned")):
+            continue
+        stage, profile, job_id = key
+        reason = record.get("reason", "lost") if record and record["state"] == "abandoned" else "lost"
+        state["retries"].pop(retry_key(key), None)
+        records.append({"stage": stage, "profile": profile, "id": job_id, "name": (record or {}).get("name"),
+                        "state": "failed", "reason": reason, "resumed": True,
+                        "merge_into": (record or {}).get("merge_into")})
+    save_state(run_dir, state)
+    append_records(run_dir, records)
+    return len(records)
+
+def array_spec(indices):
+    """--array value for sorted task indices, e.g. '0-2,5,7-8'."""
+    ranges = []
+    for index in indices:
+        if ranges and ranges[-1][1] == index - 1:
+            ranges[-1][1] = index
+        else:
+            ranges.append([index, index])
+    return ",".join(str(a) if a == b else f"{a}-{b}" for a, b in ranges)
+
+def task_windows(indices, max_array):
+    """(START_OFFSET, task indices relative to it) per window of MAX_ARRAY_SIZE tasks (SLURM limits the index)."""
+    windows = {}
+    for index in sorted(indices):
+        windows.setdefault(index // max_array * max_array, []).append(index % max_array)
+    return sorted(windows.items())
+
+def job_files(run_dir, profile):
+    """INFERENCE_ID -> pending job JSON of a profile (removed once the job succeeded)."""
+    files = {}
+    for entry in os.listdir(os.path.join(run_dir, profile)):
+        prefix = entry.partition("_")[0]
+        if prefix.isdigit() and entry.endswith(".json"):
+            files[int(prefix)] = os.path.join(run_dir, profile, entry)
+    return files
+
+def unfinished(ledger, key):
+    """Reason to run a job again ("lost" if it never wrote a record), None if it is done or was moved."""
+    record = ledger.get(key)
+    if record is None or record["state"] == "queued":
+        return "lost"
+    if record["state"] in ("failed", "abandoned"):
+        return record.get("reason") or "error"
+    return None
+
+def merge_target(record):
+    """Result directory of a failed job that its next attempt adds its seeds to (see requeue)."""
+    if record.get("merge_into"):
+        return record["merge_into"]
+    return os.path.dirname(record["result_dir"]) if record.get("result_dir") else None
+
+def resume_batch(run_dir, slurm, env, cluster_conf):
+    """
+    Resubmit the unfinished jobs of a run without streaming from its ledger. Jobs that failed, were given up or never
+    wrote a record run again under their own ID, as arrays that list only their task indices; jobs that ran out of
+    GPU memory move to the next larger GPU profile. Retries add their seeds to the result directory of the failed
+    job. If the data pipeline did not finish, its unfinished jobs are submitted, followed by the second stage.
+    Returns the number of resubmitted jobs.
+    """
+    ledger = load_ledger(run_dir)
+    max_array = int(env.get("MAX_ARRAY_SIZE", 1000))
+    records = []
+    profiles = [p for p in cluster_conf["gpu_profiles"] if os.path.isdir(os.path.join(run_dir, p))]
+    if not profiles:
+        # The second stage did not run: it waits for the data pipeline (afterok) like the first submission
+        total_dp = int(env.get("TOTAL_DATAPIPELINE_JOBS", 0))
+        missing = [job_id for job_id in range(total_dp) if unfinished(ledger, ("datapipeline", None, job_id))]
+        arrays = load_arrays(run_dir) if missing else []
+        dp_jobs = []
+        for sizing in arrays:
+            indices = [job_id - sizing["first"] for job_id in missing if sizing["first"] <= job_id <= sizing["last"]]
+            for offset, window in task_windows(indices, max_array):
+                exports = {"START_OFFSET": offset, "DP_RANGE_START": sizing["first"], "DP_RANGE_END": sizing["last"],
+                           "DP_JOBS_PER_TASK": 1, "RESUMED": "true"}
+                dp_jobs.append(slurm.sbatch([
+                    f"--array={array_spec(window)}",
+                    f"--partition={env['DATAPIPELINE_PARTITION']}",
+                    f"--cpus-per-task={sizing['cpus']}",
+                    f"--mem={sizing['mem_gb']}G",
+                    f"--time={sizing['minutes'] // sizing['pack']}",
+                    "--export=ALL," + ",".join(f"{k}={v}" for k, v in exports.items()),
+                    "utilities/af3_datapipeline_only_slurm.sh",
+                ]))
+        records += [{"stage": "datapipeline", "profile": None, "id": job_id, "state": "queued", "resumed": True}
+                    for job_id in missing]
+        append_records(run_dir, records)
+        dependency = [f"--dependency=afterok:{':'.join(dp_jobs)}"] if dp_jobs else []
+        part_2 = slurm.sbatch(dependency + ["utilities/submit_data_pipeline_part_2.sh"])
+        print(f"Resubmitted {len(missing)} data pipeline job(s), second stage: job {part_2}", file=sys.stderr)
+        return len(missing)
+
+    plan = load_plan(run_dir) if os.path.exists(os.path.join(run_dir, PLAN_FILE)) else None
+    seeds = [s for s in env["SEEDS"].split(",") if s.strip()]
+    per_task = int(env.get("SEEDS_PER_TASK") or 0)
+    shard_seeds = per_task if 0 < per_task < len(seeds) else len(seeds)
+    seed_shards = (len(seeds) + shard_seeds - 1) // shard_seeds
+
+    def virtual_count(profile):
+        return job_count(plan, run_dir, profile) if plan and profile in plan["profiles"] else 0
+
+    files = {profile: job_files(run_dir, profile) for profile in profiles}
+    next_id = {}
+    def new_id(profile):
+        """INFERENCE_ID after all jobs of a profile (virtual, pending files and ledger)."""
+        if profile not in next_id:
+            used = [job_id for stage, p, job_id in ledger if stage == "inference" and p == profile]
+            used += list(files.get(profile, {})) + [virtual_count(profile) - 1]
+            next_id[profile] = max(used) + 1
+        next_id[profile] += 1
+        return next_id[profile] - 1
+
+    resubmit = {}  # (profile, virtual) -> INFERENCE_IDs
+    for profile in profiles:
+        for job_id in sorted(set(range(virtual_count(profile))) | set(files[profile])):
+            key = ("inference", profile, job_id)
+            reason = unfinished(ledger, key)
+            if reason is None:
+                continue
+            record = ledger.get(key) or {}
+            base = {"stage": "inference", "profile": profile, "id": job_id, "name": record.get("name"),
+                    "merge_into": merge_target(record)}
+            virtual = job_id < virtual_count(profile)
+            if reason != "oom":
+                resubmit.setdefault((profile, virtual), []).append(job_id)
+                records.append(dict(base, state="queued", reason=reason, resumed=True))
+                continue
+            target = next_profile(cluster_conf, profile)
+            if target is None:
+                records.append(dict(base, state="abandoned", reason=reason, detail="no larger GPU profile"))
+                print(f"Warning: giving up {profile} inference job {job_id} (oom, no larger GPU profile).", file=sys.stderr)
+                continue
+            # The job moves to the larger profile as a pending JSON with a new INFERENCE_ID
+            source = files[profile].get(job_id) or materialize(run_dir, profile, job_id)
+            link_monomer_dirs(os.path.join(run_dir, target))
+            target_id = new_id(target)
+            os.replace(source, os.path.join(run_dir, target, f"{target_id}_{os.path.basename(source).partition('_')[2]}"))
+            resubmit.setdefault((target, False), []).append(target_id)
+            records.append(dict(base, state="retried", reason=reason, retries=[{"profile": target, "id": target_id}]))
+            records.append(dict(base, profile=target, id=target_id, state="queued", resumed=True,
+                                retry_of={"profile": profile, "id": job_id}))
+            print(f"Moving {profile} inference job {job_id} (oom) to {target} job {target_id}.", file=sys.stderr)
+    append_records(run_dir, records)
+
+    for (profile, virtual), job_ids in sorted(resubmit.items()):
+        profile_conf = cluster_conf["gpu_profiles"][profile]
+        gpu_time = profile_conf["max_minutes_per_seed"] * shard_seeds
+        gpu_type = gpu_type_of(profile_conf)
+        indices = [job_id * seed_shards + shard for job_id in job_ids for shard in range(seed_shards)]
+        for offset, window in task_windows(indices, max_array):
+            exports = {
+                "RANGE_START": 0, "RANGE_END": max(job_ids), "START_OFFSET": offset, "TOTAL_INFERENCE_JOBS": max(job_ids) + 1,
+                "GPU_PROFILE": profile, "GPU_TYPE": gpu_type, "ENABLE_XLA": str(profile_conf.get("enable_xla", False)).lower(),
+                "GPU_TIME": gpu_time, "JOBS_PER_TASK": 1, "VIRTUAL_JOBS": str(virtual).lower(), "RESUMED": "true",
+            }
+            job = slurm.sbatch([
+                f"--array={array_spec(window)}",
+                f"--partition={env['INFERENCE_PARTITION']}",
+                f"--gres={gpu_type}:1",
+                f"--time={gpu_time}",
+                "--export=ALL," + ",".join(f"{k}={v}" for k, v in exports.items()),
+                "utilities/af3_inference_only_slurm.sh",
+            ])
+            print(f"Resubmitted {len(window) // seed_shards} {profile} inference job(s): job {job}", file=sys.stderr)
+    return sum(len(job_ids) for job_ids in resubmit.values())
+
+def main():
+    parser = argparse.ArgumentParser(description="Streaming mode: submit data pipeline and inference jobs, "
+                                                 "inference as soon as its monomers are ready.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    p_tick = subparsers.add_parser("tick", help="Release and submit runnable jobs; prints 'done' or 'waiting'")
+    p_tick.add_argument("run_dir", help="pending_jobs/<PIPELINE_RUN_ID>")
+    p_resume = subparsers.add_parser("resume", help="Queue lost and given up jobs again (run before a new controller)")
+    p_resume.add_argument("run_dir", help="pending_jobs/<PIPELINE_RUN_ID>")
+    p_batch = subparsers.add_parser("resume-batch", help="Resubmit failed and lost jobs of a run without streaming")
+    p_batch.add_argument("run_dir", help="pending_jobs/<PIPELINE_RUN_ID>")
+    args = parser.parse_args()
+
+    if args.command == "resume":
+        print(f"{resume(args.run_dir)} job(s) queued for retry", file=sys.stderr)
+        return
+    with open(os.environ["CLUSTER_CONFIG"], "r") as f:
+        cluster_conf = json.load(f)
+    if args.command == "tick":
+        print("done" if tick(args.run_dir, SlurmCLI(), os.environ, cluster_conf) else "waiting")
+    elif args.command == "resume-batch":
+        print(f"{resume_batch(args.run_dir, SlurmCLI(), os.environ, cluster_conf)} job(s) resubmitted", file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,38 @@
+#!/usr/bin/env bash
+#SBATCH --job-name=AF3_controller
+#SBATCH --time=00:30:00
+#SBATCH --output=slurm-output/slurm-%j-%x.out # %j (Job ID) %x (Job Name)
+
+# Streaming mode (STREAMING=true): replaces submit_data_pipeline_part_2.sh. Every run of this job releases the
+# inference jobs whose monomers are ready, submits them and resubmits itself until the data pipeline is done.
+
+RUN_DIR=pending_jobs/${PIPELINE_RUN_ID}
+STREAM_INTERVAL=${STREAM_INTERVAL:-5}
+
+if [[ ! -f "$RUN_DIR/inference_plan.json" ]]; then
+    # First run: plan all jobs from the input sequences, the index tables are filled step by step
+    if ! json_output=$(python3 utilities/make_inference_inputs.py); then
+        echo "Error: could not create the job plan." >&2
+        exit 1
+    fi
+    echo "Planned $(echo "$json_output" | jq -r '.total_jobs') inference jobs in streaming mode."
+
+    if [[ -n "${INFERENCE_STATISTICS_FILE:-}" && ! -f "$INFERENCE_STATISTICS_FILE" ]]; then
+        touch $INFERENCE_STATISTICS_FILE
+    fi
+fi
+
+if ! status=$(python3 utilities/pipeline_controller.py tick "$RUN_DIR"); then
+    echo "Error: controller step failed. Retrying in ${STREAM_INTERVAL} minutes." >&2
+    status="waiting"
+fi
+
+if [[ "$status" == "done" ]]; then
+    # Inputs of data pipeline jobs that were given up stay for utilities/resume_run.sh
+    rmdir data_pipeline_inputs/$PIPELINE_RUN_ID 2>/dev/null
+    echo "Streaming submission of run $PIPELINE_RUN_ID finished."
+else
+    controller_job=$(sbatch --parsable --begin=now+$(( STREAM_INTERVAL * 60 )) utilities/pipeline_controller.sh)
+    echo "$controller_job" > "$RUN_DIR/controller_job"
+    echo "Next controller run: job $controller_job"
+fi
@@ -0,0 +1,363 @@
+import os
+import re
+import sys
+import json
+import time
+import fcntl
+import hashlib
+import argparse
+import itertools
+import multiprocessing
+from job_plan import count_cartesian_jobs, cartesian_token_histogram, load_buckets, profile_windows
+
+PLAN_VERSION = 1
+RUN_PLAN_FILE = "plan.json"                 # pending_jobs/<PIPELINE_RUN_ID>/plan.json
+ATOM_CACHE_FILE = "compound_atoms.jsonl"    # explicit atom count per SMILES, shared by all runs
+VALID_AA = set("ACDEFGHIKLMNPQRSTVWYUOX")
+VALID_FILENAME_REGEX = re.compile(r'^[A-Za-z0-9_-]+$')
+POOL_MIN_SMILES = 1000                      # fewer uncached SMILES are counted without starting a process pool
+MAX_PROCESSES = 8                           # the planner runs on the login node
+
+
+class PlanError(ValueError):
+    """Invalid input, screen file or cluster config; the message lists every problem found."""
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+# ------------------------------
+# Input JSON
+# ------------------------------
+
+def validate_dimensions(data, mode):
+    """Error messages for the dimensions of an input JSON (empty list if it is valid)."""
+    if not isinstance(data, list):
+        return ["ERROR: JSON must contain a list of dimensions (dictionaries)."]
+    errors = []
+    if mode not in ("cartesian", "collapsed"):
+        errors.append(f"ERROR: MODE must be 'cartesian' or 'collapsed'. Got '{mode}'")
+    sequences = {}
+    for idx, dimension in enumerate(data):
+        if not isinstance(dimension, dict):
+            errors.append(f"ERROR: Dimension at index {idx} is not a dictionary.")
+            continue
+        for protein, sequence in dimension.items():
+            if not isinstance(protein, str) or not VALID_FILENAME_REGEX.match(protein):
+                errors.append(f"ERROR: Invalid protein name in dimension {idx}: '{protein}'")
+            if not isinstance(sequence, str) or not sequence or not all(aa.upper() in VALID_AA for aa in sequence):
+                errors.append(f"ERROR: Invalid sequence for protein '{protein}' in dimension {idx}: '{sequence}'")
+            elif sequences.setdefault(protein, sequence) != sequence:
+                errors.append(f"ERROR: Protein '{protein}' has inconsistent sequences across dimensions")
+    return errors
+
+def unique_proteins(data):
+    """Sequence of every protein in the order proteins are first seen (dimensions must be valid)."""
+    proteins = {}
+    for dimension in data:
+        for protein, sequence in dimension.items():
+            proteins.setdefault(protein, sequence)
+    return proteins
+
+def enumerate_unique_jobs(mode, protein_lists):
+    """The reference: deduplicate sorted tuples of the full product (slow for large inputs)."""
+    if mode == "cartesian":
+        return {tuple(sorted(comb)) for comb in itertools.product(*protein_lists)}
+    return {tuple(sorted(dim)) for dim in protein_lists}
+
+def token_histogram(jobs, protein_lengths, cap):
+    hist = [0] * (cap + 2)
+    for job in jobs:
+        hist[min(sum(protein_lengths[p] for p in job), cap + 1)] += 1
+    return hist
+
+def job_histogram(mode, protein_lists, protein_lengths, cap):
+    """
+    (number of unique protein-only jobs, histogram of their token sizes with larger sizes collected at cap + 1,
+    the unique jobs if they had to be enumerated or None). Cartesian inputs are counted in closed form from the
+    dimension sizes; only partially overlapping dimensions need the enumeration.
+    """
+    if mode == "cartesian":
+        jobs = count_cartesian_jobs(protein_lists)
+        if jobs is not None:
+            return jobs, cartesian_token_histogram(protein_lists, protein_lengths, cap), None
+        print("WARNING: Dimensions share proteins partially. Counting jobs by enumeration.", file=sys.stderr)
+    # Collapsed: each dimension's job is the sorted tuple of its proteins
+    unique_jobs = enumerate_unique_jobs(mode, protein_lists)
+    return len(unique_jobs), token_histogram(unique_jobs, protein_lengths, cap), unique_jobs
+
+def count_jobs(mode, protein_lists, protein_lengths, windows, verify=False):
+    """
+    (number of unique protein-only jobs, jobs per token window followed by the number of too big jobs).
+    With verify, the enumeration is always done and has to agree.
+    """
+    cap = windows[-1][1] if windows else 0
+    jobs, histogram, unique_jobs = job_histogram(mode, protein_lists, protein_lengths, cap)
+
+    if verify:
+        reference = unique_jobs if unique_jobs is not None else enumerate_unique_jobs(mode, protein_lists)
+        if len(reference) != jobs or (windows and token_histogram(reference, protein_lengths, cap) != histogram):
+            raise PlanError(f"ERROR: Closed-form job count ({jobs}) does not match enumeration ({len(reference)}).")
+
+    if not windows:
+        return jobs, []
+    return jobs, [sum(histogram[lo:hi + 1]) for lo, hi in windows] + [sum(histogram[cap + 1:])]
+
+# ------------------------------
+# Screen file
+# ------------------------------
+
+def count_explicit_atoms(smiles):
+    """Count total atoms (only explicit!) in SMILES using RDKit just like AlphaFold does it. None for invalid SMILES."""
+    from rdkit import Chem
+    mol = Chem.MolFromSmiles(smiles)
+    return mol.GetNumAtoms() if mol is not None else None
+
+def smiles_key(smiles):
+    return hashlib.sha256(smiles.encode()).hexdigest()[:32]
+
+def load_atom_cache(cache_file):
+    cache = {}
+    try:
+        with open(cache_file, "r") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    continue  # truncated by a crash while appending
+                cache[entry["key"]] = entry["atoms"]
+    except FileNotFoundError:
+        pass
+    return cache
+
+def append_atom_cache(cache_file, counts):
+    with open(cache_file, "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        f.write("".join(json.dumps({"key": smiles_key(s), "atoms": n}, separators=(",", ":")) + "\n"
+                        for s, n in counts.items()))
+        f.flush()
+        fcntl.flock(f, fcntl.LOCK_UN)
+
+def atom_counts(smiles_list, cache_file=ATOM_CACHE_FILE, processes=None):
+    """
+    Explicit atom count of every SMILES. Counts are looked up in the cache file first, the rest is parsed
+    by RDKit in a process pool (large libraries) and appended to the cache.
+    """
+    cache = load_atom_cache(cache_file) if cache_file else {}
+    counts = {}
+    missing = []
+    for smiles in dict.fromkeys(smiles_list):
+        key = smiles_key(smiles)
+        if key in cache:
+            counts[smiles] = cache[key]
+        else:
+            missing.append(smiles)
+    if len(missing) < POOL_MIN_SMILES or processes == 1:
+        new_counts = dict(zip(missing, map(count_explicit_atoms, missing)))
+    else:
+        processes = processes or min(len(os.sched_getaffinity(0)), MAX_PROCESSES)
+        with multiprocessing.Pool(processes) as pool:
+            new_counts = dict(zip(missing, pool.map(count_explicit_atoms, missing, chunksize=256)))
+    if new_counts and cache_file:
+        append_atom_cache(cache_file, new_counts)
+    counts.update(new_counts)
+    return counts
+
+def load_screen(screen_file):
+    try:
+        with open(screen_file, "r") as f:
+            screen_data = json.load(f)
+    except Exception as e:
+        raise PlanError(f"Error: Failed to read SCREEN_FILE '{screen_file}': {e}")
+    if not isinstance(screen_data, list):
+        raise PlanError("Error: SCREEN_FILE must contain a top-level list.")
+    return screen_data
+
+def screen_compounds(screen_data, max_atoms, cache_file=ATOM_CACHE_FILE, processes=None):
+    """Compounds with a valid SMILES of at most max_atoms explicit atoms (no limit if 0 or None)."""
+    items = []
+    for i, item in enumerate(screen_data):
+        if not isinstance(item, dict):
+            print(f"Warning: Item {i} is not a dictionary. Skipping.", file=sys.stderr)
+        elif "ID" not in item:
+            print(f"Warning: Item {i} missing 'ID' key. Skipping.", file=sys.stderr)
+        elif item.get("SMILES"):
+            items.append(item)
+    counts = atom_counts([item["SMILES"] for item in items], cache_file, processes)
+    max_atoms = int(max_atoms) if max_atoms else 0
+    compounds = []
+    for item in items:
+        num_atoms = counts[item["SMILES"]]
+        if num_atoms is None:
+            print(f"Warning: Invalid SMILES of compound '{item['ID']}'. Skipping.", file=sys.stderr)
+            continue
+        if max_atoms > 0 and num_atoms > max_atoms:
+            continue
+        compounds.append({"ID": item["ID"], "SMILES": item["SMILES"], "Atoms": num_atoms})
+    return compounds
+
+# ------------------------------
+# Cluster config
+# ------------------------------
+
+def select_profiles(cluster_conf, gpu_profiles, config_path):
+    """Settings of the GPU profiles (all of the config if none are given), ordered by token limit."""
+    available = cluster_conf.get("gpu_profiles") or {}
+    names = gpu_profiles or sorted(available)
+    errors = []
+    profiles = []
+    for name in names:
+        conf = available.get(name)
+        if conf is None:
+            errors.append(f"Error: GPU profile '{name}' not found in cluster config ({config_path})")
+            continue
+        token_limit = conf.get("token_limit")
+        max_minutes = conf.get("max_minutes_per_seed")
+        if not isinstance(token_limit, int) or isinstance(token_limit, bool) or token_limit <= 0:
+            errors.append(f"Error: token_limit for GPU profile '{name}' is missing or invalid: {token_limit}")
+        if not isinstance(max_minutes, int) or isinstance(max_minutes, bool) or max_minutes <= 0:
+            errors.append(f"Error: max_minutes_per_seed for GPU profile '{name}' is missing or invalid.")
+        profiles.append({"name": name, "gres": conf.get("gres"), "token_limit": token_limit,
+                         "max_minutes_per_seed": max_minutes})
+    if errors:
+        raise PlanError("\n".join(errors))
+    return sorted(profiles, key=lambda p: p["token_limit"])
+
+# ------------------------------
+# Plan
+# ------------------------------
+
+def plan_settings(mode, sorting, seeds, max_compound_atoms=None, gpu_profiles=None):
+    """Settings of a submission as recorded in the plan; a plan with other settings is rebuilt."""
+    try:
+        model_seeds = [int(s) for s in seeds.split(",") if s.strip() != ""]
+    except ValueError:
+        raise PlanError("ERROR: SEEDS must be comma-separated integers (e.g. 0,1,2).")
+    return {"mode": mode, "sorting": sorting, "seeds": model_seeds,
+            "max_compound_atoms": int(max_compound_atoms) if max_compound_atoms else None,
+            "gpu_profiles": sorted(gpu_profiles) if gpu_profiles else None}
+
+def build_plan(input_file, mode, sorting, seeds, cluster_config, gpu_profiles=None, screen_file=None,
+               max_compound_atoms=None, cache_file=ATOM_CACHE_FILE, processes=None, verify=False):
+    """
+    Parse and validate the input JSON, screen file and cluster config of a submission once. The plan holds
+    everything later stages need from them and the SHA-256 of every input file to detect changes.
+    With verify, the job counts are checked against a full enumeration.
+    """
+    try:
+        with open(input_file, "r") as f:
+            data = json.load(f)
+    except (OSError, json.JSONDecodeError) as e:
+        raise PlanError(f"ERROR: Failed to read INPUT_FILE '{input_file}': {e}")
+    errors = validate_dimensions(data, mode)
+    if errors:
+        raise PlanError("\n".join(errors))
+    settings = plan_settings(mode, sorting, seeds, max_compound_atoms, gpu_profiles)
+
+    with open(cluster_config, "r") as f:
+        cluster_conf = json.load(f)
+    profiles = select_profiles(cluster_conf, gpu_profiles, cluster_config)
+    buckets = load_buckets(cluster_conf)
+
+    proteins = unique_proteins(data)
+    dimensions = [sorted(dim) if sorting == "alpha" else list(dim) for dim in data]
+    windows = list(profile_windows(range(len(profiles)), {i: p["token_limit"] for i, p in enumerate(profiles)},
+                                   buckets).values())
+    jobs, profile_jobs = count_jobs(mode, dimensions, {p: len(s) for p, s in proteins.items()}, windows, verify)
+
+    inputs = {"input_file": {"path": input_file, "sha256": file_sha256(input_file)},
+              "cluster_config": {"path": cluster_config, "sha256": file_sha256(cluster_config)}}
+    compounds = []
+    screen = None
+    if screen_file:
+        screen_data = load_screen(screen_file)
+        compounds = screen_compounds(screen_data, max_compound_atoms, cache_file, processes)
+        inputs["screen_file"] = {"path": screen_file, "sha256": file_sha256(screen_file)}
+        screen = {"compounds": len(screen_data), "valid": len(compounds)}
+
+    return {
+        "version": PLAN_VERSION,
+        "created": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "inputs": inputs,
+        "settings": settings,
+        "cluster": {key: cluster_conf.get(key) for key in ("af3_container_path", "af3_model_path", "af3_db_path",
+                                                           "datapipeline_partition", "inference_partition",
+                                                           "max_submit_jobs")},
+        "buckets": buckets,
+        "profiles": profiles,
+        "proteins": proteins,
+        "dimensions": dimensions,
+        "compounds": compounds,
+        "screen": screen,
+        "counts": {"proteins": len(proteins), "jobs": jobs, "profile_jobs": profile_jobs,
+                   "jobs_with_compounds": jobs * max(len(compounds), 1)},
+    }
+
+def save_run_plan(run_dir, plan):
+    os.makedirs(run_dir, exist_ok=True)
+    tmp_path = os.path.join(run_dir, RUN_PLAN_FILE + ".tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(plan, f)
+    os.replace(tmp_path, os.path.join(run_dir, RUN_PLAN_FILE))
+
+def load_run_plan(run_dir, input_file=None, screen_file=None, cluster_config=None, settings=None):
+    """
+    The plan of a run, or None if there is none, it was written by another version of the planner, an input file
+    given here is not the one it was made from or the settings (plan_settings) differ (the caller then parses the
+    inputs itself). With settings, a screen file given now but not then, or the other way round, also counts.
+    """
+    try:
+        with open(os.path.join(run_dir, RUN_PLAN_FILE), "r") as f:
+            plan = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+    if plan.get("version") != PLAN_VERSION:
+        return None
+    for key, path in (("input_file", input_file), ("screen_file", screen_file), ("cluster_config", cluster_config)):
+        recorded = plan["inputs"].get(key)
+        if path and (recorded is None or not os.path.exists(path) or file_sha256(path) != recorded["sha256"]):
+            print(f"Warning: {path} changed since {run_dir}/{RUN_PLAN_FILE} was written, parsing it again.",
+                  file=sys.stderr)
+            return None
+    if settings is not None and (plan["settings"] != settings
+                                 or bool(screen_file) != ("screen_file" in plan["inputs"])):
+        print(f"Warning: MODE, SORTING, SEEDS, GPU_PROFILES, SCREEN_FILE or MAX_COMPOUND_ATOMS changed since "
+              f"{run_dir}/{RUN_PLAN_FILE} was written, planning again.", file=sys.stderr)
+        return None
+    return plan
+
+def main():
+    parser = argparse.ArgumentParser(description="Parse, validate and hash the inputs of a submission once and "
+                                                 "write pending_jobs/<PIPELINE_RUN_ID>/plan.json.")
+    parser.add_argument("--run-dir", default=os.path.join("pending_jobs", os.environ.get("PIPELINE_RUN_ID", "")))
+    parser.add_argument("--input-file", default=os.environ.get("INPUT_FILE"))
+    parser.add_argument("--mode", default=os.environ.get("MODE"))
+    parser.add_argument("--sorting", default=os.environ.get("SORTING", "input"))
+    parser.add_argument("--seeds", default=os.environ.get("SEEDS", "0"))
+    parser.add_argument("--screen-file", default=os.environ.get("SCREEN_FILE") or None)
+    parser.add_argument("--max-compound-atoms", default=os.environ.get("MAX_COMPOUND_ATOMS") or None)
+    parser.add_argument("--cluster-config", default=os.environ.get("CLUSTER_CONFIG"))
+    parser.add_argument("--gpu-profiles", default=os.environ.get("GPU_PROFILES", ""),
+                        help="Comma-separated GPU profiles (default: all profiles of the cluster config)")
+    parser.add_argument("--atom-cache", default=ATOM_CACHE_FILE, help="Cache of SMILES atom counts ('' to disable)")
+    parser.add_argument("--processes", type=int, help=f"RDKit processes (default: available CPUs, at most {MAX_PROCESSES})")
+    parser.add_argument("--verify", action="store_true",
+                        help="Also count the jobs by full enumeration and fail if the closed-form result differs")
+    args = parser.parse_args()
+
+    try:
+        plan = build_plan(args.input_file, args.mode, args.sorting, args.seeds, args.cluster_config,
+                          [p.strip() for p in args.gpu_profiles.split(",") if p.strip()], args.screen_file,
+                          args.max_compound_atoms, args.atom_cache, args.processes, args.verify)
+    except PlanError as e:
+        print(e, file=sys.stderr)
+        sys.exit(1)
+    save_run_plan(args.run_dir, plan)
+    print(f"Wrote {os.path.join(args.run_dir, RUN_PLAN_FILE)}", file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
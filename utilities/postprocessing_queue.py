@@ -0,0 +1,250 @@
+import os
+import sys
+import json
+import time
+import uuid
+import fcntl
+import signal
+import argparse
+import subprocess
+
+QUEUE_DIR = "queue"          # pending_jobs/<PIPELINE_RUN_ID>/postprocessing/queue/<item>.json: finished jobs
+CLAIMED_DIR = "claimed"      # claimed/<worker>/<item>.json: batch a worker is processing
+FAILED_DIR = "failed"        # items whose script exited with an error
+WORKERS_DIR = "workers"      # workers/<worker>: heartbeat of a running worker, workers/submitted: last submission
+WORKER_JOB_FILE = "worker_job"
+WORKER_SCRIPT = "utilities/postprocessing_worker.sh"
+# Environment of POSTPROCESSING_SCRIPT per finished job (as it was with one sbatch per job)
+ITEM_VARIABLES = ("PIPELINE_RUN_ID", "GPU_PROFILE", "INFERENCE_ID", "INFERENCE_NAME", "INFERENCE_DIR", "COMPOUND_ID")
+POLL_SECONDS = 30
+HEARTBEAT_SECONDS = 60       # heartbeat interval while POSTPROCESSING_SCRIPT runs
+STALE_SECONDS = 10 * 60      # workers without heartbeat for this long are gone, their batches are queued again
+DEFAULT_BATCH_SIZE = 20
+DEFAULT_IDLE_MINUTES = 10
+
+
+def enqueue(spool, env):
+    """Add a finished job; written under a temporary name and renamed, so workers never claim partial items."""
+    os.makedirs(os.path.join(spool, QUEUE_DIR), exist_ok=True)
+    name = f"{time.time_ns()}_{uuid.uuid4().hex[:8]}.json"
+    tmp_path = os.path.join(spool, f".{name}.tmp")
+    with open(tmp_path, "w") as f:
+        json.dump({key: env[key] for key in ITEM_VARIABLES if key in env}, f)
+    os.rename(tmp_path, os.path.join(spool, QUEUE_DIR, name))
+
+def touch(path):
+    with open(path, "a"):
+        os.utime(path, None)
+
+def last_heartbeat(spool):
+    """Latest heartbeat or submission time of the workers (0 if none)."""
+    try:
+        return max((e.stat().st_mtime for e in os.scandir(os.path.join(spool, WORKERS_DIR))), default=0)
+    except FileNotFoundError:
+        return 0
+
+def ensure_workers(spool, workers, partition=None):
+    """
+    Submit an array of workers unless workers are running or were submitted recently. Only once per STALE_SECONDS
+    (while submitted workers are still pending) squeue is asked, so enqueueing stays cheap. Returns the new job ID.
+    """
+    if time.time() - last_heartbeat(spool) < STALE_SECONDS:
+        return None
+    os.makedirs(os.path.join(spool, WORKERS_DIR), exist_ok=True)
+    with open(os.path.join(spool, ".submit.lock"), "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if time.time() - last_heartbeat(spool) < STALE_SECONDS:
+            return None
+        job_file = os.path.join(spool, WORKER_JOB_FILE)
+        if os.path.exists(job_file):
+            with open(job_file, "r") as f:
+                job_id = f.read().strip()
+            out = subprocess.run(["squeue", "-h", "-j", job_id], capture_output=True, text=True).stdout
+            if out.strip():
+                touch(os.path.join(spool, WORKERS_DIR, "submitted"))
+                return None
+        args = ["sbatch", "--parsable", f"--array=0-{workers - 1}"]
+        if partition:
+            args.append(f"--partition={partition}")
+        out = subprocess.run(args + [WORKER_SCRIPT], check=True, capture_output=True, text=True).stdout
+        job_id = out.strip().split(";")[0]
+        with open(job_file, "w") as f:
+            f.write(job_id + "\n")
+        touch(os.path.join(spool, WORKERS_DIR, "submitted"))
+        return job_id
+
+def requeue_stale(spool):
+    """Put the batches of workers that stopped without finishing them back into the queue."""
+    claimed_root = os.path.join(spool, CLAIMED_DIR)
+    if not os.path.isdir(claimed_root):
+        return 0
+    requeued = 0
+    now = time.time()
+    for worker_dir in os.scandir(claimed_root):
+        try:
+            heartbeat = os.stat(os.path.join(spool, WORKERS_DIR, worker_dir.name)).st_mtime
+        except FileNotFoundError:
+            heartbeat = 0
+        if now - heartbeat < STALE_SECONDS:
+            continue
+        for item in os.scandir(worker_dir.path):
+            try:
+                os.rename(item.path, os.path.join(spool, QUEUE_DIR, item.name))
+                requeued += 1
+            except FileNotFoundError:
+                pass
+    return requeued
+
+def claim(spool, worker, batch_size):
+    """Move up to batch_size items into the worker's claimed directory; rename makes every item go to one worker only."""
+    claimed_dir = os.path.join(spool, CLAIMED_DIR, worker)
+    os.makedirs(claimed_dir, exist_ok=True)
+    batch = []
+    try:
+        entries = os.scandir(os.path.join(spool, QUEUE_DIR))
+    except FileNotFoundError:
+        return batch
+    with entries:
+        for entry in entries:
+            try:
+                os.rename(entry.path, os.path.join(claimed_dir, entry.name))
+            except FileNotFoundError:
+                continue  # claimed by another worker
+            batch.append(os.path.join(claimed_dir, entry.name))
+            if len(batch) == batch_size:
+                break
+    return batch
+
+def run_item(path, script, heartbeat):
+    """
+    Run the script for one claimed item, touching the heartbeat while it runs, so that long scripts are not taken
+    for a dead worker. Returns whether it succeeded, None if the item was queued again meanwhile.
+    """
+    try:
+        with open(path, "r") as f:
+            item = json.load(f)
+    except FileNotFoundError:
+        return None
+    print(f"Postprocessing {item.get('INFERENCE_NAME')} ({item.get('GPU_PROFILE')} {item.get('INFERENCE_ID')})", flush=True)
+    process = subprocess.Popen(["bash", script], env=dict(os.environ, **item))
+    while True:
+        try:
+            return process.wait(timeout=HEARTBEAT_SECONDS) == 0
+        except subprocess.TimeoutExpired:
+            touch(heartbeat)
+
+def move(path, target):
+    """Rename a claimed item; a no-op if requeue_stale gave it to another worker meanwhile."""
+    try:
+        if target is None:
+            os.remove(path)
+        else:
+            os.rename(path, target)
+    except FileNotFoundError:
+        pass
+
+def work(spool, worker, script, batch_size, idle_minutes):
+    """Process batches until the queue stayed empty for idle_minutes or SIGTERM arrives; returns the number of items."""
+    stop = False
+
+    def request_stop(signum, frame):
+        nonlocal stop
+        stop = True
+
+    signal.signal(signal.SIGTERM, request_stop)
+    for subdir in (QUEUE_DIR, FAILED_DIR, WORKERS_DIR):
+        os.makedirs(os.path.join(spool, subdir), exist_ok=True)
+    heartbeat = os.path.join(spool, WORKERS_DIR, worker)
+    done = 0
+    idle_since = time.time()
+    while not stop:
+        touch(heartbeat)
+        requeue_stale(spool)
+        batch = claim(spool, worker, batch_size)
+        for i, path in enumerate(batch):
+            if stop:
+                # time limit: hand the rest of the batch back
+                for rest in batch[i:]:
+                    move(rest, os.path.join(spool, QUEUE_DIR, os.path.basename(rest)))
+                break
+            touch(heartbeat)
+            succeeded = run_item(path, script, heartbeat)
+            if succeeded is None:
+                continue
+            move(path, None if succeeded else os.path.join(spool, FAILED_DIR, os.path.basename(path)))
+            done += 1
+        if batch:
+            idle_since = time.time()
+            continue
+        if time.time() - idle_since > idle_minutes * 60:
+            # Without heartbeat, enqueuing tasks submit new workers; items that came in meanwhile are still done here
+            os.remove(heartbeat)
+            if not os.listdir(os.path.join(spool, QUEUE_DIR)):
+                break
+            idle_since = time.time()
+            continue
+        time.sleep(POLL_SECONDS)
+    if os.path.exists(heartbeat):
+        os.remove(heartbeat)
+    try:
+        os.rmdir(os.path.join(spool, CLAIMED_DIR, worker))
+    except OSError:
+        pass  # items left are queued again by requeue_stale
+    return done
+
+def count(spool, subdir):
+    path = os.path.join(spool, subdir)
+    if not os.path.isdir(path):
+        return 0
+    if subdir == CLAIMED_DIR:
+        return sum(len(os.listdir(e.path)) for e in os.scandir(path))
+    return len(os.listdir(path))
+
+def main():
+    parser = argparse.ArgumentParser(description="Spool directory of finished inference jobs for batched postprocessing workers.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    p_enqueue = subparsers.add_parser("enqueue", help="Queue the job of the environment (INFERENCE_NAME, ...) and make sure workers run")
+    p_enqueue.add_argument("spool", help="pending_jobs/<PIPELINE_RUN_ID>/postprocessing")
+    p_enqueue.add_argument("--workers", type=int, default=int(os.environ.get("POSTPROCESSING_WORKERS") or 1))
+    p_enqueue.add_argument("--partition", default=os.environ.get("DATAPIPELINE_PARTITION"), help="Partition of the workers")
+    p_work = subparsers.add_parser("work", help="Run POSTPROCESSING_SCRIPT for queued jobs until the queue stays empty")
+    p_work.add_argument("spool")
+    p_work.add_argument("--script", default=os.environ.get("POSTPROCESSING_SCRIPT"))
+    p_work.add_argument("--batch-size", type=int, default=int(os.environ.get("POSTPROCESSING_BATCH_SIZE") or DEFAULT_BATCH_SIZE))
+    p_work.add_argument("--idle-minutes", type=float, default=DEFAULT_IDLE_MINUTES)
+    p_work.add_argument("--worker", default=os.environ.get("SLURM_JOB_ID") or f"{os.uname().nodename}_{os.getpid()}",
+                        help="Worker name (default: SLURM job ID)")
+    p_status = subparsers.add_parser("status", help="Print the number of queued, claimed and failed jobs")
+    p_status.add_argument("spool")
+    p_retry = subparsers.add_parser("retry-failed", help="Queue the failed jobs again")
+    p_retry.add_argument("spool")
+    args = parser.parse_args()
+
+    if args.command == "enqueue":
+        enqueue(args.spool, os.environ)
+        try:
+            job_id = ensure_workers(args.spool, args.workers, args.partition)
+        except (OSError, subprocess.CalledProcessError) as e:
+            print(f"Warning: could not submit postprocessing workers: {e}", file=sys.stderr)
+            return
+        if job_id:
+            print(f"Submitted {args.workers} postprocessing workers: job {job_id}")
+    elif args.command == "work":
+        if not args.script or not os.path.isfile(args.script):
+            print(f"Error: postprocessing script '{args.script}' not found.", file=sys.stderr)
+            sys.exit(1)
+        done = work(args.spool, args.worker, args.script, args.batch_size, args.idle_minutes)
+        print(f"Worker {args.worker} postprocessed {done} jobs.")
+    elif args.command == "status":
+        print(f"queued {count(args.spool, QUEUE_DIR)}, in progress {count(args.spool, CLAIMED_DIR)}, "
+              f"failed {count(args.spool, FAILED_DIR)}, workers active: "
+              f"{'yes' if time.time() - last_heartbeat(args.spool) < STALE_SECONDS else 'no'}")
+    elif args.command == "retry-failed":
+        os.makedirs(os.path.join(args.spool, QUEUE_DIR), exist_ok=True)
+        failed = os.listdir(os.path.join(args.spool, FAILED_DIR)) if os.path.isdir(os.path.join(args.spool, FAILED_DIR)) else []
+        for name in failed:
+            os.rename(os.path.join(args.spool, FAILED_DIR, name), os.path.join(args.spool, QUEUE_DIR, name))
+        print(f"Queued {len(failed)} failed jobs again.")
+
+if __name__ == "__main__":
+    main()
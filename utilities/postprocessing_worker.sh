@@ -0,0 +1,15 @@
+#!/bin/bash
+#SBATCH --job-name=AF3_postprocessing
+#SBATCH --time=04:00:00
+#SBATCH --ntasks=1
+#SBATCH --cpus-per-task=1
+#SBATCH --signal=B:TERM@120                     # Stop 2 minutes before the time limit, unfinished jobs are queued again
+#SBATCH --output=slurm-output/slurm-%A_%a-%x.out # %j (Job ID) %x (Job Name)
+
+# Postprocessing worker (POSTPROCESSING_WORKERS > 0): runs POSTPROCESSING_SCRIPT with the environment of every finished
+# inference job queued in pending_jobs/<PIPELINE_RUN_ID>/postprocessing, POSTPROCESSING_BATCH_SIZE jobs at a time,
+# and ends when no new jobs arrived for a while. Inference tasks submit new workers when none are left.
+echo "Worker ran on:" $(hostname)
+
+exec python3 utilities/postprocessing_queue.py work "pending_jobs/${PIPELINE_RUN_ID}/postprocessing" \
+    --script "$POSTPROCESSING_SCRIPT" --batch-size "${POSTPROCESSING_BATCH_SIZE:-20}"
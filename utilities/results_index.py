@@ -0,0 +1,149 @@
+import os
+import sys
+import json
+import time
+import fcntl
+import hashlib
+import argparse
+from merge_seed_shards import best_score
+
+INDEX_DIR = ".index"  # results/.index/<shard>.jsonl
+KINDS = ("name", "protein", "compound")
+
+
+def shard_path(results_dir, key):
+    """Shard file of a key ('<kind>:<value>'); 256 shards, so a lookup reads 1/256 of the index."""
+    return os.path.join(results_dir, INDEX_DIR, hashlib.sha256(key.encode()).hexdigest()[:2] + ".jsonl")
+
+def job_keys(name, proteins, compound_id):
+    keys = [f"name:{name}"] + [f"protein:{p}" for p in dict.fromkeys(proteins)]
+    if compound_id is not None:
+        keys.append(f"compound:{compound_id}")
+    return keys
+
+def job_components(job_file):
+    """(name, protein names, compound id or None) of an AF3 job JSON written by job_plan.build_job."""
+    with open(job_file, "r") as f:
+        data = json.load(f)
+    proteins = [s["protein"].get("description") or s["protein"]["id"] for s in data["sequences"] if "protein" in s]
+    ligands = [s["ligand"].get("description") for s in data["sequences"] if "ligand" in s]
+    return data["name"], proteins, ligands[-1] if ligands else None
+
+def make_record(results_dir, result_dir, name, proteins, compound_id, state, **fields):
+    """Index record of a result directory; the ranking score is the best one of the job (None without results)."""
+    try:
+        score = best_score(result_dir, name)
+    except (OSError, ValueError, IndexError):
+        score = None
+    record = {"keys": job_keys(name, proteins, compound_id), "name": name, "proteins": proteins,
+              "compound_id": compound_id, "path": os.path.relpath(result_dir, results_dir), "state": state,
+              "ranking_score": score, "time": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())}
+    record.update(fields)
+    return record
+
+def register(results_dir, records):
+    """Append every record to the shards of its keys, each shard under an exclusive lock."""
+    lines = {}
+    for record in records:
+        line = json.dumps(record, separators=(",", ":")) + "\n"
+        for path in dict.fromkeys(shard_path(results_dir, key) for key in record["keys"]):
+            lines.setdefault(path, []).append(line)
+    os.makedirs(os.path.join(results_dir, INDEX_DIR), exist_ok=True)
+    for path, shard_lines in lines.items():
+        with open(path, "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            f.write("".join(shard_lines))
+            f.flush()
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+def lookup(results_dir, value, kind="name"):
+    """
+    Results of a job name, protein or compound id: the latest record per result directory, oldest first
+    (a name can have several results from reruns or other runs). Truncated lines are ignored.
+    """
+    key = f"{kind}:{value}"
+    records = {}
+    try:
+        with open(shard_path(results_dir, key), "r") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                if key in record.get("keys", ()):
+                    records.pop(record["path"], None)
+                    records[record["path"]] = record
+    except FileNotFoundError:
+        pass
+    return list(records.values())
+
+def latest_done(records):
+    """Path of the most recent complete result, or None."""
+    done = [r for r in records if r["state"] == "done"]
+    return done[-1]["path"] if done else None
+
+def rebuild(results_dir):
+    """Index all complete results in results/<array dir>/<name>/ (e.g. results from before the index existed)."""
+    records = []
+    for bucket in sorted(os.scandir(results_dir), key=lambda e: e.name):
+        if bucket.name.startswith(".") or not bucket.is_dir():
+            continue
+        for entry in sorted(os.scandir(bucket.path), key=lambda e: e.name):
+            data_file = os.path.join(entry.path, f"{entry.name}_data.json")
+            if not os.path.exists(os.path.join(entry.path, f"{entry.name}_model.cif")):
+                continue
+            try:
+                name, proteins, compound_id = job_components(data_file)
+            except (OSError, KeyError, json.JSONDecodeError) as e:
+                print(f"Warning: could not index {entry.path}: {e}", file=sys.stderr)
+                continue
+            records.append(make_record(results_dir, entry.path, name, proteins, compound_id, "done"))
+    for path in (os.path.join(results_dir, INDEX_DIR, f"{i:02x}.jsonl") for i in range(256)):
+        if os.path.exists(path):
+            os.remove(path)
+    register(results_dir, records)
+    return len(records)
+
+def main():
+    parser = argparse.ArgumentParser(description="Index of the inference results by job name, protein and compound.")
+    parser.add_argument("--results-dir", default="results")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    p_register = subparsers.add_parser("register", help="Record the result directory of a job")
+    p_register.add_argument("result_dir", help="results/<array dir>/<name>")
+    p_register.add_argument("job_file", help="AF3 input JSON of the job")
+    p_register.add_argument("--state", required=True, help="Ledger state of the job (done, failed)")
+    p_register.add_argument("--run", help="PIPELINE_RUN_ID")
+    p_register.add_argument("--profile", help="GPU profile")
+    p_register.add_argument("--id", type=int, help="INFERENCE_ID")
+    p_lookup = subparsers.add_parser("lookup", help="Print the result directories of a job name, protein or compound id")
+    p_lookup.add_argument("value")
+    p_lookup.add_argument("--kind", choices=KINDS, default="name")
+    p_lookup.add_argument("--latest", action="store_true", help="Only print the path of the latest complete result")
+    subparsers.add_parser("rebuild", help="Re-index all complete results in the results directory")
+    args = parser.parse_args()
+
+    if args.command == "register":
+        try:
+            name, proteins, compound_id = job_components(args.job_file)
+        except (OSError, KeyError, json.JSONDecodeError) as e:
+            print(f"Error: could not read {args.job_file}: {e}", file=sys.stderr)
+            sys.exit(1)
+        register(args.results_dir, [make_record(args.results_dir, args.result_dir, name, proteins, compound_id, args.state,
+                                                pipeline_run_id=args.run, gpu_profile=args.profile, inference_id=args.id)])
+    elif args.command == "lookup":
+        records = lookup(args.results_dir, args.value, args.kind)
+        if args.latest:
+            path = latest_done(records)
+            if path is None:
+                sys.exit(1)
+            print(os.path.join(args.results_dir, path))
+            return
+        for r in records:
+            score = f"{r['ranking_score']:.3f}" if r.get("ranking_score") is not None else "-"
+            print(f"{os.path.join(args.results_dir, r['path'])}\t{r['name']}\t{r['state']}\t{score}\t"
+                  f"{r.get('pipeline_run_id') or '-'}\t{r['time']}")
+    elif args.command == "rebuild":
+        print(f"{rebuild(args.results_dir)} results indexed")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,38 @@
+#!/usr/bin/env bash
+#SBATCH --job-name=AF3_resume
+#SBATCH --time=00:30:00
+#SBATCH --output=slurm-output/slurm-%j-%x.out # %j (Job ID) %x (Job Name)
+
+# Runs without streaming: submitted by submit_data_pipeline_part_2.sh to start once the inference arrays of the run
+# ended. It resubmits their failed and lost jobs once, like utilities/resume_run.sh (out-of-memory jobs on the next
+# larger GPU profile). Arrays submitted later by the tasks themselves (next chunks) are listed in
+# pending_jobs/<PIPELINE_RUN_ID>/inference_jobs; while one of them is queued, this job submits itself again after it.
+
+RUN_DIR=pending_jobs/${PIPELINE_RUN_ID}
+JOBS_FILE=$RUN_DIR/inference_jobs
+
+if ! queued=$(squeue -h -u "$USER" -n AF3_inference -o "%F %r"); then
+    echo "Error: squeue failed, checking again in 10 minutes." >&2
+    sbatch --parsable --begin=now+600 utilities/resume_batch.sh
+    exit 0
+fi
+queued=$(grep -wFf "$JOBS_FILE" <<< "$queued")
+
+# Next chunks of an array with failed tasks never start (afterok); their jobs are resubmitted like lost ones
+stuck=$(awk '$2 == "DependencyNeverSatisfied" {print $1}' <<< "$queued" | sort -u)
+if [[ -n "$stuck" ]]; then
+    echo "Cancelling chunks that cannot start anymore: $(paste -sd' ' <<< "$stuck")"
+    scancel $stuck
+fi
+active=$(awk '$2 != "DependencyNeverSatisfied" {print $1}' <<< "$queued" | sort -u | paste -sd:)
+if [[ -n "$active" ]]; then
+    resume_job=$(sbatch --parsable --dependency=afterany:$active utilities/resume_batch.sh)
+    echo "Inference jobs $active are still queued, resuming after them: job $resume_job"
+    exit 0
+fi
+
+if ! python3 utilities/pipeline_controller.py resume-batch "$RUN_DIR"; then
+    echo "Error: could not resubmit the jobs of run $PIPELINE_RUN_ID (retry with: bash utilities/resume_run.sh $PIPELINE_RUN_ID)." >&2
+    exit 1
+fi
+python3 utilities/run_ledger.py show "$RUN_DIR" --states none
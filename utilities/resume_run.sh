@@ -0,0 +1,53 @@
+#!/usr/bin/env bash
+
+# Restart a run from its ledger: jobs that were given up, failed or lost get new retries, finished jobs and seeds are
+# kept. Streaming runs (STREAMING=true) get a new controller, other runs get their unfinished jobs resubmitted
+# (out-of-memory jobs on the next larger GPU profile). Run from the working directory:
+# bash utilities/resume_run.sh <PIPELINE_RUN_ID>
+
+if [[ $# -ne 1 ]]; then
+    echo "Usage: bash utilities/resume_run.sh <PIPELINE_RUN_ID>" >&2
+    exit 1
+fi
+RUN_DIR=pending_jobs/$1
+
+if [[ ! -f "$RUN_DIR/run_env.sh" ]]; then
+    echo "Error: $RUN_DIR has no run_env.sh (runs submitted before resuming was supported cannot be resumed)." >&2
+    exit 1
+fi
+source "$RUN_DIR/run_env.sh"
+
+if [[ "${STREAMING:-false}" != "true" ]]; then
+    # The ledger cannot tell a job that is still queued from a lost one
+    active=$(squeue -h -u "$USER" -n AF3_datapipeline,AF3_part_2,AF3_inference,AF3_node,AF3_resume -o "%i" 2>/dev/null | wc -l)
+    if (( active > 0 )); then
+        echo "Error: $active pipeline task(s) are still in the queue, resume once they ended." >&2
+        exit 1
+    fi
+    if ! python3 utilities/pipeline_controller.py resume-batch "$RUN_DIR"; then
+        echo "Error: could not resubmit the jobs of run $1." >&2
+        exit 1
+    fi
+    python3 utilities/run_ledger.py show "$RUN_DIR" --states none
+    echo "Resumed run $1."
+    exit 0
+fi
+
+if [[ "$(jq -r '.index' "$RUN_DIR/inference_plan.json" 2>/dev/null)" != "stream" ]]; then
+    echo "Error: $RUN_DIR has no streaming job plan yet (the controller did not run)." >&2
+    exit 1
+fi
+if [[ -f "$RUN_DIR/controller_job" && -n "$(squeue -h -j "$(cat "$RUN_DIR/controller_job")" 2>/dev/null)" ]]; then
+    echo "Error: the controller of run $1 is still active (job $(cat "$RUN_DIR/controller_job"))." >&2
+    exit 1
+fi
+
+if ! python3 utilities/pipeline_controller.py resume "$RUN_DIR"; then
+    echo "Error: could not prepare run $1 for resuming." >&2
+    exit 1
+fi
+python3 utilities/run_ledger.py show "$RUN_DIR" --states none
+
+controller_job=$(sbatch --parsable utilities/pipeline_controller.sh)
+echo "$controller_job" > "$RUN_DIR/controller_job"
+echo "Resumed run $1: controller job $controller_job"
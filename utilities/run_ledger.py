@@ -0,0 +1,95 @@
+import os
+import sys
+import json
+import fcntl
+import argparse
+from collections import Counter
+
+LEDGER_FILE = "ledger.jsonl"  # pending_jobs/<PIPELINE_RUN_ID>/ledger.jsonl
+# Final states of array tasks that ended without writing their own ledger record (sacct -o State)
+SACCT_REASONS = {
+    "TIMEOUT": "timeout",
+    "DEADLINE": "timeout",
+    "OUT_OF_MEMORY": "host_oom",
+    "NODE_FAIL": "node_fail",
+    "BOOT_FAIL": "node_fail",
+    "PREEMPTED": "preempted",
+    "CANCELLED": "cancelled",
+}
+
+# Record states:
+#   done       written by the task, the result is complete
+#   failed     written by the task (reason: oom, timeout, error, no_input) or by the controller for tasks that
+#              died without a record (reason from SACCT_REASONS, else "lost")
+#   queued     written by the controller for a retry (retry_of, attempt, seeds, merge_into)
+#   retried    written by the controller for a failed job once its retries are queued (retries)
+#   abandoned  written by the controller when no retry is left (reason)
+
+
+def ledger_key(record):
+    return record["stage"], record.get("profile"), record["id"]
+
+def append_records(run_dir, records):
+    """Append records under an exclusive lock (the task scripts use flock on the same file)."""
+    lines = "".join(json.dumps(record, separators=(",", ":")) + "\n" for record in records)
+    with open(os.path.join(run_dir, LEDGER_FILE), "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        f.write(lines)
+        f.flush()
+        fcntl.flock(f, fcntl.LOCK_UN)
+
+def load_ledger(run_dir):
+    """(stage, profile, id) -> latest record. Truncated lines (e.g. from a killed writer) are ignored."""
+    ledger = {}
+    try:
+        with open(os.path.join(run_dir, LEDGER_FILE), "r") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                ledger[ledger_key(record)] = record
+    except FileNotFoundError:
+        pass
+    return ledger
+
+def counts(ledger):
+    """(stage, state) -> number of jobs."""
+    return Counter((stage, record["state"]) for (stage, _, _), record in ledger.items())
+
+def show(run_dir, states):
+    ledger = load_ledger(run_dir)
+    for (stage, state), n in sorted(counts(ledger).items()):
+        print(f"{stage:<13} {state:<10} {n:>8}")
+    for (stage, profile, job_id), record in sorted(ledger.items(), key=lambda item: str(item[0])):
+        if record["state"] in states:
+            print(f"{stage}\t{profile or '-'}\t{job_id}\t{record.get('name') or ''}\t{record['state']}\t{record.get('reason') or ''}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Per-run ledger of data pipeline and inference job states.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    p_show = subparsers.add_parser("show", help="Print job counts per state and the jobs in the given states")
+    p_show.add_argument("run_dir", help="pending_jobs/<PIPELINE_RUN_ID>")
+    p_show.add_argument("--states", default="failed,abandoned", help="Comma-separated states to list")
+    p_get = subparsers.add_parser("get", help="Print a field of the latest record of a job (empty if not set)")
+    p_get.add_argument("run_dir", help="pending_jobs/<PIPELINE_RUN_ID>")
+    p_get.add_argument("stage", choices=["datapipeline", "inference"])
+    p_get.add_argument("profile", help="GPU profile ('-' for data pipeline jobs)")
+    p_get.add_argument("id", type=int)
+    p_get.add_argument("field")
+    args = parser.parse_args()
+
+    if args.command == "get":
+        record = load_ledger(args.run_dir).get((args.stage, None if args.profile == "-" else args.profile, args.id))
+        value = (record or {}).get(args.field)
+        print("" if value is None else value if isinstance(value, str) else json.dumps(value))
+        return
+
+    if args.command == "show":
+        if not os.path.exists(os.path.join(args.run_dir, LEDGER_FILE)):
+            print(f"Error: no ledger in {args.run_dir}", file=sys.stderr)
+            sys.exit(1)
+        show(args.run_dir, set(args.states.split(",")))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,239 @@
+import os
+import sys
+import json
+import heapq
+import random
+import shutil
+import argparse
+import tempfile
+from job_plan import load_plan, decode, padded_size, TABLE_FILE, PLAN_FILE
+from pipeline_controller import tick
+from run_ledger import append_records
+from datapipeline_sizing import load_classes, SearchTimeModel, plan_arrays, ARRAYS_FILE
+
+
+class SimulatedSlurm:
+    """
+    In-memory stand-in for sbatch/squeue with the interface of pipeline_controller.SlurmCLI.
+    Array tasks start in submission order when a slot of their partition (or GPU type) is free and
+    report to the run's ledger when they finish, like the real task scripts do.
+    """
+
+    def __init__(self, run_dir, slots, duration, dp_names, failure_rate=0.0, seed=0, failure_reason="error"):
+        self.run_dir = run_dir
+        self.slots = slots            # partition or gres -> parallel tasks
+        self.duration = duration      # (job, task index) -> minutes
+        self.dp_names = dp_names      # DATA_PIPELINE_ID -> protein name
+        self.failure_rate = failure_rate
+        self.failure_reason = failure_reason  # of failed inference jobs
+        self.random = random.Random(seed)
+        self.clock = 0.0
+        self.next_id = 1000
+        self.jobs = {}
+        self.pending = []             # (job id, task index) in submission order
+        self.running = []             # heap of (end time, job id, task index)
+        self.ready = set()            # proteins whose data pipeline task succeeded
+        self.submissions = 0
+        self.busy_minutes = {}        # slot key -> summed task minutes
+        self.first_start = {}         # script -> first task start
+
+    def sbatch(self, args):
+        job = {"exports": {}, "partition": None, "gres": None, "tasks": 0, "active": 0}
+        for arg in args:
+            if arg.startswith("--array=0-"):
+                job["tasks"] = int(arg.split("-")[-1]) + 1
+            elif arg.startswith("--partition="):
+                job["partition"] = arg.split("=", 1)[1]
+            elif arg.startswith("--gres="):
+                job["gres"] = arg.split("=", 1)[1].rsplit(":", 1)[0]
+            elif arg.startswith("--export="):
+                for item in arg.split("=", 1)[1].split(",")[1:]:
+                    key, _, value = item.partition("=")
+                    job["exports"][key] = value
+            elif not arg.startswith("--"):
+                job["script"] = os.path.basename(arg)
+        job_id = str(self.next_id)
+        self.next_id += 1
+        job["active"] = job["tasks"]
+        self.jobs[job_id] = job
+        self.pending.extend((job_id, i) for i in range(job["tasks"]))
+        self.submissions += 1
+        self._schedule()
+        return job_id
+
+    def active_tasks(self, job_ids):
+        return {j: self.jobs[j]["active"] for j in job_ids if j in self.jobs and self.jobs[j]["active"]}
+
+    def task_states(self, job_id):
+        return {}  # every simulated task writes its ledger record
+
+    def _slot_key(self, job):
+        return job["gres"] or job["partition"]
+
+    def _schedule(self):
+        in_use = {}
+        for _, job_id, _ in self.running:
+            key = self._slot_key(self.jobs[job_id])
+            in_use[key] = in_use.get(key, 0) + 1
+        waiting = []
+        for job_id, task in self.pending:
+            job = self.jobs[job_id]
+            key = self._slot_key(job)
+            if in_use.get(key, 0) < self.slots.get(key, self.slots.get("default", 1)):
+                in_use[key] = in_use.get(key, 0) + 1
+                minutes = self.duration(job, task)
+                heapq.heappush(self.running, (self.clock + minutes, job_id, task))
+                self.busy_minutes[key] = self.busy_minutes.get(key, 0) + minutes
+                self.first_start.setdefault(job["script"], self.clock)
+            else:
+                waiting.append((job_id, task))
+        self.pending = waiting
+
+    def _finish(self, job_id, task):
+        job = self.jobs[job_id]
+        job["active"] -= 1
+        exports = job["exports"]
+        records = []
+        failed = self.random.random() < self.failure_rate
+        if job["script"] == "af3_datapipeline_only_slurm.sh":
+            for dp_id in datapipeline_ids(exports, task):
+                if not failed:
+                    self.ready.add(self.dp_names[dp_id])
+                records.append({"stage": "datapipeline", "id": dp_id, "name": self.dp_names[dp_id],
+                                "state": "failed" if failed else "done", "reason": "error" if failed else None})
+        else:
+            plan = load_plan(self.run_dir)
+            pack = int(exports["JOBS_PER_TASK"])
+            first = int(exports["RANGE_START"]) + task * pack
+            for inference_id in range(first, min(first + pack - 1, int(exports["RANGE_END"])) + 1):
+                seeds = decode(plan, self.run_dir, exports["GPU_PROFILE"], inference_id)[2]
+                records.append({"stage": "inference", "profile": exports["GPU_PROFILE"], "id": inference_id,
+                                "state": "failed" if failed else "done", "reason": self.failure_reason if failed else None,
+                                "seeds": seeds, "seeds_done": [] if failed else seeds})
+        append_records(self.run_dir, records)
+
+    def advance(self, minutes):
+        """Let the simulated cluster run for some minutes."""
+        target = self.clock + minutes
+        while self.running and self.running[0][0] <= target:
+            end, job_id, task = heapq.heappop(self.running)
+            self.clock = end
+            self._finish(job_id, task)
+            self._schedule()
+        self.clock = target
+
+    def ready_monomers(self, plan, names):
+        return set(names) & self.ready
+
+def datapipeline_ids(exports, task):
+    """DATA_PIPELINE_IDs of a data pipeline array task (as computed by af3_datapipeline_only_slurm.sh)."""
+    pack = int(exports["DP_JOBS_PER_TASK"])
+    first = int(exports["DP_RANGE_START"]) + (int(exports["START_OFFSET"]) + task) * pack
+    return range(first, min(first + pack - 1, int(exports["DP_RANGE_END"])) + 1)
+
+def scratch_copy(run_dir):
+    """Copy of the plan with empty index tables, so a simulation never touches the real run."""
+    plan = load_plan(run_dir)
+    scratch = tempfile.mkdtemp(prefix="af3_sim_")
+    shutil.copy(os.path.join(run_dir, PLAN_FILE), scratch)
+    for profile in plan["profiles"]:
+        os.makedirs(os.path.join(scratch, profile))
+        open(os.path.join(scratch, profile, TABLE_FILE), "wb").close()
+    return scratch
+
+def simulate(run_dir, cluster_conf, args):
+    scratch = scratch_copy(run_dir)
+    plan = load_plan(scratch)
+    if plan["index"] != "stream":
+        print("Error: simulation needs a streaming plan (STREAMING=true).", file=sys.stderr)
+        sys.exit(1)
+    # DATA_PIPELINE_IDs by decreasing length as in make_datapipeline_inputs.py
+    dp_names = sorted(sorted(plan["sequences"]), key=lambda name: -len(plan["sequences"][name]))
+    classes = load_classes(cluster_conf)
+    dp_arrays = plan_arrays([len(plan["sequences"][n]) for n in dp_names], classes, SearchTimeModel([], classes),
+                            args.monomers_per_task, 0, args.max_array_size)
+    with open(os.path.join(scratch, ARRAYS_FILE), "w") as f:
+        json.dump(dp_arrays, f)
+
+    def duration(job, task):
+        exports = job["exports"]
+        if job["script"] == "af3_datapipeline_only_slurm.sh":
+            return sum(args.dp_base_minutes + args.dp_minutes_per_residue * len(plan["sequences"][dp_names[dp_id]])
+                       for dp_id in datapipeline_ids(exports, task))
+        pack = int(exports["JOBS_PER_TASK"])
+        first = int(exports["RANGE_START"]) + task * pack
+        minutes = args.task_overhead_minutes
+        current = load_plan(scratch)  # retries may add GPU profiles
+        for inference_id in range(first, min(first + pack - 1, int(exports["RANGE_END"])) + 1):
+            names, compound, seeds = decode(current, scratch, exports["GPU_PROFILE"], inference_id)
+            tokens = sum(len(plan["sequences"][n]) for n in names) + (compound["Atoms"] if compound else 0)
+            minutes += len(seeds) * args.seed_minutes_per_1k_tokens * padded_size(tokens, plan["buckets"]) / 1000
+        return minutes
+
+    slots = {args.dp_partition: args.dp_slots, "default": args.gpu_slots}
+    slurm = SimulatedSlurm(scratch, slots, duration, dp_names, args.failure_rate, args.seed, args.failure_reason)
+    env = dict(os.environ)
+    env.update({
+        "TOTAL_DATAPIPELINE_JOBS": str(len(dp_names)), "MAX_ARRAY_SIZE": str(args.max_array_size),
+        "MAX_SUBMIT_JOBS": str(args.max_submit_jobs), "RESULTS_PER_DIR": str(args.results_per_dir),
+        "JOBS_PER_TASK": str(args.jobs_per_task), "SEEDS": ",".join(str(s) for s in plan["seeds"]),
+        "DATAPIPELINE_PARTITION": args.dp_partition, "INFERENCE_PARTITION": args.gpu_partition,
+    })
+    env.pop("INPUT_FILE", None)
+
+    ticks = 0
+    stderr = sys.stderr
+    try:
+        with open(os.devnull, "w") as devnull:
+            sys.stderr = devnull if not args.verbose else stderr
+            while not tick(scratch, slurm, env, cluster_conf, ready_func=slurm.ready_monomers):
+                ticks += 1
+                slurm.advance(args.interval)
+    finally:
+        sys.stderr = stderr
+    gpu_busy = {key: m for key, m in slurm.busy_minutes.items() if key != args.dp_partition}
+    gpu_capacity = slurm.clock * args.gpu_slots * len(gpu_busy)
+    result = {
+        "makespan_minutes": round(slurm.clock, 1),
+        "first_inference_start_minutes": slurm.first_start.get("af3_inference_only_slurm.sh"),
+        "controller_runs": ticks + 1,
+        "sbatch_calls": slurm.submissions,
+        "gpu_utilization": round(sum(gpu_busy.values()) / gpu_capacity, 3) if gpu_capacity else None,
+    }
+    shutil.rmtree(scratch)
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the streaming controller against a simulated SLURM cluster.")
+    parser.add_argument("--cluster-config", default=os.environ.get("CLUSTER_CONFIG"), help="Cluster configuration JSON")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    p_sim = subparsers.add_parser("simulate", help="Simulate a planned streaming run (all monomers still to compute)")
+    p_sim.add_argument("run_dir", help="pending_jobs/<PIPELINE_RUN_ID> with a streaming plan")
+    p_sim.add_argument("--dp-slots", type=int, default=50, help="Parallel data pipeline tasks")
+    p_sim.add_argument("--gpu-slots", type=int, default=8, help="Parallel inference tasks per GPU type")
+    p_sim.add_argument("--interval", type=float, default=5, help="Minutes between controller runs")
+    p_sim.add_argument("--max-array-size", type=int, default=1001)
+    p_sim.add_argument("--max-submit-jobs", type=int, default=5000)
+    p_sim.add_argument("--results-per-dir", type=int, default=250)
+    p_sim.add_argument("--jobs-per-task", type=int, default=1)
+    p_sim.add_argument("--monomers-per-task", type=int, default=1, help="Data pipeline monomers per task")
+    p_sim.add_argument("--dp-base-minutes", type=float, default=20)
+    p_sim.add_argument("--dp-minutes-per-residue", type=float, default=0.1)
+    p_sim.add_argument("--seed-minutes-per-1k-tokens", type=float, default=2)
+    p_sim.add_argument("--task-overhead-minutes", type=float, default=3)
+    p_sim.add_argument("--failure-rate", type=float, default=0.0)
+    p_sim.add_argument("--failure-reason", choices=("error", "oom", "timeout"), default="error",
+                       help="Reason reported by failed inference jobs")
+    p_sim.add_argument("--seed", type=int, default=0, help="Random seed for failures")
+    p_sim.add_argument("--dp-partition", default="datapipeline")
+    p_sim.add_argument("--gpu-partition", default="inference")
+    p_sim.add_argument("--verbose", action="store_true", help="Show the controller output")
+    args = parser.parse_args()
+
+    with open(args.cluster_config, "r") as f:
+        cluster_conf = json.load(f)
+    if args.command == "simulate":
+        print(json.dumps(simulate(args.run_dir, cluster_conf, args), indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,271 @@
+import os
+import csv
+import json
+import sqlite3
+import argparse
+from datetime import datetime
+from walltime_predictor import quantile, record_seeds, TIME_FORMAT
+
+DEFAULT_DB = "statistics.sqlite"
+# Scalar fields of the inference statistics records (af3_confidences goes to inference_samples)
+INFERENCE_COLUMNS = ("pipeline_run_id", "gpu_profile", "inference_id", "name", "compound_id", "array_job", "array_task",
+                     "hostname", "tokens", "bucket_size", "start_time", "end_time", "jobs_in_task", "num_seeds",
+                     "seed_shard", "jax_cache_hit", "compile_seconds", "staging_seconds", "startup_seconds",
+                     "featurisation_seconds", "model_seconds", "extraction_seconds", "output_seconds",
+                     "confidences_seconds", "seeds_inferred", "outcome")
+# Completed jobs and their seeds (records from before the outcome was recorded count as completed with all seeds)
+COMPLETED = "(outcome IS NULL OR outcome = 'done')"
+SEEDS = "COALESCE(NULLIF(seeds_inferred, 0), num_seeds)"
+SAMPLE_COLUMNS = ("ranking_score", "ptm", "iptm", "fraction_disordered", "has_clash")
+DATAPIPELINE_COLUMNS = ("pipeline_run_id", "datapipeline_id", "datapipeline_name", "job_id", "task_id", "node",
+                        "sequence_length", "start_time", "end_time", "db_staging_seconds", "search_seconds", "cpus",
+                        "jobs_in_task", "input_copy_seconds", "startup_seconds", "msa_extraction_seconds")
+# Phases of the time of a job: (name, column, measured once per task and shared by the jobs_in_task jobs of the task)
+INFERENCE_PHASES = (("input staging", "staging_seconds", True), ("container startup", "startup_seconds", True),
+                    ("featurisation", "featurisation_seconds", False), ("compilation", "compile_seconds", False),
+                    ("inference", "model_seconds", False), ("extraction", "extraction_seconds", False),
+                    ("output writing", "output_seconds", False), ("confidences", "confidences_seconds", False))
+DATAPIPELINE_PHASES = (("database staging", "db_staging_seconds", True), ("input copy", "input_copy_seconds", True),
+                       ("container startup", "startup_seconds", True), ("search", "search_seconds", False),
+                       ("MSA extraction", "msa_extraction_seconds", False))
+
+
+def connect(db_path):
+    """Open the database and create or extend its tables (columns added by later versions are appended)."""
+    conn = sqlite3.connect(db_path)
+    conn.execute("CREATE TABLE IF NOT EXISTS ingested_files (path TEXT PRIMARY KEY, inode INTEGER, offset INTEGER)")
+    tables = {
+        "inference_jobs": ("id INTEGER PRIMARY KEY", "source TEXT", "seconds REAL") + INFERENCE_COLUMNS,
+        "inference_samples": ("job_id INTEGER", "seed INTEGER", "sample INTEGER") + SAMPLE_COLUMNS,
+        "datapipeline_jobs": ("source TEXT", "seconds REAL") + DATAPIPELINE_COLUMNS,
+    }
+    for table, columns in tables.items():
+        conn.execute(f"CREATE TABLE IF NOT EXISTS {table} ({', '.join(columns)})")
+        existing = {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+        for column in columns:
+            if column.split()[0] not in existing:
+                conn.execute(f"ALTER TABLE {table} ADD COLUMN {column}")
+    conn.execute("CREATE INDEX IF NOT EXISTS samples_by_job ON inference_samples (job_id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS samples_by_score ON inference_samples (ranking_score)")
+    conn.execute("CREATE INDEX IF NOT EXISTS jobs_by_source ON inference_jobs (source)")
+    conn.execute("CREATE INDEX IF NOT EXISTS datapipeline_by_source ON datapipeline_jobs (source)")
+    return conn
+
+def seconds_between(start, end):
+    try:
+        return (datetime.strptime(end, TIME_FORMAT) - datetime.strptime(start, TIME_FORMAT)).total_seconds()
+    except (TypeError, ValueError):
+        return None
+
+def new_lines(conn, path, tables):
+    """
+    Complete lines appended to a statistics file since the last ingestion, as (offset of the line, line).
+    A file that was replaced or truncated (different inode, shorter than the offset) is read again from the start
+    after dropping its rows from tables.
+    """
+    source = os.path.realpath(path)
+    st = os.stat(source)
+    row = conn.execute("SELECT inode, offset FROM ingested_files WHERE path = ?", (source,)).fetchone()
+    offset = 0
+    if row and row[0] == st.st_ino and row[1] <= st.st_size:
+        offset = row[1]
+    elif row:
+        for table in tables:
+            if table == "inference_jobs":
+                conn.execute("DELETE FROM inference_samples WHERE job_id IN (SELECT id FROM inference_jobs WHERE source = ?)", (source,))
+            conn.execute(f"DELETE FROM {table} WHERE source = ?", (source,))
+    with open(source, "rb") as f:
+        f.seek(offset)
+        for line in f:
+            if not line.endswith(b"\n"):
+                break  # still being written
+            yield offset, line.decode()
+            offset += len(line)
+    conn.execute("INSERT OR REPLACE INTO ingested_files VALUES (?, ?, ?)", (source, st.st_ino, offset))
+
+def sample_rows(confidences):
+    """(seed, sample, ranking_score, ptm, iptm, ...) per 'seed-<n>_sample-<m>' entry of af3_confidences."""
+    rows = []
+    for key, values in (confidences or {}).items():
+        try:
+            seed_part, sample_part = key.split("_")
+            seed, sample = int(seed_part[len("seed-"):]), int(sample_part[len("sample-"):])
+        except ValueError:
+            continue
+        rows.append((seed, sample) + tuple(values.get(column) for column in SAMPLE_COLUMNS))
+    return rows
+
+def ingest_inference(conn, path):
+    source = os.path.realpath(path)
+    jobs = 0
+    for _, line in new_lines(conn, path, ("inference_jobs",)):
+        try:
+            record = json.loads(line)
+        except json.JSONDecodeError:
+            continue
+        values = [record.get(column) for column in INFERENCE_COLUMNS]
+        values = [int(v) if isinstance(v, bool) else v for v in values]
+        cursor = conn.execute(
+            f"INSERT INTO inference_jobs (source, seconds, {', '.join(INFERENCE_COLUMNS)}) "
+            f"VALUES ({', '.join('?' * (len(INFERENCE_COLUMNS) + 2))})",
+            [source, seconds_between(record.get("start_time"), record.get("end_time"))] + values)
+        if not record.get("num_seeds"):
+            conn.execute("UPDATE inference_jobs SET num_seeds = ? WHERE id = ?", (record_seeds(record), cursor.lastrowid))
+        conn.executemany(f"INSERT INTO inference_samples VALUES ({', '.join('?' * (len(SAMPLE_COLUMNS) + 3))})",
+                         [(cursor.lastrowid,) + row for row in sample_rows(record.get("af3_confidences"))])
+        jobs += 1
+    return jobs
+
+def csv_value(value):
+    for convert in (int, float):
+        try:
+            return convert(value)
+        except ValueError:
+            pass
+    return value or None
+
+def ingest_datapipeline(conn, path):
+    source = os.path.realpath(path)
+    header = None
+    rows = 0
+    for offset, line in new_lines(conn, path, ("datapipeline_jobs",)):
+        fields = next(csv.reader([line]))
+        if offset == 0:
+            header = fields
+            continue
+        if header is None:
+            with open(source, "r", newline="") as f:
+                header = next(csv.reader(f))
+        record = dict(zip(header, fields))
+        values = [csv_value(record.get(column, "")) for column in DATAPIPELINE_COLUMNS]
+        seconds = csv_value(record.get("search_seconds", ""))
+        if seconds is None:
+            seconds = seconds_between(record.get("start_time"), record.get("end_time"))
+        conn.execute(f"INSERT INTO datapipeline_jobs (source, seconds, {', '.join(DATAPIPELINE_COLUMNS)}) "
+                     f"VALUES ({', '.join('?' * (len(DATAPIPELINE_COLUMNS) + 2))})",
+                     [source, seconds] + values)
+        rows += 1
+    return rows
+
+def print_top(conn, n, run_id=None):
+    """Best sample of the n jobs with the highest ranking score."""
+    rows = conn.execute(
+        "SELECT j.pipeline_run_id, j.name, j.compound_id, s.seed, s.sample, s.ranking_score, s.iptm, s.ptm "
+        "FROM inference_samples s JOIN inference_jobs j ON j.id = s.job_id "
+        "WHERE s.ranking_score IS NOT NULL AND (? IS NULL OR j.pipeline_run_id = ?) "
+        "ORDER BY s.ranking_score DESC", (run_id, run_id))
+    print(f"{'run':<20} {'name':<40} {'compound':<12} {'seed':>6} {'sample':>6} {'score':>7} {'iptm':>6} {'ptm':>6}")
+    seen = set()
+    for run, name, compound, seed, sample, score, iptm, ptm in rows:
+        if (run, name) in seen:
+            continue
+        seen.add((run, name))
+        iptm, ptm = (f"{v:.3f}" if v is not None else "-" for v in (iptm, ptm))
+        print(f"{str(run):<20} {name:<40} {compound or '':<12} {seed:>6} {sample:>6} {score:>7.3f} {iptm:>6} {ptm:>6}")
+        if len(seen) == n:
+            break
+
+def print_gpu_hours(conn, run_id=None):
+    """
+    GPU-hours per profile (every inference task runs on one GPU) of completed jobs, and GPU-hours lost to jobs
+    that ran out of memory or time or failed otherwise.
+    """
+    print(f"{'profile':<12} {'jobs':>8} {'seeds':>8} {'GPU-hours':>10} {'min/seed':>9} {'lost hours':>10}")
+    rows = conn.execute(
+        f"SELECT gpu_profile, SUM({COMPLETED}), SUM(CASE WHEN {COMPLETED} THEN {SEEDS} END), "
+        f"SUM(CASE WHEN {COMPLETED} THEN seconds END) / 3600.0, "
+        f"SUM(CASE WHEN {COMPLETED} THEN seconds END) / 60.0 / SUM(CASE WHEN {COMPLETED} THEN {SEEDS} END), "
+        f"SUM(CASE WHEN {COMPLETED} THEN 0 ELSE seconds END) / 3600.0 "
+        f"FROM inference_jobs WHERE seconds > 0 AND (? IS NULL OR pipeline_run_id = ?) "
+        f"GROUP BY gpu_profile ORDER BY gpu_profile", (run_id, run_id))
+    for profile, jobs, seeds, hours, per_seed, lost in rows:
+        print(f"{str(profile):<12} {jobs:>8} {seeds or 0:>8} {hours or 0:>10.1f} {per_seed or 0:>9.2f} {lost:>10.1f}")
+
+def print_tokens(conn, run_id=None):
+    """Minutes per seed over the AF3 bucket size per profile (median and 95% quantile) of completed jobs."""
+    samples = {}
+    rows = conn.execute(
+        f"SELECT gpu_profile, bucket_size, seconds / 60.0 / {SEEDS} FROM inference_jobs "
+        f"WHERE {COMPLETED} AND seconds > 0 AND {SEEDS} > 0 AND bucket_size IS NOT NULL "
+        f"AND (? IS NULL OR pipeline_run_id = ?)", (run_id, run_id))
+    for profile, bucket, minutes in rows:
+        samples.setdefault((str(profile), bucket), []).append(minutes)
+    print(f"{'profile':<12} {'bucket':>6} {'jobs':>8} {'median':>8} {'p95':>8}")
+    for (profile, bucket), values in sorted(samples.items()):
+        print(f"{profile:<12} {bucket:>6} {len(values):>8} {quantile(values, 0.5):>8.2f} {quantile(values, 0.95):>8.2f}")
+
+def phase_hours(rows, phases, in_call):
+    """
+    Hours per phase over rows of (seconds, jobs_in_task, phase columns...). Time of the AlphaFold call (seconds) not
+    covered by the phases in in_call goes to "other"; for a task with a single job it includes the container startup.
+    """
+    totals = dict.fromkeys([name for name, _, _ in phases] + ["other"], 0.0)
+    for seconds, jobs_in_task, *values in rows:
+        jobs_in_task = jobs_in_task or 1
+        covered = 0.0
+        for (name, column, per_task), value in zip(phases, values):
+            value = value or 0.0
+            totals[name] += value / jobs_in_task if per_task else value
+            if name in in_call and (not per_task or jobs_in_task == 1):
+                covered += value
+        totals["other"] += max(0.0, (seconds or 0.0) - covered)
+    return {name: total / 3600.0 for name, total in totals.items()}
+
+def print_phase_table(title, hours):
+    total = sum(hours.values())
+    print(f"{title:<20} {'hours':>10} {'share':>7}")
+    for name, value in hours.items():
+        print(f"{name:<20} {value:>10.2f} {100.0 * value / total if total else 0.0:>6.1f}%")
+    print(f"{'total':<20} {total:>10.2f}")
+
+def print_phases(conn, run_id=None):
+    """Time of the inference and data pipeline jobs broken down by phase (jobs with phase timings only)."""
+    columns = ", ".join(column for _, column, _ in INFERENCE_PHASES)
+    rows = conn.execute(f"SELECT seconds, jobs_in_task, {columns} FROM inference_jobs "
+                        f"WHERE staging_seconds IS NOT NULL AND (? IS NULL OR pipeline_run_id = ?)", (run_id, run_id))
+    print_phase_table("inference phase", phase_hours(rows.fetchall(), INFERENCE_PHASES, (
+        "container startup", "featurisation", "compilation", "inference", "extraction", "output writing")))
+    print()
+    # search_seconds is the whole AlphaFold call of a single-monomer task, which includes the container startup
+    columns = ", ".join(column for _, column, _ in DATAPIPELINE_PHASES)
+    rows = conn.execute(f"SELECT seconds, jobs_in_task, {columns} FROM datapipeline_jobs "
+                        f"WHERE input_copy_seconds IS NOT NULL AND (? IS NULL OR pipeline_run_id = ?)", (run_id, run_id))
+    rows = [(seconds, jobs, db, copy, startup,
+             search - (startup or 0) if (jobs or 1) == 1 and search is not None else search, extract)
+            for seconds, jobs, db, copy, startup, search, extract in rows]
+    print_phase_table("data pipeline phase", phase_hours(rows, DATAPIPELINE_PHASES, ("container startup", "search")))
+
+def main():
+    parser = argparse.ArgumentParser(description="SQLite store of the inference and data pipeline statistics.")
+    parser.add_argument("--db", default=os.environ.get("STATISTICS_DB", DEFAULT_DB), help="SQLite database")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    p_ingest = subparsers.add_parser("ingest", help="Add the records appended to the statistics files since the last ingestion")
+    p_ingest.add_argument("--inference", default=os.environ.get("INFERENCE_STATISTICS_FILE"), help="Inference statistics JSONL")
+    p_ingest.add_argument("--datapipeline", default=os.environ.get("DATAPIPELINE_STATISTICS_FILE"), help="Data pipeline statistics CSV")
+    p_top = subparsers.add_parser("top", help="Jobs with the highest ranking score")
+    p_top.add_argument("-n", type=int, default=20)
+    p_gpu = subparsers.add_parser("gpu-hours", help="GPU-hours and minutes per seed per GPU profile, GPU-hours of failed jobs")
+    p_tokens = subparsers.add_parser("tokens", help="Minutes per seed over the bucket size per GPU profile")
+    p_phases = subparsers.add_parser("phases", help="Inference and data pipeline time broken down by phase")
+    for p in (p_top, p_gpu, p_tokens, p_phases):
+        p.add_argument("--run", help="Only this PIPELINE_RUN_ID")
+    args = parser.parse_args()
+
+    conn = connect(args.db)
+    with conn:
+        if args.command == "ingest":
+            for path, ingest in ((args.inference, ingest_inference), (args.datapipeline, ingest_datapipeline)):
+                if path and os.path.exists(path):
+                    print(f"{path}: {ingest(conn, path)} new records")
+        elif args.command == "top":
+            print_top(conn, args.n, args.run)
+        elif args.command == "gpu-hours":
+            print_gpu_hours(conn, args.run)
+        elif args.command == "tokens":
+            print_tokens(conn, args.run)
+        elif args.command == "phases":
+            print_phases(conn, args.run)
+    conn.close()
+
+if __name__ == "__main__":
+    main()
@@ -3,41 +3,6 @@ set -euo pipefail
 
 export PIPELINE_RUN_ID="run-$(date +%Y%m%d-%H%M)"
 
-# Parse cluster settings
-export AF3_CONTAINER_PATH=$(jq -r '.af3_container_path' "$CLUSTER_CONFIG")
-export AF3_MODEL_PATH=$(jq -r '.af3_model_path' "$CLUSTER_CONFIG")
-export AF3_DB_PATH=$(jq -r '.af3_db_path' "$CLUSTER_CONFIG")
-
-# Validate paths
-if [ ! -f "$AF3_CONTAINER_PATH" ]; then
-    echo "Error: AF3_CONTAINER_PATH does not point to a file: $AF3_CONTAINER_PATH" >&2
-    exit 1
-fi
-
-if [ ! -d "$AF3_MODEL_PATH" ]; then
-    echo "Error: AF3_MODEL_PATH does not point to a directory: $AF3_MODEL_PATH" >&2
-    exit 1
-fi
-
-if [ ! -d "$AF3_DB_PATH" ]; then
-    echo "Error: AF3_DB_PATH does not point to a directory: $AF3_DB_PATH" >&2
-    exit 1
-fi
-
-export DATAPIPELINE_PARTITION=$(jq -r '.datapipeline_partition' "$CLUSTER_CONFIG")
-export INFERENCE_PARTITION=$(jq -r '.inference_partition' "$CLUSTER_CONFIG")
-
-check_partition() {
-    local partition=$1
-    if ! sinfo -h -o "%R" | awk -v p="$partition" '$1 == p {found=1} END {exit !found}'; then
-        echo "Error: SLURM partition '$partition' is not available on this cluster" >&2
-        exit 1
-    fi
-}
-
-check_partition "$DATAPIPELINE_PARTITION"
-check_partition "$INFERENCE_PARTITION"
-
 # MODE must be cartesian or collapsed
 if [[ "$MODE" != "cartesian" && "$MODE" != "collapsed" ]]; then
     echo "ERROR: MODE must be 'cartesian' or 'collapsed'." >&2
@@ -70,16 +35,132 @@ if ! [[ "${SEEDS:-}" =~ ^[0-9]+(,[0-9]+)*$ ]]; then
     exit 1
 fi
 
+# JOBS_PER_TASK must be an integer > 0
+if ! [[ "${JOBS_PER_TASK:-1}" =~ ^[0-9]+$ ]] || (( ${JOBS_PER_TASK:-1} <= 0 )); then
+    echo "ERROR: JOBS_PER_TASK must be a positive integer." >&2
+    exit 1
+fi
+
+# MONOMERS_PER_TASK must be an integer > 0
+if ! [[ "${MONOMERS_PER_TASK:-1}" =~ ^[0-9]+$ ]] || (( ${MONOMERS_PER_TASK:-1} <= 0 )); then
+    echo "ERROR: MONOMERS_PER_TASK must be a positive integer." >&2
+    exit 1
+fi
+
+# SEEDS_PER_TASK must be an integer >= 0 (0: all seeds of a job in one task)
+if ! [[ "${SEEDS_PER_TASK:-0}" =~ ^[0-9]+$ ]]; then
+    echo "ERROR: SEEDS_PER_TASK must be a non-negative integer." >&2
+    exit 1
+fi
+
+# POSTPROCESSING_WORKERS must be an integer >= 0 (0: one job per inference job), POSTPROCESSING_BATCH_SIZE > 0
+if ! [[ "${POSTPROCESSING_WORKERS:-0}" =~ ^[0-9]+$ ]]; then
+    echo "ERROR: POSTPROCESSING_WORKERS must be a non-negative integer." >&2
+    exit 1
+fi
+if ! [[ "${POSTPROCESSING_BATCH_SIZE:-20}" =~ ^[0-9]+$ ]] || (( ${POSTPROCESSING_BATCH_SIZE:-20} <= 0 )); then
+    echo "ERROR: POSTPROCESSING_BATCH_SIZE must be a positive integer." >&2
+    exit 1
+fi
+
+# VIRTUAL_JOBS must be true or false
+if [[ "${VIRTUAL_JOBS:-false}" != "true" && "${VIRTUAL_JOBS:-false}" != "false" ]]; then
+    echo "ERROR: VIRTUAL_JOBS must be 'true' or 'false'." >&2
+    exit 1
+fi
+
+# STREAMING must be true or false and needs VIRTUAL_JOBS (jobs are added to the plan while the run is going on)
+if [[ "${STREAMING:-false}" != "true" && "${STREAMING:-false}" != "false" ]]; then
+    echo "ERROR: STREAMING must be 'true' or 'false'." >&2
+    exit 1
+elif [[ "${STREAMING:-false}" == "true" && "${VIRTUAL_JOBS:-false}" != "true" ]]; then
+    echo "ERROR: STREAMING=true requires VIRTUAL_JOBS=true." >&2
+    exit 1
+elif [[ "${STREAMING:-false}" == "true" && "${SEEDS_PER_TASK:-0}" != "0" ]]; then
+    echo "ERROR: SEEDS_PER_TASK is not supported with STREAMING=true (the controller splits the seeds of jobs that time out)." >&2
+    exit 1
+fi
+
+# NODE_TYPE must be a node type of the cluster config; whole-node jobs take the place of arrays and seed shards
+if [[ -n "${NODE_TYPE:-}" ]]; then
+    if ! jq -e --arg n "$NODE_TYPE" '.gpu_nodes[$n].devices | length > 0' "$CLUSTER_CONFIG" > /dev/null; then
+        echo "ERROR: NODE_TYPE '$NODE_TYPE' has no devices in gpu_nodes of the cluster config." >&2
+        exit 1
+    elif [[ "${STREAMING:-false}" == "true" || "${SEEDS_PER_TASK:-0}" != "0" ]]; then
+        echo "ERROR: NODE_TYPE is not supported with STREAMING=true or SEEDS_PER_TASK." >&2
+        exit 1
+    elif ! [[ "${NODES:-1}" =~ ^[0-9]+$ ]] || (( ${NODES:-1} <= 0 )); then
+        echo "ERROR: NODES must be a positive integer." >&2
+        exit 1
+    fi
+fi
+
+# SPILL_GPUS is a list of <profile>=<GPUs>; spilled jobs need job files (virtual jobs address profiles by token window)
+if [[ -n "${SPILL_GPUS:-}" ]]; then
+    if ! [[ "$SPILL_GPUS" =~ ^[A-Za-z0-9_.-]+=[0-9]+(,[A-Za-z0-9_.-]+=[0-9]+)*$ ]]; then
+        echo "ERROR: SPILL_GPUS must look like '40g=32,80g=8'." >&2
+        exit 1
+    elif [[ "${VIRTUAL_JOBS:-false}" == "true" ]]; then
+        echo "ERROR: SPILL_GPUS is not supported with VIRTUAL_JOBS=true." >&2
+        exit 1
+    fi
+fi
+
 # RESULTS_PER_DIR must be an integer > 0
 if ! [[ "$RESULTS_PER_DIR" =~ ^[0-9]+$ ]] || (( RESULTS_PER_DIR <= 0 )); then
     echo "ERROR: RESULTS_PER_DIR must be a positive integer." >&2
     exit 1
 fi
 
+# Parse, validate and hash the input file, screen file and cluster config once; later stages read the plan
+RUN_PLAN=pending_jobs/$PIPELINE_RUN_ID/plan.json
+if ! python3 utilities/planner.py; then
+    echo "Validation of input files failed. Aborting."
+    exit 1
+fi
+# The plan of a submission that is not confirmed is removed again
+trap 'rm -rf "pending_jobs/$PIPELINE_RUN_ID"' EXIT
+
+# Parse cluster settings (from the plan, read once by planner.py)
+readarray -t cluster_settings < <(jq -r '.cluster | .af3_container_path, .af3_model_path, .af3_db_path,
+    .datapipeline_partition, .inference_partition' "$RUN_PLAN")
+export AF3_CONTAINER_PATH=${cluster_settings[0]}
+export AF3_MODEL_PATH=${cluster_settings[1]}
+export AF3_DB_PATH=${cluster_settings[2]}
+
+# Validate paths
+if [ ! -f "$AF3_CONTAINER_PATH" ]; then
+    echo "Error: AF3_CONTAINER_PATH does not point to a file: $AF3_CONTAINER_PATH" >&2
+    exit 1
+fi
+
+if [ ! -d "$AF3_MODEL_PATH" ]; then
+    echo "Error: AF3_MODEL_PATH does not point to a directory: $AF3_MODEL_PATH" >&2
+    exit 1
+fi
+
+if [ ! -d "$AF3_DB_PATH" ]; then
+    echo "Error: AF3_DB_PATH does not point to a directory: $AF3_DB_PATH" >&2
+    exit 1
+fi
+
+export DATAPIPELINE_PARTITION=${cluster_settings[3]}
+export INFERENCE_PARTITION=${cluster_settings[4]}
+
+check_partition() {
+    local partition=$1
+    if ! sinfo -h -o "%R" | awk -v p="$partition" '$1 == p {found=1} END {exit !found}'; then
+        echo "Error: SLURM partition '$partition' is not available on this cluster" >&2
+        exit 1
+    fi
+}
+
+check_partition "$DATAPIPELINE_PARTITION"
+check_partition "$INFERENCE_PARTITION"
+
 # Default to all profiles if user didn't specify
 if [[ -z "${GPU_PROFILES:-}" ]]; then
-    readarray -t GPU_PROFILES_ARRAY < <(jq -r '.gpu_profiles | keys | .[]' "$CLUSTER_CONFIG")
-    export GPU_PROFILES=$(IFS=','; echo "${GPU_PROFILES_ARRAY[*]}")
+    export GPU_PROFILES=$(jq -r '[.profiles[].name] | join(",")' "$RUN_PLAN")
 fi
 
 check_gres_in_partition() {
@@ -96,6 +177,15 @@ check_gres_in_partition() {
     fi
 }
 
+partition_max_minutes() {
+    local max_time days time_part hours minutes seconds
+    max_time=$(scontrol show partition "$1" | awk 'match($0,/MaxTime=([^ ]+)/,a){print a[1]}')
+    [[ $max_time =~ infinite|UNLIMITED ]] && { echo 0; return; }
+    [[ $max_time == *-* ]] && days=${max_time%%-*} time_part=${max_time#*-} || days=0 time_part=$max_time
+    IFS=: read hours minutes seconds <<<"$time_part"
+    echo $(( 10#$days*1440 + 10#$hours*60 + 10#$minutes ))
+}
+
 slurm_limit_exceeded() {
     max_time=$(scontrol show partition "$1" | awk 'match($0,/MaxTime=([^ ]+)/,a){print a[1]}')
     [[ $max_time =~ infinite|UNLIMITED ]] && return 1
@@ -106,39 +196,26 @@ slurm_limit_exceeded() {
 
 IFS=',' read -ra seed_array <<< "$SEEDS"
 num_seeds=${#seed_array[@]}
-IFS=',' read -ra GPU_PROFILES_ARRAY <<< "$GPU_PROFILES"
-for profile in "${GPU_PROFILES_ARRAY[@]}"; do
-    # Check if profile exists in cluster config
-    if ! jq -e --arg p "$profile" '.gpu_profiles[$p]' "$CLUSTER_CONFIG" > /dev/null; then
-        echo "Error: GPU profile '$profile' not found in cluster config ($CLUSTER_CONFIG)" >&2
-        exit 1
-    fi
-
-    # Parse profile data
-    gpu_gres=$(jq -r --arg p "$profile" '.gpu_profiles[$p].gres' "$CLUSTER_CONFIG")
-    token_limit=$(jq -r --arg p "$profile" '.gpu_profiles[$p].token_limit' "$CLUSTER_CONFIG")
-    max_minutes=$(jq -r --arg p "$profile" '.gpu_profiles[$p].max_minutes_per_seed' "$CLUSTER_CONFIG")
-
-    # Validate token_limit
-    if ! [[ "$token_limit" =~ ^[1-9][0-9]*$ ]]; then
-        echo "Error: token_limit for GPU profile '$profile' is missing or invalid: $token_limit" >&2
-        exit 1
-    fi
-
-    # Validate max_minutes
-    if ! [[ "$max_minutes" =~ ^[1-9][0-9]*$ ]]; then
-        echo "Error: max_minutes_per_seed for GPU profile '$profile' is missing or invalid." >&2
-        exit 1
-    fi
-    gpu_time=$(( max_minutes * num_seeds ))
+# Seeds run by one task (seed sharding splits every job into several tasks)
+task_seeds=$num_seeds
+if (( ${SEEDS_PER_TASK:-0} > 0 && SEEDS_PER_TASK < num_seeds )); then
+    task_seeds=$SEEDS_PER_TASK
+fi
+# Profiles of the plan are ordered by token limit, as they are assigned in make_inference_inputs.py
+declare -A PROFILE_TOKEN_LIMITS
+SORTED_PROFILES=()
+while read -r profile gpu_gres token_limit max_minutes; do
+    PROFILE_TOKEN_LIMITS[$profile]=$token_limit
+    SORTED_PROFILES+=("$profile")
+    gpu_time=$(( max_minutes * task_seeds ))
     if slurm_limit_exceeded "$INFERENCE_PARTITION" "$gpu_time"; then
-        echo "Error: Job time for profile '$profile' ($gpu_time minutes) exceeds MaxTime of partition '$INFERENCE_PARTITION'. Please reduce the number of seeds." >&2
+        echo "Error: Task time for profile '$profile' ($gpu_time minutes for $task_seeds seeds) exceeds MaxTime of partition '$INFERENCE_PARTITION'. Please reduce the number of seeds or set SEEDS_PER_TASK." >&2
         exit 1
     fi
 
     # Check if gres exists in partition
     check_gres_in_partition "$INFERENCE_PARTITION" "$gpu_gres" "$profile"
-done
+done < <(jq -r '.profiles[] | "\(.name) \(.gres) \(.token_limit) \(.max_minutes_per_seed)"' "$RUN_PLAN")
 
 #########################################################################################################################
 #															#
@@ -146,20 +223,13 @@ done
 #															#
 #########################################################################################################################
 
-if ! output=$(python3 utilities/analyze_job_input_json.py "$INPUT_FILE" "$MODE"); then
-    echo "Validation of input file failed. Aborting."
-    exit 1
-fi
-
-read TOTAL_DATAPIPELINE_JOBS TOTAL_INFERENCE_JOBS <<< "$output"
+# Unique proteins, protein-only jobs and jobs per GPU profile (followed by the too big ones) as counted by the planner
+read -r TOTAL_DATAPIPELINE_JOBS TOTAL_INFERENCE_JOBS NUM_DIMENSIONS < <(jq -r \
+    '"\(.counts.proteins) \(.counts.jobs) \(.dimensions | length)"' "$RUN_PLAN")
+read -r -a PROFILE_JOB_COUNTS < <(jq -r '.counts.profile_jobs | join(" ")' "$RUN_PLAN")
 
 if [[ -n "${SCREEN_FILE:-}" ]]; then
-    if ! output_screen=$(python3 utilities/validate_screen_json.py); then
-        echo "Validation of screen file failed. Aborting."
-        exit 1
-    fi
-
-    read total_compounds valid_compounds <<< "$output_screen"
+    valid_compounds=$(jq -r '.screen.valid' "$RUN_PLAN")
 
     if [[ "$valid_compounds" =~ ^[1-9][0-9]*$ ]]; then
         total_inference_jobs_without_compounds=$TOTAL_INFERENCE_JOBS
@@ -170,7 +240,6 @@ if [[ -n "${SCREEN_FILE:-}" ]]; then
 fi
 
 export TOTAL_DATAPIPELINE_JOBS TOTAL_INFERENCE_JOBS
-NUM_DIMENSIONS=$(jq 'length' "$INPUT_FILE")
 
 if [[ "$MODE" == "cartesian" ]]; then
     MODE_DESC="all combinations across dimensions ('cartesian')"
@@ -189,6 +258,19 @@ if [[ -n "${SCREEN_FILE:-}" && "$valid_compounds" =~ ^[1-9][0-9]*$ ]]; then
 fi
 echo "Generating $TOTAL_INFERENCE_JOBS job(s) using mode: $MODE_DESC."
 echo
+echo "Protein-only jobs per GPU profile by padded AF3 bucket size (compounds not included):"
+for i in "${!SORTED_PROFILES[@]}"; do
+    echo "  ${SORTED_PROFILES[$i]} (<= ${PROFILE_TOKEN_LIMITS[${SORTED_PROFILES[$i]}]} tokens): ${PROFILE_JOB_COUNTS[$i]}"
+done
+echo "  too big: ${PROFILE_JOB_COUNTS[-1]}"
+echo
+if [[ -n "${SPILL_GPUS:-}" ]]; then
+    echo "Predicted makespan on $SPILL_GPUS GPUs (jobs are spilled to larger profiles if that is faster):"
+    if ! python3 utilities/makespan_simulator.py simulate "pending_jobs/$PIPELINE_RUN_ID"; then
+        exit 1
+    fi
+    echo
+fi
 
 read -r -p "Do you want to continue? [Y/n] " answer
 
@@ -200,6 +282,7 @@ answer=$(echo "$answer" | tr '[:upper:]' '[:lower:]')
 
 case "$answer" in
     y|yes|ja|1)
+        trap - EXIT
         echo "Continuing..."
         ;;
     n|no|nein|0)
@@ -239,16 +322,63 @@ if [[ "$created_jsons" -lt "$TOTAL_DATAPIPELINE_JOBS" ]]; then
 fi
 
 if (( TOTAL_DATAPIPELINE_JOBS > 0 )); then
+    dp_statistics_header="pipeline_run_id,datapipeline_id,datapipeline_name,job_id,task_id,node,sequence_length,start_time,end_time,db_staging_seconds,search_seconds,cpus,jobs_in_task,input_copy_seconds,startup_seconds,msa_extraction_seconds"
     if [[ -n "${DATAPIPELINE_STATISTICS_FILE:-}" && ! -f "$DATAPIPELINE_STATISTICS_FILE" ]]; then
-        echo "pipeline_run_id,datapipeline_id,datapipeline_name,job_id,task_id,node,sequence_length,start_time,end_time" > "$DATAPIPELINE_STATISTICS_FILE"
+        echo "$dp_statistics_header" > "$DATAPIPELINE_STATISTICS_FILE"
+    elif [[ -n "${DATAPIPELINE_STATISTICS_FILE:-}" && "$(head -n 1 "$DATAPIPELINE_STATISTICS_FILE")" != "$dp_statistics_header" ]]; then
+        # Statistics files of earlier versions: add the new columns (empty for old rows)
+        sed -i "1s/.*/${dp_statistics_header}/" "$DATAPIPELINE_STATISTICS_FILE"
+    fi
+
+    # Pack the monomers (ordered by length) into tasks with CPUs, memory and walltime per resource class
+    if ! python3 utilities/datapipeline_sizing.py plan data_pipeline_inputs/$PIPELINE_RUN_ID pending_jobs/$PIPELINE_RUN_ID \
+            --max-per-task "${MONOMERS_PER_TASK:-1}" --partition-max-minutes "$(partition_max_minutes "$DATAPIPELINE_PARTITION")" \
+            --max-array-size "$MAX_ARRAY_SIZE"; then
+        echo "Error: could not plan the data pipeline tasks." >&2
+        exit 1
     fi
 
-    # Submit only the first chunk; recursion handled inside af3_datapipeline_only_slurm.sh
-    sbatch --array=0-$(( MAX_ARRAY_SIZE < TOTAL_DATAPIPELINE_JOBS ? MAX_ARRAY_SIZE-1 : TOTAL_DATAPIPELINE_JOBS-1 )) \
-           --partition=${DATAPIPELINE_PARTITION} \
-           --export=ALL,START_OFFSET=0 \
-           utilities/af3_datapipeline_only_slurm.sh
+    # In streaming mode the controller submits the data pipeline tasks itself
+    if [[ "${STREAMING:-false}" != "true" ]]; then
+        # Submit only the first array; recursion handled inside af3_datapipeline_only_slurm.sh
+        read -r first last pack cpus mem_gb minutes < <(jq -r \
+            '.[0] | "\(.first) \(.last) \(.pack) \(.cpus) \(.mem_gb) \(.minutes)"' pending_jobs/$PIPELINE_RUN_ID/datapipeline_arrays.json)
+        sbatch --array=0-$(( (last - first + pack) / pack - 1 )) \
+               --partition=${DATAPIPELINE_PARTITION} \
+               --cpus-per-task=$cpus \
+               --mem=${mem_gb}G \
+               --time=$minutes \
+               --export=ALL,START_OFFSET=0,DP_ARRAY=0,DP_RANGE_START=$first,DP_RANGE_END=$last,DP_JOBS_PER_TASK=$pack \
+               utilities/af3_datapipeline_only_slurm.sh
+    fi
 else
     echo "Datapipeline stage was skipped completely."
+fi
+
+if [[ "${STREAMING:-false}" == "true" ]]; then
+    # Queue limit for the controller: all array tasks of the user count against MaxSubmitJobs
+    MAX_SUBMIT_JOBS=$(jq -r '.cluster.max_submit_jobs // empty' "$RUN_PLAN")
+    if [[ -z "$MAX_SUBMIT_JOBS" ]]; then
+        MAX_SUBMIT_JOBS=$(sacctmgr -nP show assoc user="$USER" format=MaxSubmit 2>/dev/null | awk 'NF {print; exit}')
+    fi
+    export MAX_SUBMIT_JOBS=${MAX_SUBMIT_JOBS:-$MAX_ARRAY_SIZE}
+    echo "Streaming mode: a controller job keeps up to $MAX_SUBMIT_JOBS tasks queued and submits inference jobs as soon as their monomers are ready."
+fi
+
+# Environment of the run for utilities/resume_run.sh
+run_variables="PIPELINE_RUN_ID|INPUT_FILE|MODE|SEEDS|RESULTS_PER_DIR|JOBS_PER_TASK|SORTING|SCREEN_FILE|MAX_COMPOUND_ATOMS"
+run_variables+="|VIRTUAL_JOBS|STREAMING|STREAM_INTERVAL|CLUSTER_CONFIG|GPU_PROFILES|DATAPIPELINE_STATISTICS_FILE"
+run_variables+="|INFERENCE_STATISTICS_FILE|POSTPROCESSING_SCRIPT|AF3_CONTAINER_PATH|AF3_MODEL_PATH|AF3_DB_PATH"
+run_variables+="|DATAPIPELINE_PARTITION|INFERENCE_PARTITION|TOTAL_DATAPIPELINE_JOBS|TOTAL_INFERENCE_JOBS|MAX_ARRAY_SIZE"
+run_variables+="|OUR_ARRAY_SIZE|MAX_SUBMIT_JOBS|SEEDS_PER_TASK|MONOMERS_PER_TASK|POSTPROCESSING_WORKERS|POSTPROCESSING_BATCH_SIZE"
+run_variables+="|SPILL_GPUS|NODE_TYPE|NODES"
+mkdir -p pending_jobs/$PIPELINE_RUN_ID
+export -p | grep -E "^declare -x (${run_variables})=" > pending_jobs/$PIPELINE_RUN_ID/run_env.sh
+
+if [[ "${STREAMING:-false}" == "true" ]]; then
+    controller_job=$(sbatch --parsable utilities/pipeline_controller.sh)
+    echo "$controller_job" > pending_jobs/$PIPELINE_RUN_ID/controller_job
+    echo "Submitted controller job $controller_job"
+elif (( TOTAL_DATAPIPELINE_JOBS == 0 )); then
     sbatch utilities/submit_data_pipeline_part_2.sh
 fi
\ No newline at end of file
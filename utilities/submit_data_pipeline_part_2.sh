@@ -1,6 +1,7 @@
 #!/usr/bin/env bash
 #SBATCH --job-name=AF3_part_2
 #SBATCH --time=01:00:00
+#SBATCH --cpus-per-task=4
 #SBATCH --output=slurm-output/slurm-%j-%x.out # %j (Job ID) %x (Job Name)
 
 rm -rf data_pipeline_inputs/$PIPELINE_RUN_ID
@@ -9,12 +10,15 @@ rm -rf data_pipeline_inputs/$PIPELINE_RUN_ID
 # Phase 1: Run make_inference_inputs.py and parse job info
 # ------------------------------
 
+# Link proteins that share their sequence with a finished entry of the monomer store (no-op without store)
+python3 utilities/monomer_store.py link-run "$INPUT_FILE"
+
 # Run Python function to generate job info
 json_output=$(python3 utilities/make_inference_inputs.py)
 
 # Extract total jobs and too big jobs
 TOTAL_INFERENCE_JOBS=$(echo "$json_output" | jq -r '.total_jobs')
-TOO_BIG_JOBS=$(echo "$json_output" | jq -r '.too_big_jobs | length')
+TOO_BIG_JOBS=$(echo "$json_output" | jq -r '.too_big_count')
 
 # Reconstruct array
 IFS=',' read -ra GPU_PROFILES_ARRAY <<< "$GPU_PROFILES"
@@ -54,6 +58,20 @@ fi
 
 IFS=',' read -ra seed_array <<< "$SEEDS"
 num_seeds=${#seed_array[@]}
+# Seed sharding: every job runs as seed_shards consecutive tasks with shard_seeds seeds each
+shard_seeds=$num_seeds
+if (( ${SEEDS_PER_TASK:-0} > 0 && SEEDS_PER_TASK < num_seeds )); then
+    shard_seeds=$SEEDS_PER_TASK
+fi
+seed_shards=$(( (num_seeds + shard_seeds - 1) / shard_seeds ))
+# Chunks must hold all shards of a job (they merge into the chunk's results directory)
+array_size=$OUR_ARRAY_SIZE
+if (( seed_shards > 1 )); then
+    array_size=$(( (MAX_ARRAY_SIZE / (RESULTS_PER_DIR * seed_shards)) * RESULTS_PER_DIR * seed_shards ))
+    if (( array_size == 0 )); then
+        array_size=$(( (MAX_ARRAY_SIZE / seed_shards) * seed_shards ))
+    fi
+fi
 
 # ------------------------------
 # Phase 2: Submit inference jobs
@@ -63,6 +81,53 @@ if [[ -n "${INFERENCE_STATISTICS_FILE:-}" && ! -f "$INFERENCE_STATISTICS_FILE" ]
     touch $INFERENCE_STATISTICS_FILE
 fi
 
+partition_max_minutes() {
+    local max_time days time_part hours minutes seconds
+    max_time=$(scontrol show partition "$1" | awk 'match($0,/MaxTime=([^ ]+)/,a){print a[1]}')
+    [[ $max_time =~ infinite|UNLIMITED ]] && { echo 0; return; }
+    [[ $max_time == *-* ]] && days=${max_time%%-*} time_part=${max_time#*-} || days=0 time_part=$max_time
+    IFS=: read hours minutes seconds <<<"$time_part"
+    echo $(( 10#$days*1440 + 10#$hours*60 + 10#$minutes ))
+}
+PARTITION_MAX_MINUTES=$(partition_max_minutes "$INFERENCE_PARTITION")
+
+# Whole-node mode: NODES node jobs with one worker per GPU take the jobs of all profiles from a queue
+if [[ -n "${NODE_TYPE:-}" ]]; then
+    read -r node_gres node_minutes < <(jq -r --arg n "$NODE_TYPE" '.gpu_nodes[$n] | "\(.gres) \(.max_minutes // 0)"' "$CLUSTER_CONFIG")
+    if (( node_minutes == 0 )); then
+        node_minutes=$PARTITION_MAX_MINUTES
+    fi
+    if (( node_minutes == 0 )); then
+        echo "Error: set max_minutes of node type '$NODE_TYPE' (partition '$INFERENCE_PARTITION' has no time limit)." >&2
+        exit 1
+    fi
+    echo "$json_output" | python3 utilities/node_queue.py init "pending_jobs/$PIPELINE_RUN_ID"
+    for (( node = 0; node < ${NODES:-1}; node++ )); do
+        sbatch --partition="${INFERENCE_PARTITION}" \
+               --gres=${node_gres} \
+               --time=${node_minutes} \
+               --export=ALL,NODE_GRES=$node_gres,NODE_MINUTES=$node_minutes \
+               utilities/af3_inference_node.sh
+    done
+    echo "Submitted ${NODES:-1} '$NODE_TYPE' node job(s) of ${node_minutes} minutes."
+    exit 0
+fi
+
+# Largest pack size <= JOBS_PER_TASK that fits the partition MaxTime and divides RESULTS_PER_DIR
+# (so that all jobs of one task end up in the same results directory)
+pack_size() {
+    local gpu_time=$1
+    local pack=${JOBS_PER_TASK:-1}
+    if (( PARTITION_MAX_MINUTES > 0 && pack * gpu_time > PARTITION_MAX_MINUTES )); then
+        pack=$(( PARTITION_MAX_MINUTES / gpu_time ))
+    fi
+    (( pack < 1 )) && pack=1
+    while (( RESULTS_PER_DIR % pack != 0 )); do
+        pack=$(( pack - 1 ))
+    done
+    echo $pack
+}
+
 # Loop over all selected GPU profiles
 for profile in "${GPU_PROFILES_ARRAY[@]}"; do
     job_count=${JOB_COUNTS[$profile]:-0}
@@ -73,18 +138,50 @@ for profile in "${GPU_PROFILES_ARRAY[@]}"; do
     fi
     enable_xla=$(jq -r --arg p "$profile" '.gpu_profiles[$p].enable_xla // false' "$CLUSTER_CONFIG")
     max_minutes=$(jq -r --arg p "$profile" '.gpu_profiles[$p].max_minutes_per_seed' "$CLUSTER_CONFIG")
-    gpu_time=$(( max_minutes * num_seeds ))
+    max_gpu_time=$(( max_minutes * shard_seeds ))
 
-    if [[ $job_count -gt 0 ]]; then
-        first_chunk_size=$(( job_count < OUR_ARRAY_SIZE ? job_count : OUR_ARRAY_SIZE ))
-        echo "Submitting ${profile} inference jobs (0-$((first_chunk_size - 1))) with GPU '$gpu_type'."
-        sbatch --array=0-$(( first_chunk_size - 1 )) \
-               --partition="${INFERENCE_PARTITION}" \
-               --gres=${gpu_type}:1 \
-               --time=${gpu_time} \
-               --export=ALL,TOTAL_INFERENCE_JOBS=$job_count,START_OFFSET=0,GPU_PROFILE=$profile,GPU_TYPE=$gpu_type,ENABLE_XLA=$enable_xla,GPU_TIME=$gpu_time \
-               utilities/af3_inference_only_slurm.sh
-    else
+    if [[ $job_count -eq 0 ]]; then
         echo "No jobs to submit for GPU profile '$profile'."
+        continue
+    fi
+
+    # One array per range of INFERENCE_IDs (ordered by AF3 bucket) with the walltime predicted from
+    # the inference statistics. Without history the whole profile gets the configured limit.
+    ranges=$(echo "$json_output" | python3 utilities/walltime_predictor.py ranges "$profile" --seeds "$shard_seeds" --max-minutes "$max_gpu_time")
+    if [[ -z "$ranges" ]]; then
+        ranges="0 $(( job_count - 1 )) $max_gpu_time"
     fi
-done
\ No newline at end of file
+
+    while read -r range_start range_end gpu_time; do
+        range_jobs=$(( range_end - range_start + 1 ))
+        if (( seed_shards > 1 )); then
+            jobs_per_task=1
+            task_count=$(( range_jobs * seed_shards ))
+            task_content="$shard_seeds of $num_seeds seeds per task"
+        else
+            jobs_per_task=$(pack_size "$gpu_time")
+            task_count=$(( (range_jobs + jobs_per_task - 1) / jobs_per_task ))
+            task_content="$jobs_per_task job(s) per task"
+        fi
+        task_time=$(( gpu_time * jobs_per_task ))
+        first_chunk_size=$(( task_count < array_size ? task_count : array_size ))
+        echo "Submitting ${profile} inference jobs ${range_start}-${range_end} (tasks 0-$((first_chunk_size - 1)), $task_content, ${task_time} min per task) with GPU '$gpu_type'."
+        inference_job=$(sbatch --parsable \
+               --array=0-$(( first_chunk_size - 1 )) \
+               --partition="${INFERENCE_PARTITION}" \
+               --gres=${gpu_type}:1 \
+               --time=${task_time} \
+               --export=ALL,TOTAL_INFERENCE_JOBS=$job_count,RANGE_START=$range_start,RANGE_END=$range_end,START_OFFSET=0,GPU_PROFILE=$profile,GPU_TYPE=$gpu_type,ENABLE_XLA=$enable_xla,GPU_TIME=$task_time,JOBS_PER_TASK=$jobs_per_task,OUR_ARRAY_SIZE=$array_size \
+               utilities/af3_inference_only_slurm.sh)
+        echo "Submitted batch job $inference_job"
+        echo "$inference_job" >> "pending_jobs/$PIPELINE_RUN_ID/inference_jobs"
+    done <<< "$ranges"
+done
+
+# Failed and lost jobs are resubmitted once after all inference arrays ended (utilities/resume_run.sh for more)
+if [[ -s "pending_jobs/$PIPELINE_RUN_ID/inference_jobs" ]]; then
+    resume_job=$(sbatch --parsable \
+                 --dependency=afterany:$(paste -sd: "pending_jobs/$PIPELINE_RUN_ID/inference_jobs") \
+                 utilities/resume_batch.sh)
+    echo "Failed inference jobs are resubmitted once after the arrays ended: job $resume_job"
+fi
\ No newline at end of file
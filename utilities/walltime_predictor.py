@@ -0,0 +1,174 @@
+import os
+import sys
+import json
+import math
+import argparse
+from datetime import datetime
+
+TIME_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+DEFAULT_QUANTILE = 0.95
+DEFAULT_MARGIN = 0.2
+DEFAULT_MIN_SAMPLES = 5
+SAFETY_MINUTES = 5  # added to every prediction (container start, model loading, writing results)
+
+
+def record_seeds(record):
+    """Number of seeds of a statistics record (older records: count the seeds in the confidences)."""
+    if record.get("num_seeds"):
+        return record["num_seeds"]
+    seeds = {key.split("_")[0] for key in (record.get("af3_confidences") or {}) if key.startswith("seed-")}
+    return len(seeds) or None
+
+def completed_seeds(record):
+    """
+    Seeds inferred by a job that completed, None for jobs that ran out of memory or time or failed otherwise
+    (records from before the outcome was recorded count as completed with all their seeds).
+    """
+    if record.get("outcome", "done") != "done":
+        return None
+    return record.get("seeds_inferred") or record_seeds(record)
+
+def record_minutes(record):
+    try:
+        start = datetime.strptime(record["start_time"], TIME_FORMAT)
+        end = datetime.strptime(record["end_time"], TIME_FORMAT)
+    except (KeyError, TypeError, ValueError):
+        return None
+    return (end - start).total_seconds() / 60
+
+def load_history(stats_file):
+    """Completed jobs of the inference statistics JSONL: (run id, profile, bucket, seeds inferred, minutes)."""
+    history = []
+    if not stats_file or not os.path.exists(stats_file):
+        return history
+    with open(stats_file, "r") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            minutes = record_minutes(record)
+            seeds = completed_seeds(record)
+            if minutes is None or minutes <= 0 or not seeds or record.get("bucket_size") is None:
+                continue
+            history.append((record.get("pipeline_run_id"), record.get("gpu_profile"), record["bucket_size"], seeds, minutes))
+    return history
+
+def quantile(values, q):
+    """Nearest-rank quantile."""
+    values = sorted(values)
+    return values[min(len(values) - 1, max(0, math.ceil(q * len(values)) - 1))]
+
+class WalltimeModel:
+    """Quantile of the minutes per seed for every (GPU profile, AF3 bucket)."""
+
+    def __init__(self, history, q=DEFAULT_QUANTILE, margin=DEFAULT_MARGIN, min_samples=DEFAULT_MIN_SAMPLES):
+        self.margin = margin
+        samples = {}
+        for _, profile, bucket, seeds, minutes in history:
+            samples.setdefault((profile, bucket), []).append(minutes / seeds)
+        self.per_seed = {key: quantile(values, q) for key, values in samples.items() if len(values) >= min_samples}
+
+    def minutes_per_seed(self, profile, bucket):
+        """Estimate for a bucket, else the one of the next larger bucket with enough history (runtime grows with size)."""
+        if bucket is None:
+            return None
+        candidates = [(b, m) for (p, b), m in self.per_seed.items() if p == profile and b >= bucket]
+        return min(candidates)[1] if candidates else None
+
+    def predict(self, profile, bucket, seeds, max_minutes=None):
+        """Walltime in minutes for one job; max_minutes (the configured limit) without history."""
+        per_seed = self.minutes_per_seed(profile, bucket)
+        if per_seed is None:
+            return max_minutes
+        minutes = math.ceil(per_seed * seeds * (1 + self.margin)) + SAFETY_MINUTES
+        return min(minutes, max_minutes) if max_minutes else minutes
+
+def load_model(stats_file, cluster_conf, exclude_run=None):
+    history = [h for h in load_history(stats_file) if exclude_run is None or h[0] != exclude_run]
+    return WalltimeModel(history,
+                         float(cluster_conf.get("walltime_quantile", DEFAULT_QUANTILE)),
+                         float(cluster_conf.get("walltime_margin", DEFAULT_MARGIN)),
+                         int(cluster_conf.get("walltime_min_samples", DEFAULT_MIN_SAMPLES)))
+
+def id_ranges(model, profile, bucket_counts, seeds, max_minutes):
+    """
+    Split the INFERENCE_IDs of a profile (ordered by bucket) into ranges (first, last, minutes per job).
+    Neighbouring buckets with the same prediction share a range.
+    """
+    ranges = []
+    start = 0
+    for entry in bucket_counts:
+        if not entry["jobs"]:
+            continue
+        minutes = model.predict(profile, entry["bucket"], seeds, max_minutes)
+        end = start + entry["jobs"] - 1
+        if ranges and ranges[-1][2] == minutes:
+            ranges[-1][1] = end
+        else:
+            ranges.append([start, end, minutes])
+        start = end + 1
+    return ranges
+
+def report(stats_file, cluster_conf):
+    """Leave-one-run-out evaluation: predict every job of a run from all other runs."""
+    history = load_history(stats_file)
+    rows = {}
+    for run_id in sorted({h[0] for h in history}, key=str):
+        model = load_model(stats_file, cluster_conf, exclude_run=run_id)
+        for run, profile, bucket, seeds, minutes in history:
+            if run != run_id:
+                continue
+            max_per_seed = cluster_conf.get("gpu_profiles", {}).get(profile, {}).get("max_minutes_per_seed")
+            max_minutes = max_per_seed * seeds if max_per_seed else None
+            predicted = model.predict(profile, bucket, seeds, max_minutes)
+            rows.setdefault((profile, bucket), []).append((minutes, predicted, model.minutes_per_seed(profile, bucket) is not None))
+
+    print(f"{'profile':<12} {'bucket':>6} {'jobs':>6} {'actual':>8} {'predicted':>9} {'reserved':>9} {'under':>6} {'fallback':>8}")
+    total_actual = total_predicted = 0
+    for (profile, bucket), values in sorted(rows.items(), key=lambda item: (str(item[0][0]), item[0][1])):
+        predicted_values = [p for _, p, _ in values if p is not None]
+        actual = sum(a for a, _, _ in values)
+        predicted = sum(predicted_values)
+        under = sum(1 for a, p, _ in values if p is not None and a > p)
+        fallback = sum(1 for _, _, learned in values if not learned)
+        total_actual += actual
+        total_predicted += predicted
+        print(f"{str(profile):<12} {bucket:>6} {len(values):>6} {actual / len(values):>8.1f} "
+              f"{predicted / max(len(predicted_values), 1):>9.1f} {predicted / actual if actual else 0:>8.2f}x {under:>6} {fallback:>8}")
+    if total_actual:
+        print(f"Reserved/actual GPU time overall: {total_predicted / total_actual:.2f}x")
+
+def main():
+    parser = argparse.ArgumentParser(description="Walltime prediction for inference jobs from the inference statistics.")
+    parser.add_argument("--cluster-config", default=os.environ.get("CLUSTER_CONFIG"), help="Cluster configuration JSON")
+    parser.add_argument("--stats", default=os.environ.get("INFERENCE_STATISTICS_FILE"), help="Inference statistics JSONL")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    p_ranges = subparsers.add_parser("ranges", help="Read make_inference_inputs.py output from stdin and print "
+                                                    "'<first id> <last id> <minutes per job>' per array of a profile")
+    p_ranges.add_argument("profile")
+    p_ranges.add_argument("--seeds", type=int, required=True)
+    p_ranges.add_argument("--max-minutes", type=int, required=True, help="Configured limit (max_minutes_per_seed * seeds)")
+    p_predict = subparsers.add_parser("predict", help="Print the predicted minutes of one job")
+    p_predict.add_argument("profile")
+    p_predict.add_argument("bucket", type=int)
+    p_predict.add_argument("--seeds", type=int, required=True)
+    subparsers.add_parser("report", help="Predicted versus actual runtime (leave-one-run-out)")
+    args = parser.parse_args()
+
+    with open(args.cluster_config, "r") as f:
+        cluster_conf = json.load(f)
+
+    if args.command == "ranges":
+        profile_info = json.load(sys.stdin)["profiles"][args.profile]
+        bucket_counts = profile_info.get("buckets") or [{"bucket": None, "jobs": profile_info["jobs"]}]
+        model = load_model(args.stats, cluster_conf)
+        for first, last, minutes in id_ranges(model, args.profile, bucket_counts, args.seeds, args.max_minutes):
+            print(first, last, minutes)
+    elif args.command == "predict":
+        print(load_model(args.stats, cluster_conf).predict(args.profile, args.bucket, args.seeds))
+    elif args.command == "report":
+        report(args.stats, cluster_conf)
+
+if __name__ == "__main__":
+    main()